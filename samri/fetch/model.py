@@ -1,5 +1,7 @@
+import os
 import shutil
 import getpass
+from glob import glob
 from os import path
 from samri.pipelines import glm
 from samri.fetch.local import prepare_abi_connectivity_maps
@@ -22,8 +24,9 @@ def abi_connectivity_map(identifier,
 	Parameters
 	----------
 
-	identifier : str
+	identifier : str or list of str
 		Experiment set identifier which corresponds to the data set paths from the ABI-connectivity-data package.
+		If a list of identifiers is given, the maps for all of them are estimated as one batch (via `samri.pipelines.glm.l2_batch`).
 	exclude_experiments : list of str, optional
 		List of strings, each string 9 characters long, identifying which experiments should be excluded from the modelling.
 	keep_work : bool, optional
@@ -39,10 +42,13 @@ def abi_connectivity_map(identifier,
 		Python-formattable string, containing "{experiment}" according to which the prepared (e.g. flipped) data from ABI experiments is to be organized inside the `prepare_root` directory.
 	save_as_cope : str, optional
 		Path under which to save the COPE result of the modelling.
+		This may contain "{identifier}", which is required if multiple identifiers are specified.
 	save_as_tstat : str, optional
 		Path under which to save the t-statistic result of the modelling.
+		This may contain "{identifier}", which is required if multiple identifiers are specified.
 	save_as_zstat : str, optional
 		Path under which to save the z-statistic result of the modelling.
+		This may contain "{identifier}", which is required if multiple identifiers are specified.
 	tmp_dir : string, optional
 		Temporary directory inside which to execute the modelling workflow.
 		Generally this should be a temporal and new path, containing either "{user}" or located under the user's home directory, in order to avoid race conditions between users.
@@ -65,40 +71,47 @@ def abi_connectivity_map(identifier,
 	prepare_root = prepare_root.format(user=current_user)
 	tmp_dir = tmp_dir.format(user=current_user)
 
+	identifiers = [identifier] if isinstance(identifier, str) else list(identifier)
+	save_as = {'cope': save_as_cope, 'tstat': save_as_tstat, 'zstat': save_as_zstat}
+	save_as = {key: value for key, value in save_as.items() if value}
+	if not save_as:
+		save_as = {key: '{identifier}_'+key+'.nii.gz' for key in ['cope','tstat','zstat']}
+	elif len(identifiers) > 1 and not all(['{identifier}' in value for value in save_as.values()]):
+		raise ValueError('If multiple identifiers are specified, the `save_as_cope`, `save_as_tstat`, and `save_as_zstat` paths need to contain "{identifier}".')
+
 	reposit_path = path.join(prepare_root,'{identifier}',prepare_subdirs)
-	prepare_abi_connectivity_maps(identifier,
-		abi_data_root=abi_data_root,
-		reposit_path=reposit_path,
-		invert_lr_experiments=invert_lr_experiments,
-		)
-	prepare_root=prepare_root.format(identifier=identifier)
-	glm.l2_common_effect(prepare_root,
-		workflow_name=identifier,
+	jobs = []
+	for identifier_ in identifiers:
+		prepare_abi_connectivity_maps(identifier_,
+			abi_data_root=abi_data_root,
+			reposit_path=reposit_path,
+			invert_lr_experiments=invert_lr_experiments,
+			)
+		excluded = [reposit_path.format(identifier=identifier_, experiment=i) for i in exclude_experiments]
+		cope_files = sorted(glob(reposit_path.format(identifier=identifier_, experiment='*')))
+		jobs.append({
+			'name': identifier_,
+			'cope_files': [i for i in cope_files if i not in excluded],
+			})
+	# The experiment maps come without variance maps, so only an OLS estimate is possible.
+	summary = glm.l2_batch(jobs, tmp_dir,
 		mask=mask,
+		run_mode='ols',
 		n_jobs_percentage=.33,
-		out_base=tmp_dir,
-		exclude={'subject':exclude_experiments},
-		run_mode='fe',
-		keep_work=keep_work,
+		statistics=list(save_as.keys()),
 		)
-	if save_as_zstat:
-		zstat_path = path.join(tmp_dir,identifier,'_zstat.nii.gz')
-		shutil.copyfile(zstat_path, save_as_zstat)
-	if save_as_tstat:
-		tstat_path = path.join(tmp_dir,identifier,'_tstat.nii.gz')
-		shutil.copyfile(tstat_path, save_as_tstat)
-	if save_as_cope:
-		cope_path = path.join(tmp_dir,identifier,'_cope.nii.gz')
-		shutil.copyfile(cope_path, save_as_cope)
-	if not any([save_as_zstat,save_as_tstat,save_as_cope]):
-		zstat_path = path.join(tmp_dir,identifier,'_zstat.nii.gz')
-		shutil.copyfile(zstat_path, '{identifier}_zstat.nii.gz')
-		tstat_path = path.join(tmp_dir,identifier,'_tstat.nii.gz')
-		shutil.copyfile(tstat_path, '{identifier}_tstat.nii.gz')
-		cope_path = path.join(tmp_dir,identifier,'_cope.nii.gz')
-		shutil.copyfile(cope_path, '{identifier}_cope.nii.gz')
+
+	for _, job in summary[summary['status'] == 'completed'].iterrows():
+		for statistic, save_as_path in save_as.items():
+			shutil.copyfile(job[statistic], save_as_path.format(identifier=job['name']))
 
 	if not keep_work:
-		results_dir = path.join(tmp_dir,identifier)
-		shutil.rmtree(results_dir)
-		shutil.rmtree(prepare_root)
+		for _, job in summary.iterrows():
+			for statistic in save_as:
+				if isinstance(job[statistic], str) and path.isfile(job[statistic]):
+					os.remove(job[statistic])
+		for identifier_ in identifiers:
+			shutil.rmtree(path.join(prepare_root,identifier_))
+	failed = summary[summary['status'] == 'failed']
+	if len(failed) != 0:
+		raise RuntimeError('The model could not be estimated for the following identifiers:\n'+'\n'.join(failed['name']+': '+failed['error']))
@@ -23,3 +23,33 @@ def test_abi_connectivity_map(tmp_path):
 		save_as_tstat=f'{tmp_path}/vta_tstat.nii.gz',
 		save_as_cope=f'{tmp_path}/vta_cope.nii.gz',
 		)
+
+def test_abi_connectivity_map_layout(tmp_path, monkeypatch):
+	import nibabel as nib
+	import numpy as np
+	import os
+	from samri.fetch import model
+
+	experiments = ['100000001', '100000002', '100000003', '100000004']
+	rng = np.random.default_rng(0)
+	maps = {i: rng.normal(1, 1, (3,3,2)).astype(np.float32) for i in experiments}
+	def prepare(identifier, reposit_path='', **kwargs):
+		for experiment, data in maps.items():
+			save_as = reposit_path.format(identifier=identifier, experiment=experiment)
+			os.makedirs(os.path.dirname(save_as), exist_ok=True)
+			nib.save(nib.Nifti1Image(data, np.eye(4)), save_as)
+	monkeypatch.setattr(model, 'prepare_abi_connectivity_maps', prepare)
+	nib.save(nib.Nifti1Image(np.ones((3,3,2), dtype=np.uint8), np.eye(4)), f'{tmp_path}/mask.nii.gz')
+
+	# The default `prepare_root` and `prepare_subdirs` layout, relocated to the temporary directory.
+	prepare_root = f'{tmp_path}/abi_connectivity/'
+	model.abi_connectivity_map('ventral_tegmental_area',
+		exclude_experiments=['100000004'],
+		mask=f'{tmp_path}/mask.nii.gz',
+		prepare_root=prepare_root,
+		save_as_cope=f'{tmp_path}/vta_cope.nii.gz',
+		tmp_dir=f'{tmp_path}/l2',
+		)
+	cope = nib.load(f'{tmp_path}/vta_cope.nii.gz').get_fdata()
+	np.testing.assert_allclose(cope, np.mean([maps[i] for i in experiments[:3]], axis=0), rtol=1e-5)
+	assert not os.path.exists(f'{prepare_root}/ventral_tegmental_area')
@@ -4,6 +4,8 @@ from os import path
 def flip_axis(img_path,
 	axis=2,
 	out_path='flipped.nii.gz',
+	chunk_size=16,
+	compresslevel=None,
 	):
 	"""Flip along an axis, while avoiding axis inversion (e.g. left-right inversion to right-left).
 
@@ -16,19 +18,25 @@ def flip_axis(img_path,
 		Note that this is the axis which does not change, i.e. in order to rotate an animal from prone to supine (rotating the X and Y axes), the axis selected here should be 2.
 	out_path : str, optional
 		Path to which to save the flipped NIfTI file.
+	chunk_size : int, optional
+		Number of volumes to hold in memory at any one time.
+	compresslevel : int, optional
+		Gzip compression level, from 1 (fastest) to 9 (smallest), used if `out_path` is compressed.
 	"""
 
+	from samri.pipelines.utils import nifti_raw_chunks, nifti_slope_inter, write_nifti_volumes
+
 	img_path = path.abspath(path.expanduser(img_path))
 	out_path = path.abspath(path.expanduser(out_path))
-	img = nib.load(img_path)
-	data = img.get_data()
-	affine = img.affine
+	# Keeping the file open lets chunks of compressed files be read sequentially, rather than decompressing from the start for each chunk.
+	img = nib.load(img_path, keep_file_open=True)
 	if axis == 0:
-	    flipped_data = data[:,::-1,::-1,...]
+		flip = (slice(None), slice(None, None, -1), slice(None, None, -1))
 	elif axis == 1:
-	    flipped_data = data[::-1,:,::-1,...]
+		flip = (slice(None, None, -1), slice(None), slice(None, None, -1))
 	elif axis == 2:
-	    flipped_data = data[::-1,::-1,:,...]
-	flipped_img = nib.Nifti1Image(flipped_data,affine,img.header)
-	nib.save(flipped_img,out_path)
+		flip = (slice(None, None, -1), slice(None, None, -1), slice(None))
+	# Volumes are read from the data proxy already flipped, and written back with the original data type and scaling.
+	volumes = nifti_raw_chunks(img, spatial_slicer=flip, chunk_size=chunk_size)
+	write_nifti_volumes(out_path, img.header, volumes, slope_inter=nifti_slope_inter(img), compresslevel=compresslevel)
 	return out_path
@@ -8,12 +8,8 @@ import json
 import shutil
 
 from copy import deepcopy
+from samri.pipelines.utils import parse_bids_entities, read_jcampdx
 import pandas as pd
-# PyBIDS 0.6.5 and 0.10.2 compatibility
-try:
-	from bids.grabbids import BIDSLayout
-except ModuleNotFoundError:
-	from bids.layout import BIDSLayout
 
 BEST_GUESS_MODALITY_MATCH = {
 	('FLASH',):'T1w',
@@ -22,37 +18,39 @@ BEST_GUESS_MODALITY_MATCH = {
 BIDS_METADATA_EXTRACTION_DICTS = [
 	{'field_name':'EchoTime',
 		'query_file':'method',
-		'regex':r'^##\$EchoTime=(?P<value>.*?)$',
+		'parameter':'EchoTime',
 		'scale': 1./1000.,
 		'type': float,
 		},
 	{'field_name':'FlipAngle',
 		'query_file':'visu_pars',
-		'regex':r'^##\$VisuAcqFlipAngle=(?P<value>.*?)$',
+		'parameter':'VisuAcqFlipAngle',
 		'type': float,
 		},
 	{'field_name':'Manufacturer',
 		'query_file':'configscan',
-		'regex':r'^##ORIGIN=(?P<value>.*?)$',
+		'parameter':'ORIGIN',
 		},
 	{'field_name':'NumberOfVolumesDiscardedByScanner',
 		'query_file':'method',
-		'regex':r'^##\$PVM_DummyScans=(?P<value>.*?)$',
+		'parameter':'PVM_DummyScans',
 		'type': int,
 		},
+	# The coil name is nested in a structure, which is easier to match in the raw file.
 	{'field_name':'ReceiveCoilName',
 		'query_file':'configscan',
 		'regex':r'.*?,COILTABLE,1#\$Name,(?P<value>.*?)#\$Id.*?',
 		},
 	{'field_name':'RepetitionTime',
 		'query_file':'method',
-		'regex':r'^##\$PVM_RepetitionTime=(?P<value>.*?)$',
+		'parameter':'PVM_RepetitionTime',
 		'scale': 1./1000.,
 		'type': float,
 		},
 	{'field_name':'PulseSequenceType',
 		'query_file':'method',
-		'regex':r'^##\$Method=<Bruker:(?P<value>.*?)>$',
+		'parameter':'Method',
+		'regex':r'^Bruker:(?P<value>.*?)$',
 		},
 	]
 MODALITY_MATCH = {
@@ -70,6 +68,8 @@ def extract_volumes(in_files, volume,
 	):
 	"""
 	Iterative wrapper for `samri.pipelines.extract.volume`
+
+	If `volume` is a list, the returned list contains, for each input file, the list of extracted volume files.
 	"""
 
 	from samri.pipelines.extra_functions import extract_volume
@@ -79,7 +79,7 @@ def extract_volumes(in_files, volume,
 	for ix, in_file in enumerate(in_files):
 		out_file = '{}_{}'.format(ix, out_files_base)
 		out_file = path.abspath(path.expanduser(out_file))
-		extract_volume(in_file, volume, axis=axis, out_file=out_file)
+		out_file = extract_volume(in_file, volume, axis=axis, out_file=out_file)
 		out_files.append(out_file)
 	return out_files
 
@@ -88,34 +88,140 @@ def extract_volume(in_file, volume,
 	out_file='extracted_volume.nii.gz'
 	):
 	"""
-	Extract one volume from a given axis of a NIfTI file.
+	Extract one or more volumes from a given axis of a NIfTI file.
+
+	Only the requested volumes are read, via the image data proxy.
+	For gzip-compressed files, the file is kept open between volumes, which are read in ascending order, so that several volumes are extracted in one sequential pass; if the `indexed_gzip` package is installed, it is used for random access into the compressed data.
 
 	Parameters
 	----------
 
 	in_file : string
 		Path to a NIfTI file with more than one volume on the selected axis.
-	volume : int
-		The volume on the selected axis which to extract.
+	volume : int or list of int
+		The volume on the selected axis which to extract, or a list of such volumes.
 		Volume numbering starts at zero.
 	axis : int
 		The axis which to select the volume on.
 		Axis numbering starts at zero.
+	out_file : string, optional
+		Path under which to save the extracted volume.
+		If a list of volumes is extracted, each is saved under this path, with the volume number appended to the file name (before the extension).
+
+	Returns
+	-------
+
+	str or list of str : Path(s) under which the extracted volume(s) were saved.
 	"""
 
 	import nibabel as nib
 	import numpy as np
+	from os import path
 
-	img = nib.load(in_file)
-	data = img.get_data()
-	extracted_data = np.rollaxis(data,axis)[volume]
-	img_ = nib.Nifti1Image(extracted_data, img.affine, img.header)
-	nib.save(img_,out_file)
+	img = nib.load(in_file, keep_file_open=True)
+	if isinstance(volume, (list, tuple)):
+		volumes = list(volume)
+		out_base, extension = path.basename(out_file), ''
+		for i in ['.nii.gz', '.nii']:
+			if out_base.endswith(i):
+				out_base, extension = out_base[:-len(i)], i
+				break
+		out_base = path.join(path.dirname(out_file), out_base)
+		out_files = {i:'{}_{}{}'.format(out_base, i, extension) for i in volumes}
+	else:
+		volumes = [volume]
+		out_files = {volume:out_file}
+
+	for i in sorted(set(volumes)):
+		slicer = [slice(None)] * len(img.shape)
+		slicer[axis] = i
+		extracted_data = np.asanyarray(img.dataobj[tuple(slicer)])
+		img_ = nib.Nifti1Image(extracted_data, img.affine, img.header)
+		nib.save(img_,out_files[i])
+
+	if isinstance(volume, (list, tuple)):
+		return [out_files[i] for i in volumes]
+	return out_file
+
+def merge_statistics(in_files,
+	merged_file='merged.nii.gz',
+	statistic='cope',
+	volume=None,
+	):
+	"""
+	Concatenate one statistic from a list of GLM outputs along the fourth axis, as `fsl.Merge(dimension='t')` does for dedicated statistic files.
+
+	The inputs may be consolidated GLM statistics files (see `samri.utilities.statistic_image`), or dedicated statistic files.
+	The maps are streamed to the output, so that only one of them is held in memory at any one time.
+
+	Parameters
+	----------
+
+	in_files : list of str
+		Paths to the GLM output files.
+	merged_file : str, optional
+		Path under which to save the merged file.
+	statistic : str, optional
+		Name of the statistic to read from consolidated files.
+	volume : int, optional
+		Volume of the statistic to select, if the statistic has multiple volumes (e.g. one per contrast).
+
+	Returns
+	-------
+
+	str : Path under which the merged file was saved.
+	"""
+
+	import numpy as np
+	from os import path
+	from samri.pipelines.utils import write_nifti_volumes
+	from samri.utilities import statistic_image
+
+	def maps():
+		for in_file in in_files:
+			img = statistic_image(in_file, statistic)
+			if isinstance(volume, int) and len(img.shape) > 3:
+				img = img.slicer[..., volume]
+			yield np.asarray(img.dataobj, dtype=np.float32).reshape(img.shape[:3] + (-1,))
+
+	first = statistic_image(in_files[0], statistic)
+	if isinstance(volume, int) and len(first.shape) > 3:
+		first = first.slicer[..., volume]
+	volumes_per_file = first.shape[3] if len(first.shape) > 3 else 1
+	header = first.header.copy()
+	header.set_data_shape(first.shape[:3] + (volumes_per_file * len(in_files),))
+	header.set_data_dtype(np.float32)
+	header.set_qform(first.affine)
+	header.set_sform(first.affine)
+	merged_file = path.abspath(path.expanduser(merged_file))
+	return write_nifti_volumes(merged_file, header, maps())
+
+def _volume_modes(samples):
+	"""Most frequent value of each column of a 2D array, the smallest one in case of ties (as returned by `scipy.stats.mode`)."""
+
+	import numpy as np
+
+	volumes = samples.shape[1]
+	if np.issubdtype(samples.dtype, np.integer) and samples.size:
+		low = int(samples.min())
+		span = int(samples.max()) - low + 1
+		# Count all volumes in a single pass, as long as the table of counts is no larger than the array of indices it is counted from.
+		if span * volumes <= max(samples.size, 2**16):
+			indices = (samples.astype(np.int64) - low) + np.arange(volumes, dtype=np.int64) * span
+			counts = np.bincount(indices.ravel(), minlength=span * volumes).reshape((volumes, span))
+			return (counts.argmax(axis=1) + low).astype(samples.dtype)
+	modes = []
+	for column in samples.T:
+		values, counts = np.unique(column, return_counts=True)
+		modes.append(values[counts.argmax()])
+	return np.array(modes, dtype=samples.dtype)
 
 def reset_background(in_file,
 	bg_value=0,
 	out_file='background_reset_complete.nii.gz',
 	restriction_range='auto',
+	subsample=1,
+	chunk_size=16,
 	):
 	"""
 	Set the background voxel value of a 4D NIfTI time series to a given value.
@@ -135,27 +241,41 @@ def reset_background(in_file,
 	restriction_range : int or string, optional
 		What restricted range (if any) to use as the bounding box for the image area on which the mode is actually determined.
 		If auto, the mode is determined on a bounding box the size of the smallest spatial axis.
-		If the variable evaluates as false, no restriction will be used and the mode will be calculated given all spatial data --- which can be extremely time-consuming.
+		If the variable evaluates as false, no restriction will be used and the mode will be calculated given all spatial data.
+	subsample : int, optional
+		Step with which to sample voxels along each spatial axis of the bounding box, when determining the mode.
+		Larger values speed up the calculation, at the risk of a less accurate background estimate.
+	chunk_size : int, optional
+		Number of volumes to hold in memory at any one time.
 	"""
 
 	import nibabel as nib
 	import numpy as np
-	from scipy import stats
+	from samri.pipelines.extra_functions import _volume_modes
+	from samri.pipelines.utils import nifti_slope_inter, write_nifti_volumes
 
-	img = nib.load(in_file)
-	data = img.get_data()
-	number_of_slices = np.shape(data)[3]
+	# Keeping the file open lets chunks of compressed files be read sequentially, rather than decompressing from the start for each chunk.
+	img = nib.load(in_file, keep_file_open=True)
+	shape = img.shape
 	if restriction_range == 'auto':
-		restriction_range = min(np.shape(data)[:3])
-	for i in range(number_of_slices):
-		if not restriction_range:
-			old_bg_value = stats.mode(data[:,:,:,i])
-		else:
-			old_bg_value = stats.mode(data[:restriction_range,:restriction_range,:restriction_range,i].flatten())
-		old_bg_value = old_bg_value.mode[0]
-		data[:,:,:,i][data[:,:,:,i]==old_bg_value] = bg_value
-	img_ = nib.Nifti1Image(data, img.affine, img.header)
-	nib.save(img_,out_file)
+		restriction_range = min(shape[:3])
+	if not restriction_range:
+		restriction_range = max(shape[:3])
+	box = (slice(None, restriction_range, subsample),) * 3
+
+	header = img.header.copy()
+	if nifti_slope_inter(img) != (None, None):
+		# The scaled data is floating point, and written as such.
+		header.set_data_dtype(np.float32)
+
+	def volumes():
+		for start in range(0, shape[3], chunk_size):
+			chunk = np.array(img.dataobj[..., start:start + chunk_size])
+			samples = chunk[box].reshape((-1, chunk.shape[3]))
+			chunk[chunk == _volume_modes(samples)] = bg_value
+			yield chunk
+
+	write_nifti_volumes(out_file, header, volumes())
 
 def force_dummy_scans(in_file,
 	desired_dummy_scans=10,
@@ -163,16 +283,21 @@ def force_dummy_scans(in_file,
 	):
 	"""Take a scan and crop initial timepoints depending upon the number of dummy scans (determined from a Bruker scan directory) and the desired number of dummy scans.
 
+	The data is not rewritten unless needed: if no timepoints need to be cropped, the input file is returned, and uncompressed NIfTI inputs are cropped via a header pointing past the cropped timepoints (see `samri.pipelines.utils.nifti_volume_range`).
+
 	in_file : string
 	BIDS-compliant path to the 4D NIfTI file for which to force dummy scans.
 
 	desired_dummy_scans : int , optional
 	Desired timepoints dummy scans.
+
+	out_file : string, optional
+	Path for the cropped file, the extension of which determines whether compressed input is written compressed (uncompressed input is never compressed), and which is changed to `.hdr` if a header-only NIfTI pair is created.
 	"""
 
 	import json
-	import nibabel as nib
 	from os import path
+	from samri.pipelines.utils import nifti_volume_range
 
 	out_file = path.abspath(path.expanduser(out_file))
 	in_file = path.abspath(path.expanduser(in_file))
@@ -191,12 +316,16 @@ def force_dummy_scans(in_file,
 
 	delete_scans = desired_dummy_scans - dummy_scans
 
-	img = nib.load(in_file)
 	if delete_scans <= 0:
-		nib.save(img,out_file)
+		out_file = in_file
 	else:
-		img_ = nib.Nifti1Image(img.get_data()[...,delete_scans:], img.affine, img.header)
-		nib.save(img_,out_file)
+		out_base = out_file
+		for extension in ['.nii.gz', '.nii']:
+			if out_base.endswith(extension):
+				out_base = out_base[:-len(extension)]
+				break
+		compress = out_file.endswith('.gz') and in_file.endswith('.gz')
+		out_file = nifti_volume_range(in_file, out_base, start=delete_scans, compress=compress)
 	deleted_scans = delete_scans
 
 	return out_file, deleted_scans
@@ -244,7 +373,8 @@ def write_bids_metadata_file(scan_dir, extraction_dicts,
 	scan_dir : str
 		Path to the scan directory containing the acquisition protocol files.
 	extraction_dicts : str
-		A list of dictionaries which contain keys including `query_file` (which specifies the file, relative to `scan dir`, which to query), `regex` (which gives a regex expression which will be tested against each rowin the file until a match is found), and `field_name` (which specifies under what field name to record this value in the JSON file).
+		A list of dictionaries which contain keys including `query_file` (which specifies the file, relative to `scan dir`, which to query), `parameter` (which gives the name of the parameter to look up in the parsed file, see `samri.pipelines.utils.read_jcampdx`), and `field_name` (which specifies under what field name to record this value in the JSON file).
+		If `parameter` is missing, `regex` (which gives a regex expression with a `value` group) is instead tested against each row in the raw file until a match is found; if both are given, `regex` is matched against the parameter value.
 		Additionally, the following keys are also supported: `type` (a python class operator, e.g. `str` to which the value should be converted), and `scale` (a float with which the value is multiplied before recording in JSON).
 	out_file : str, optional
 		Path under which to save the resulting JSON.
@@ -256,7 +386,7 @@ def write_bids_metadata_file(scan_dir, extraction_dicts,
 	import json
 	import re
 	from os import path
-	from samri.pipelines.utils import parse_paravision_date
+	from samri.pipelines.utils import parse_paravision_date, read_jcampdx
 
 	out_file = path.abspath(path.expanduser(out_file))
 	scan_dir = path.abspath(path.expanduser(scan_dir))
@@ -264,56 +394,41 @@ def write_bids_metadata_file(scan_dir, extraction_dicts,
 
 	# Extract parameters which are nicely accessible in the Bruker files:
 	for extraction_dict in extraction_dicts:
+		query_file = path.abspath(path.join(scan_dir,extraction_dict['query_file']))
+		try:
+			if 'parameter' in extraction_dict:
+				value = read_jcampdx(query_file)[extraction_dict['parameter']]
+				if 'regex' in extraction_dict:
+					value = re.match(extraction_dict['regex'], str(value)).groupdict()['value']
+			else:
+				matches = (re.match(extraction_dict['regex'], line) for line in read_jcampdx(query_file, lines=True))
+				value = next(m for m in matches if m).groupdict()['value']
+		except (FileNotFoundError, KeyError, AttributeError, StopIteration):
+			continue
+		try:
+			value = extraction_dict['type'](value)
+		except KeyError:
+			pass
 		try:
-			query_file = path.abspath(path.join(scan_dir,extraction_dict['query_file']))
-			with open(query_file) as search:
-				for line in search:
-					if re.match(extraction_dict['regex'], line):
-						m = re.match(extraction_dict['regex'], line)
-						value = m.groupdict()['value']
-						try:
-							value = extraction_dict['type'](value)
-						except KeyError:
-							pass
-						try:
-							value = value * extraction_dict['scale']
-						except KeyError:
-							pass
-						metadata[extraction_dict['field_name']] = value
-						break
-		except FileNotFoundError:
+			value = value * extraction_dict['scale']
+		except KeyError:
 			pass
+		metadata[extraction_dict['field_name']] = value
 
 	# Extract DelayAfterTrigger
 	try:
-		query_file = path.abspath(path.join(scan_dir,'AdjStatePerScan'))
-		read_line = False
-		with open(query_file) as search:
-			for line in search:
-				if '##$AdjScanStateTime=( 2 )' in line:
-					read_line = True
-					continue
-				if read_line:
-					m = re.match(r'^<(?P<value>.*?)> <.*?>$', line)
-					adjustments_start = m.groupdict()['value']
-					adjustments_start = parse_paravision_date(adjustments_start)
-					break
+		adjustments = read_jcampdx(path.join(scan_dir,'AdjStatePerScan'))
 	except IOError:
 		pass
 	else:
-		query_file = path.abspath(path.join(scan_dir,'acqp'))
-		with open(query_file) as search:
-			for line in search:
-				if re.match(r'^##\$ACQ_time=<.*?>$', line):
-					m = re.match(r'^##\$ACQ_time=<(?P<value>.*?)>$', line)
-					adjustments_end = m.groupdict()['value']
-					adjustments_end = parse_paravision_date(adjustments_end)
-					break
+		acquisition = read_jcampdx(path.join(scan_dir,'acqp'))
 		try:
-			adjustments_duration = adjustments_end - adjustments_start
-		except UnboundLocalError:
+			adjustments_start = parse_paravision_date(adjustments['AdjScanStateTime'][0])
+			adjustments_end = parse_paravision_date(acquisition['ACQ_time'])
+		except KeyError:
 			metadata['DelayAfterTrigger'] = 0
 		else:
+			adjustments_duration = adjustments_end - adjustments_start
 			metadata['DelayAfterTrigger'] = adjustments_duration.total_seconds()
 
 	if task:
@@ -377,9 +492,10 @@ def eventfile_add_habituation(in_file,
 	return out_file
 
 def write_bids_physio_file(scan_dir,
-	out_file='physio.tsv',
+	out_file='physio.tsv.gz',
 	forced_dummy_scans=0.,
 	nii_name=False,
+	compress=True,
 	):
 	"""Create a BIDS physiology recording ("physio") file, based on available data files in the scan directory.
 
@@ -390,6 +506,8 @@ def write_bids_physio_file(scan_dir,
 		ParaVision scan directory path, containing one or more files prefixed with "physio_".
 	out_file : str, optional
 		Path to which to write the adjusted physiology file.
+	compress : bool, optional
+		Whether to write a gzip-compressed physiology file (as recommended by BIDS).
 
 	Returns
 	-------
@@ -400,9 +518,11 @@ def write_bids_physio_file(scan_dir,
 		Path to which the collapsed physiology metadata file was saved.
 	"""
 
-	import csv
 	import json
 	import os
+	import re
+	import numpy as np
+	import pandas as pd
 
 	if nii_name:
 		nii_basename, ext = os.path.splitext(nii_name)
@@ -415,6 +535,11 @@ def write_bids_physio_file(scan_dir,
 		out_file = os.path.join(nii_pathname,f'{nii_filename}_physio.tsv')
 
 	out_file = os.path.abspath(os.path.expanduser(out_file))
+	if out_file.endswith('.gz'):
+		out_file = out_file[:-3]
+	physio_metadata_name, _ = os.path.splitext(out_file)
+	if compress:
+		out_file += '.gz'
 	scan_dir = os.path.abspath(os.path.expanduser(scan_dir))
 
 	physio_prefix = 'physio_'
@@ -425,38 +550,26 @@ def write_bids_physio_file(scan_dir,
 	else:
 		return '/dev/null'
 
-	physio_columns = []
-	column_names = []
+	# AFNI-style `count*value` entries, of which we keep the values.
+	value_pattern = re.compile(r'\*(\S+)')
+	physio_columns = {}
 	start_times = []
 	sampling_frequencies = []
 	for physio_file in physio_files:
 		if physio_file.endswith('.1D'):
-			f = open(physio_file, 'r')
-			physio_column = f.read()
-			physio_column = physio_column.split(' ')
-			physio_column = [float(i.split('*')[1]) for i in physio_column if i != '']
-			physio_columns.append(physio_column)
+			with open(physio_file, 'r') as f:
+				physio_column = np.array(value_pattern.findall(f.read()), dtype=float)
 			column_name = os.path.basename(physio_file)
 			column_name, _ = os.path.splitext(column_name)
 			column_name = column_name[len(physio_prefix):]
-			column_names.append(column_name)
+			physio_columns[column_name] = pd.Series(physio_column)
 			start_times.append(60)
 			sampling_frequencies.append(1)
-	column_lengths = [len(i) for i in physio_columns]
+	column_names = list(physio_columns.keys())
 
-	# check if all regressors are of the same length, as this would otherwise break list transposition.
-	if len(set(column_lengths)) != 1:
-		max_len = max(column_lengths)
-		for physio_column in physio_columns:
-			physio_column += ['n/a'] * (max_len - len(physio_column))
-
-	physio_rows = [list(i) for i in zip(*physio_columns)]
-
-	out_file = os.path.abspath(os.path.expanduser(out_file))
-	with open(out_file, 'w') as tsvfile:
-		writer = csv.writer(tsvfile, delimiter='\t', lineterminator='\n')
-		for physio_row in physio_rows:
-			writer.writerow(physio_row)
+	# Columns of different lengths are padded with 'n/a' (as per BIDS), which `pandas` does by aligning the indices.
+	physio_df = pd.DataFrame(physio_columns)
+	physio_df.to_csv(out_file, sep='\t', header=False, index=False, na_rep='n/a', compression='gzip' if compress else None)
 
 	if len(set(start_times)) == 1:
 		start_times = start_times[0]
@@ -468,7 +581,6 @@ def write_bids_physio_file(scan_dir,
 	physio_metadata['Start_Time'] = start_times
 	physio_metadata['Columns'] = column_names
 
-	physio_metadata_name,_ = os.path.splitext(out_file)
 	out_metadata_file = '{}.json'.format(physio_metadata_name)
 	out_metadata_file = os.path.abspath(os.path.expanduser(out_metadata_file))
 	with open(out_metadata_file, 'w') as f:
@@ -593,63 +705,83 @@ def write_bids_events_file(scan_dir,
 def physiofile_ts(in_file, column_name,
 	save=True,
 	):
-	"""Based on a BIDS timecourse path and a physiological regressor name, get the corresponding timecourse."""
+	"""Based on a BIDS timecourse path and a physiological regressor name, get the corresponding timecourse.
+
+	If the physiological recording is longer than the timecourse, it is truncated to the timecourse length.
+	If the timecourse is longer than the recording, the timecourse volumes are truncated to the recording length, via `samri.pipelines.utils.nifti_volume_range`, which avoids copying the data for uncompressed NIfTI files.
+
+	Parameters
+	----------
+
+	in_file : str
+		Path to a BIDS timecourse file, next to which the corresponding physiology file and its metadata file are located.
+	column_name : str
+		Name of the physiology file column to return, as listed under "Columns" in the metadata file.
+	save : bool or str, optional
+		Whether to create a NIfTI file corresponding to the physiological timecourse length in the current working directory, or the path (without extension) under which to create it.
+		If the timecourse does not need to be truncated, the path of the input file is returned.
+		If false, a (lazily truncated) `nibabel` image object is returned instead.
+
+	Returns
+	-------
+
+	nii_file : str or nibabel.Nifti1Image
+		Timecourse with a length matching the returned physiological timecourse.
+	ts : list
+		Physiological timecourse.
+	"""
 
 	from os import path
 	import json
 	import nibabel as nib
+	import pandas as pd
+	from samri.pipelines.extra_functions import corresponding_physiofile
+	from samri.pipelines.utils import nifti_volume_range
 
+	in_file = path.abspath(path.expanduser(in_file))
 	img = nib.load(in_file)
-	nii_dir = path.dirname(in_file)
-	nii_name = path.basename(in_file)
-	stripped_name = nii_name.split('.', 1)[0].rsplit('_', 1)[0]
-	physiofile = path.join(nii_dir,stripped_name+'_physio.tsv')
-	physiofile_meta = path.join(nii_dir,stripped_name+'_physio.json')
+	physiofile, physiofile_meta = corresponding_physiofile(in_file)
 
 	with open(physiofile_meta, 'r') as json_file:
 		metadata = json.load(json_file)
 	columns = metadata['Columns']
-	with open(physiofile, 'r') as f:
-		physios = f.read().split('\n')
-	physios = [i.split('\t') for i in physios if i != '']
-	physios = [list(map(float, sublist)) for sublist in physios]
-	physios = [list(i) for i in zip(*physios)]
 	ts_index = columns.index(column_name)
-	ts = physios[ts_index]
+	ts = pd.read_csv(physiofile, sep='\t', header=None, usecols=[ts_index], na_values='n/a').iloc[:, 0].dropna()
+	ts = ts.tolist()
 
-	duration_img = img.header['dim'][4]
+	duration_img = img.shape[3]
 	duration_physios = len(ts)
 
+	truncate_img = duration_img > duration_physios
 	if duration_physios > duration_img:
 		ts = ts[:duration_img]
-	elif duration_img > duration_physios:
-		data = img.get_data()
-		data = data[:,:,:,:duration_physios]
-		img = nib.Nifti1Image(data, img.affine, img.header)
-
-	if save:
-		nib.save(img, nii_name)
-		nii_file = path.abspath(path.expanduser(nii_name))
-	elif isinstance(save, str):
-		save = path.abspath(path.expanduser(save))
-		nib_save(img, save)
-		nii_file = save
+
+	if not save:
+		nii_file = img.slicer[..., :duration_physios] if truncate_img else img
+	elif not truncate_img:
+		nii_file = in_file
 	else:
-		nii_file = img
+		if isinstance(save, str):
+			out_base = path.abspath(path.expanduser(save))
+		else:
+			out_base = path.abspath(path.basename(in_file).split('.', 1)[0])
+		nii_file = nifti_volume_range(in_file, out_base, stop=duration_physios)
 
 	return nii_file, ts
 
 def corresponding_physiofile(nii_path):
-	"""Based on a BIDS timecourse path, get the corresponding BIDS physiology file."""
+	"""Based on a BIDS timecourse path, get the corresponding BIDS physiology file (gzip-compressed or not)."""
 
 	from os import path
 
 	nii_dir = path.dirname(nii_path)
 	nii_name = path.basename(nii_path)
 	stripped_name = nii_name.split('.', 1)[0].rsplit('_', 1)[0]
-	physiofile = path.join(nii_dir,stripped_name+'_physio.tsv')
+	physiofile = path.join(nii_dir,stripped_name+'_physio.tsv.gz')
 	meta_physiofile = path.join(nii_dir,stripped_name+'_physio.json')
 
+	if not path.isfile(physiofile):
+		physiofile = physiofile[:-3]
 	if not path.isfile(physiofile):
 		physiofile = ''
 	if not path.isfile(meta_physiofile):
@@ -832,6 +964,130 @@ def match_exclude_ss(entry, match, exclude, record, key):
 	else:
 		return False
 
+def _bruker_measurement_signature(measurement_path):
+	"""Modification times identifying the state of a Bruker measurement directory."""
+	signature = []
+	for i in ['', 'subject', 'ScanProgram.scanProgram']:
+		try:
+			signature.append(os.stat(os.path.join(measurement_path, i)).st_mtime_ns)
+		except OSError:
+			signature.append(None)
+	return signature
+
+def _bruker_scan_signature(scan_path):
+	"""Relative paths, sizes, and modification times of all files in a Bruker scan directory."""
+	signature = []
+	for root, dirs, files in os.walk(scan_path):
+		dirs.sort()
+		for i in sorted(files):
+			file_path = os.path.join(root, i)
+			try:
+				stat = os.stat(file_path)
+			except OSError:
+				continue
+			signature.append([os.path.relpath(file_path, scan_path), stat.st_size, stat.st_mtime_ns])
+	return signature
+
+def _bruker_measurement_acqp_scans(measurement_path):
+	"""List candidate scan names for each scan directory of a Bruker measurement, based on the `acqp` files."""
+	acqp_scans = []
+	for sub_sub_dir in sorted(os.listdir(measurement_path), key=lambda x: (0, int(x)) if x.isdigit() else (1, x)):
+		acqp_file_path = os.path.join(measurement_path,sub_sub_dir,"acqp")
+		try:
+			acqp = read_jcampdx(acqp_file_path)
+			number = str(int(sub_sub_dir))
+		except (IOError, ValueError):
+			continue
+		# String parameters (e.g. `ACQ_scan_name` and `ACQ_protocol_name`) which look like BIDS name fragments, in file order.
+		candidates = [i for i in acqp.values() if isinstance(i, str) and re.match(r'^[a-zA-Z0-9-_]+?-[a-zA-Z0-9-_]+?$', i)]
+		if candidates:
+			acqp_scans.append([number, candidates])
+	return acqp_scans
+
+def _bruker_measurement(measurement_path):
+	"""Read the subject, session, position, and scan names of a Bruker measurement directory.
+
+	Returns
+	-------
+
+	dict or None : Measurement description, or None if the directory does not contain a complete `subject` file.
+	"""
+	try:
+		subject = read_jcampdx(os.path.join(measurement_path,"subject"))
+	except IOError:
+		print('Could not open {}'.format(os.path.join(measurement_path,"subject")))
+		return None
+	try:
+		position = re.match(r'^SUBJ_POS_(?P<position>.+?)$', subject['SUBJECT_position']).groupdict()['position']
+		measurement = {
+			'subject':subject['SUBJECT_id'],
+			'session':subject['SUBJECT_study_name'],
+			'position':position,
+			'program_scans':[],
+			# Only determined when needed, as this requires reading all acqp files.
+			'acqp_scans':None,
+			}
+	except (KeyError, TypeError, AttributeError):
+		return None
+	try:
+		with open(os.path.join(measurement_path,"ScanProgram.scanProgram")) as search:
+			for line in search:
+				if re.match(r'^[ \t]+<displayName>[a-zA-Z0-9-_]+? \(E\d+\)</displayName>[\r\n]+', line):
+					m = re.match(r'^[ \t]+<displayName>(?P<scan_type>.+?) \(E(?P<number>\d+)\)</displayName>[\r\n]+', line)
+					measurement['program_scans'].append([m.groupdict()['scan_type'], str(int(m.groupdict()['number']))])
+	except IOError:
+		pass
+	return measurement
+
+def _select_bruker_scans(measurement_path, measurement, match, exclude, fail_suffix):
+	"""Select the scans of a Bruker measurement matching the selection criteria."""
+
+	selected_measurement = {}
+	if not match_exclude_ss(measurement['subject'], match, exclude, selected_measurement, 'subject'):
+		return []
+	if not match_exclude_ss(measurement['session'], match, exclude, selected_measurement, 'session'):
+		return []
+	selected_measurement['PV_position'] = measurement['position']
+	selected_measurement['measurement'] = measurement_path
+
+	def considered(scan_type):
+		if fail_suffix and scan_type.endswith(fail_suffix):
+			return False
+		bids_keys = parse_bids_entities(scan_type)
+		for key in match:
+			# Session and subject fields are not recorded in scan_type and were already checked at this point.
+			if key in ['session', 'subject']:
+				continue
+			if key not in bids_keys or bids_keys[key] not in match[key]:
+				return False
+		return bids_keys
+
+	selected_scans = []
+	for scan_type, number in measurement['program_scans']:
+		bids_keys = considered(scan_type)
+		if bids_keys is not False:
+			selected_scans.append((scan_type, number, bids_keys))
+	if not selected_scans:
+		if measurement['acqp_scans'] is None:
+			measurement['acqp_scans'] = _bruker_measurement_acqp_scans(measurement_path)
+		for number, candidates in measurement['acqp_scans']:
+			for scan_type in candidates:
+				bids_keys = considered(scan_type)
+				if bids_keys is not False:
+					selected_scans.append((scan_type, number, bids_keys))
+					break
+
+	selected_measurements = []
+	for run_counter, (scan_type, number, bids_keys) in enumerate(selected_scans):
+		measurement_copy = dict(selected_measurement)
+		measurement_copy['scan_type'] = str(scan_type).strip(' ')
+		measurement_copy['scan'] = number
+		measurement_copy['run'] = run_counter
+		scan_type, measurement_copy = assign_modality(scan_type, measurement_copy)
+		measurement_copy.update(bids_keys)
+		selected_measurements.append(measurement_copy)
+	return selected_measurements
+
 def get_data_selection(workflow_base,
 	match={},
 	exclude={},
@@ -839,6 +1095,8 @@ def get_data_selection(workflow_base,
 	exclude_measurements=[],
 	count_runs=False,
 	fail_suffix='_failed',
+	manifest_file='',
+	n_jobs=8,
 	):
 	"""
 	Return a `pandas.DataFrame` object of the Bruker measurement directories located under a given base directory, and their respective scans, subjects, and tasks.
@@ -858,146 +1116,59 @@ def get_data_selection(workflow_base,
 		If the list is empty, all directories (unless explicitly excluded via `exclude_measurements`) will be queried.
 	exclude_measurements : list of str, optional
 		A list of measurement directory names to be excluded from querying (i.e. a blacklist).
+	manifest_file : str, optional
+		Path to a JSON file in which to persistently record the scans found in each measurement directory.
+		Measurement directories which have not been modified since they were recorded in the manifest are not parsed again.
+		If this evaluates to false, no manifest is used.
+	n_jobs : int, optional
+		Number of measurement directories to parse in parallel.
 
 	Notes
 	-----
 	This data selector function is robust to `ScanProgram.scanProgram` files which have been truncated before the first detected match, but not to files truncated after at least one match.
 	"""
 
+	from joblib import Parallel, delayed
+
 	workflow_base = os.path.abspath(os.path.expanduser(workflow_base))
 
 	if not measurements:
 		measurements = os.listdir(workflow_base)
 	measurement_path_list = [os.path.join(workflow_base,i) for i in measurements]
+	measurement_path_list = [i for i in measurement_path_list if i not in exclude_measurements]
+
+	manifest = {}
+	if manifest_file:
+		manifest_file = os.path.abspath(os.path.expanduser(manifest_file))
+		try:
+			with open(manifest_file) as f:
+				manifest = json.load(f)
+		except (IOError, ValueError):
+			manifest = {}
+
+	signatures = [_bruker_measurement_signature(i) for i in measurement_path_list]
+	outdated = [i for i, signature in zip(measurement_path_list, signatures) if manifest.get(i, {}).get('signature') != signature]
+	parsed = Parallel(n_jobs=n_jobs, verbose=0, backend="threading")(map(delayed(_bruker_measurement), outdated))
+	for measurement_path, measurement in zip(outdated, parsed):
+		manifest[measurement_path] = {'signature':None, 'measurement':measurement}
+	for measurement_path, signature in zip(measurement_path_list, signatures):
+		manifest[measurement_path]['signature'] = signature
+
+	selected_measurements = []
+	for measurement_path in measurement_path_list:
+		measurement = manifest[measurement_path]['measurement']
+		if measurement:
+			selected_measurements.extend(_select_bruker_scans(measurement_path, measurement, match, exclude, fail_suffix))
+
+	if manifest_file:
+		manifest_dir = os.path.dirname(manifest_file)
+		if not os.path.exists(manifest_dir):
+			os.makedirs(manifest_dir)
+		with open(manifest_file+'.tmp', 'w') as f:
+			json.dump(manifest, f, indent=1)
+		os.replace(manifest_file+'.tmp', manifest_file)
 
-	selected_measurements=[]
-	# Create a dummy path for bidsgrabber to parse file names from.
-	# Ideally we could avoid this: https://github.com/bids-standard/pybids/issues/633
-	bids_temppath = '/var/tmp/samri_bids_temppaths/'
-	try:
-		os.mkdir(bids_temppath)
-	except FileExistsError:
-		pass
-	data = {}
-	data['Name'] = ''
-	data['BIDSVersion'] = ''
-	with open(os.path.join(bids_temppath,'dataset_description.json'), 'w') as outfile:
-		json.dump(data, outfile)
-	layout = BIDSLayout(bids_temppath)
-	#populate a list of lists with acceptable subject names, sessions, and sub_dir's
-	for sub_dir in measurement_path_list:
-		if sub_dir not in exclude_measurements:
-			run_counter = 0
-			selected_measurement = {}
-			try:
-				state_file = open(os.path.join(workflow_base,sub_dir,"subject"), "r")
-				read_variables=0 #count variables so that breaking takes place after both have been read
-				while True:
-					current_line = state_file.readline()
-					if "##$SUBJECT_id=" in current_line:
-						entry=re.sub("[<>\n]", "", state_file.readline())
-						if not match_exclude_ss(entry, match, exclude, selected_measurement, 'subject'):
-							break
-						read_variables +=1 #count recorded variables
-					if "##$SUBJECT_study_name=" in current_line:
-						entry=re.sub("[<>\n]", "", state_file.readline())
-						if not match_exclude_ss(entry, match, exclude, selected_measurement, 'session'):
-							break
-						read_variables +=1 #count recorded variables
-					if "##$SUBJECT_position=SUBJ_POS_" in current_line:
-						m = re.match(r'^##\$SUBJECT_position=SUBJ_POS_(?P<position>.+?)$', current_line)
-						position = m.groupdict()['position']
-						read_variables +=1 #count recorded variables
-						selected_measurement['PV_position'] = position
-					if read_variables == 3:
-						selected_measurement['measurement'] = sub_dir
-						scan_program_file = os.path.join(workflow_base,sub_dir,"ScanProgram.scanProgram")
-						scan_dir_resolved = False
-						try:
-							with open(scan_program_file) as search:
-								for line in search:
-									line_considered = True
-									measurement_copy = deepcopy(selected_measurement)
-									if re.match(r'^[ \t]+<displayName>[a-zA-Z0-9-_]+? \(E\d+\)</displayName>[\r\n]+', line):
-										if fail_suffix and re.match(r'^.+?{} \(E\d+\)</displayName>[\r\n]+'.format(fail_suffix), line):
-											continue
-										m = re.match(r'^[ \t]+<displayName>(?P<scan_type>.+?) \(E(?P<number>\d+)\)</displayName>[\r\n]+', line)
-										number = m.groupdict()['number']
-										scan_type = m.groupdict()['scan_type']
-										bids_keys = layout.parse_file_entities('{}/{}'.format(bids_temppath,scan_type))
-										for key in match:
-											# Session and subject fields are not recorded in scan_type and were already checked at this point.
-											if key in ['session', 'subject']:
-												continue
-											try:
-												if bids_keys[key] not in match[key]:
-													line_considered = False
-													break
-											except KeyError:
-												line_considered = False
-												break
-										if line_considered:
-											measurement_copy['scan_type'] = str(scan_type).strip(' ')
-											measurement_copy['scan'] = str(int(number))
-											measurement_copy['run'] = run_counter
-											scan_type, measurement_copy = assign_modality(scan_type, measurement_copy)
-											measurement_copy.update(bids_keys)
-											run_counter += 1
-											selected_measurements.append(measurement_copy)
-											scan_dir_resolved = True
-							if not scan_dir_resolved:
-								raise IOError()
-						except IOError:
-							for sub_sub_dir in os.listdir(os.path.join(workflow_base,sub_dir)):
-								measurement_copy = deepcopy(selected_measurement)
-								acqp_file_path = os.path.join(workflow_base,sub_dir,sub_sub_dir,"acqp")
-								scan_subdir_resolved = False
-								try:
-									with open(acqp_file_path,'r') as search:
-										for line in search:
-											line_considered = True
-											if scan_subdir_resolved:
-												break
-											if re.match(r'^(?!/)<[a-zA-Z0-9-_]+?-[a-zA-Z0-9-_]+?>[\r\n]+', line):
-												if fail_suffix and re.match(r'^.+?{}$'.format(fail_suffix), line):
-													continue
-												number = sub_sub_dir
-												m = re.match(r'^(?!/)<(?P<scan_type>.+?)>[\r\n]+', line)
-												scan_type = m.groupdict()['scan_type']
-												bids_keys = layout.parse_file_entities('{}/{}'.format(bids_temppath,scan_type))
-												for key in match:
-													# Session and subject fields are not recorded in scan_type and were already checked at this point.
-													if key in ['session', 'subject']:
-														continue
-													try:
-														if bids_keys[key] not in match[key]:
-															line_considered = False
-															break
-													except KeyError:
-														line_considered = False
-														break
-												if line_considered:
-													measurement_copy['scan_type'] = str(scan_type).strip(' ')
-													measurement_copy['scan'] = str(int(number))
-													measurement_copy['run'] = run_counter
-													scan_type, measurement_copy= assign_modality(scan_type, measurement_copy)
-													measurement_copy.update(bids_keys)
-													run_counter += 1
-													selected_measurements.append(measurement_copy)
-													scan_subdir_resolved = True
-										else:
-											pass
-								except IOError:
-									pass
-						break #prevent loop from going on forever
-			except IOError:
-				print('Could not open {}'.format(os.path.join(workflow_base,sub_dir,"subject")))
-				pass
 	data_selection = pd.DataFrame(selected_measurements)
-	try:
-		shutil.rmtree(bids_temppath)
-	except (FileNotFoundError, PermissionError):
-		pass
 	return data_selection
 
 def select_from_datafind_df(df,
@@ -1101,8 +1272,44 @@ def regressor(timecourse,
 	output = [my_dict]
 	return output
 
+def compress_nifti(in_file, out_file,
+	compresslevel=6,
+	):
+	"""Write a NIfTI file to a given path, gzip-compressing it on the fly if `out_file` ends in `.gz` and `in_file` does not.
+
+	The compression operates on the raw byte stream, so the image data is never decoded.
+	This is used to deliver final outputs in compressed form, when intermediate files are kept uncompressed.
+
+	Parameters
+	----------
+
+	in_file : str
+		Path to a `.nii` or `.nii.gz` file.
+	out_file : str
+		Path to which to write the file.
+		If this does not end in a NIfTI extension (as is the case for the file names generated by `get_bids_scan` for Bruker scans), `.nii.gz` is appended.
+	compresslevel : int, optional
+		Gzip compression level, from 1 (fastest) to 9 (smallest).
+	"""
+
+	import gzip
+	import shutil
+	from os import path
+
+	in_file = path.abspath(path.expanduser(in_file))
+	out_file = path.abspath(path.expanduser(out_file))
+	if not out_file.endswith(('.nii', '.nii.gz')):
+		out_file = '{}.nii.gz'.format(out_file)
+	if in_file.endswith('.gz') or not out_file.endswith('.gz'):
+		shutil.copyfile(in_file, out_file)
+	else:
+		with open(in_file, 'rb') as f_in, gzip.open(out_file, 'wb', compresslevel=compresslevel) as f_out:
+			shutil.copyfileobj(f_in, f_out, 2**20)
+	return out_file
+
 def flip_if_needed(data_selection, nii_path, ind,
 	output_filename='flipped.nii.gz',
+	compresslevel=6,
 	):
 	"""Check based on a SAMRI data selection of Bruker Paravision scans, if the orientation is incorrect (“Prone”, terminologically correct, but corresponding to an incorrect “Supine” representation in Bruker ParaVision small animal scans), and flip the scan with respect to the axial axis if so.
 
@@ -1117,6 +1324,8 @@ def flip_if_needed(data_selection, nii_path, ind,
 		Index of the `data_selection` entry.
 	output_filename : str, optional
 		String specifying the desired flipped NIfTI filename for potential flipped output.
+	compresslevel : int, optional
+		Gzip compression level, from 1 (fastest) to 9 (smallest), used if the output is compressed.
 	"""
 
 	from os import path
@@ -1128,7 +1337,11 @@ def flip_if_needed(data_selection, nii_path, ind,
 	if output_filename[-7:] != '.nii.gz' and output_filename[-4:] != '.nii':
 		output_filename = '{}.nii.gz'.format(output_filename)
 	if position == 'Prone':
-		output_filename = flip_axis(nii_path, axis=2, out_path=output_filename)
+		output_filename = flip_axis(nii_path, axis=2, out_path=output_filename, compresslevel=compresslevel)
+	elif nii_path.endswith('.nii') and output_filename.endswith('.nii.gz'):
+		# Uncompressed intermediate, deliver compressed.
+		from samri.pipelines.extra_functions import compress_nifti
+		output_filename = compress_nifti(nii_path, output_filename, compresslevel=compresslevel)
 	else:
 		output_filename = nii_path
 	return output_filename
@@ -1,6 +1,9 @@
 from nipype.interfaces.base import BaseInterface, BaseInterfaceInputSpec, traits, File, Str, TraitedSpec, Directory, CommandLineInputSpec, CommandLine, InputMultiPath, isdefined, Bunch, OutputMultiPath
 from nipype.interfaces.ants.base import ANTSCommand, ANTSCommandInputSpec
+from nipype.interfaces.ants.registration import Registration, RegistrationInputSpec
 from nipype.interfaces.fsl.base import FSLCommandInputSpec, FSLCommand
+from nipype.interfaces.fsl.model import FLAMEOOutputSpec, GLMOutputSpec, Level1DesignInputSpec, FEATModelOutpuSpec, RandomiseOutputSpec
+from nipype.interfaces.io import DataSink, DataSinkInputSpec
 from nibabel import load
 
 import csv
@@ -29,9 +32,63 @@ def scale_timings(timelist, input_units, output_units, time_repetition):
 
 	if (input_units == 'secs') and (output_units == 'scans'):
 		_scalefactor = 1. / time_repetition
-	timelist = [np.max([0., _scalefactor * t]) for t in timelist]
+	timelist = np.maximum(0., _scalefactor * np.asarray(timelist, dtype=np.float64)).tolist()
 	return timelist
 
+# Parsed event files, keyed by the SHA-1 digest of their content, so that files shared between scans (or identical copies thereof) are parsed only once per process.
+# The cache is not shared between processes: under the nipype MultiProc plugin, each worker process parses (and holds) its own copy of every file it reads.
+_EVENT_FILE_CACHE = {}
+
+def _cached_event_file(file_path, parser):
+	import hashlib
+
+	with open(file_path, 'rb') as f:
+		content = f.read()
+	key = (parser.__name__, hashlib.sha1(content).hexdigest())
+	try:
+		return _EVENT_FILE_CACHE[key]
+	except KeyError:
+		parsed = _EVENT_FILE_CACHE[key] = parser(content)
+		return parsed
+
+def _bids_event_columns(content):
+	"""Parse the content of a BIDS events file into a dictionary of column names and arrays of string values."""
+	import io
+
+	rows = list(csv.reader(io.StringIO(content.decode('utf-8')), skipinitialspace=True, delimiter='\t'))
+	header, rows = rows[0], [row for row in rows[1:] if row]
+	# Rows with fewer fields than the header (e.g. omitting trailing optional columns) are padded with empty values, and surplus fields are dropped.
+	values = np.array([(row + [''] * len(header))[:len(header)] for row in rows], dtype=str).reshape(len(rows), len(header))
+	return {column: values[:, ix] for ix, column in enumerate(header)}
+
+def _fsl_event_matrix(content):
+	"""Parse the content of an FSL 1, 2 or 3 column event file into a 2D array."""
+	import io
+
+	return np.atleast_2d(np.loadtxt(io.BytesIO(content)))
+
+def read_bids_events(bids_event_file):
+	"""Read the columns of a BIDS events file, parsing each distinct file content only once per process.
+
+	Parameters
+	----------
+
+	bids_event_file : str
+		Path to a BIDS .tsv events file.
+
+	Returns
+	-------
+
+	dict : Dictionary with the column names as keys and arrays of the (string) column values as values.
+		The arrays are shared between calls for files with the same content, and should not be modified.
+
+	Notes
+	-----
+
+	The parsed files are cached per process, so that workflows run with the MultiProc plugin parse each file once in every worker process which reads it, rather than once per workflow.
+	"""
+	return _cached_event_file(bids_event_file, _bids_event_columns)
+
 def bids_gen_info(bids_event_files,
 				  condition_column='trial_type',
 				  amplitude_column=None,
@@ -39,6 +96,8 @@ def bids_gen_info(bids_event_files,
 				  ):
 	"""Generate subject_info structure from a list of BIDS .tsv event files.
 
+	Each distinct events file is parsed only once (see `read_bids_events`), and the events of all conditions are grouped in a single vectorized pass.
+
 	Parameters
 	----------
 
@@ -48,7 +107,7 @@ def bids_gen_info(bids_event_files,
 	condition_column : str
 		Column of files in `bids_event_files` based on the values of which
 		events will be sorted into different regressors. If empty, all events
-		are modelled in the same regressor, named 'e0'.
+		are modelled in the same regressor, named 'ev0'.
 	amplitude_column : str
 		Column of files in `bids_event_files` based on the values of which
 		to apply amplitudes to events. If unspecified, all events will be
@@ -61,32 +120,32 @@ def bids_gen_info(bids_event_files,
 	"""
 	info = []
 	for bids_event_file in bids_event_files:
-		with open(bids_event_file) as f:
-			f_events = csv.DictReader(f, skipinitialspace=True, delimiter='\t')
-			events = [{k: v for k, v in row.items()} for row in f_events]
-		if not condition_column:
-			condition_column = '_trial_type'
-			for i in events:
-				i.update({condition_column:'ev0'})
-		conditions = list(set([i[condition_column] for i in events]))
-		conditions = sorted(conditions)
-		runinfo = Bunch(conditions=[], onsets=[], durations=[], amplitudes=[])
-		for condition in conditions:
-			selected_events = [i for i in events if i[condition_column]==condition]
-			onsets = [float(i['onset']) for i in selected_events]
-			durations = [float(i['duration']) for i in selected_events]
-			if time_repetition:
-				decimals = math.ceil(-math.log10(time_repetition))
-				onsets = [np.round(i, decimals) for i in onsets]
-				durations = [np.round(i ,decimals) for i in durations]
-			runinfo.conditions.append(condition)
-			runinfo.onsets.append(onsets)
-			runinfo.durations.append(durations)
-			try:
-				amplitudes = [float(i[amplitude_column]) for i in selected_events]
-				runinfo.amplitudes.append(amplitudes)
-			except KeyError:
-				runinfo.amplitudes.append([1] * len(onsets))
+		events = read_bids_events(bids_event_file)
+		onsets = events['onset'].astype(np.float64)
+		durations = events['duration'].astype(np.float64)
+		if condition_column:
+			conditions, condition_indices = np.unique(events[condition_column], return_inverse=True)
+		else:
+			conditions, condition_indices = np.array(['ev0']), np.zeros(len(onsets), dtype=int)
+		if time_repetition:
+			decimals = math.ceil(-math.log10(time_repetition))
+			onsets = np.round(onsets, decimals)
+			durations = np.round(durations, decimals)
+		if amplitude_column in events:
+			amplitudes = events[amplitude_column].astype(np.float64)
+		else:
+			amplitudes = np.ones(len(onsets), dtype=int)
+		# Group the events by condition, preserving their order within each condition.
+		order = np.argsort(condition_indices, kind='stable')
+		splits = np.cumsum(np.bincount(condition_indices, minlength=len(conditions)))[:-1]
+		def by_condition(values):
+			return [i.tolist() for i in np.split(values[order], splits)][:len(conditions)]
+		runinfo = Bunch(
+			conditions=conditions.tolist(),
+			onsets=by_condition(onsets),
+			durations=by_condition(durations),
+			amplitudes=by_condition(amplitudes),
+			)
 		info.append(runinfo)
 	return info
 
@@ -105,7 +164,7 @@ def gen_info(run_event_files):
 				name, _ = name.split('.txt')
 
 			runinfo.conditions.append(name)
-			event_info = np.atleast_2d(np.loadtxt(event_file))
+			event_info = _cached_event_file(event_file, _fsl_event_matrix)
 			runinfo.onsets.append(event_info[:, 0].tolist())
 			if event_info.shape[1] > 1:
 				runinfo.durations.append(event_info[:, 1].tolist())
@@ -119,7 +178,6 @@ def gen_info(run_event_files):
 		info.append(runinfo)
 	return info
 
-
 class SpecifyModelInputSpec(BaseInterfaceInputSpec):
 	subject_info = InputMultiPath(
 		Bunch,
@@ -476,6 +534,423 @@ class VoxelResize(BaseInterface):
 		outputs['out_file'] = self.result
 		return outputs
 
+class TemporalMeanInputSpec(BaseInterfaceInputSpec):
+	in_file = File(exists=True, mandatory=True,
+		desc="4D NIfTI time series",
+		)
+	out_file = traits.Str(
+		default_value="mean.nii.gz",
+		usedefault=True,
+		desc="image written after calculations",
+		)
+	std_file = traits.Str(
+		desc="Path under which to additionally write the temporal standard deviation image",
+		)
+	tsnr_file = traits.Str(
+		desc="Path under which to additionally write the temporal signal-to-noise ratio image",
+		)
+	chunk_size = traits.Int(16,
+		usedefault=True,
+		desc="Number of volumes to hold in memory at any one time",
+		)
+
+class TemporalMeanOutputSpec(TraitedSpec):
+	out_file = File(exists=True)
+	std_file = File()
+	tsnr_file = File()
+
+class TemporalMean(BaseInterface):
+	"""Compute the temporal mean (and optionally the standard deviation and tSNR) of a 4D NIfTI file in-process.
+
+	Volumes are read in chunks of `chunk_size` via the image data proxy, so that only one chunk is resident in memory at any one time, and the 3D results are written directly.
+	This is a drop-in replacement for `nipype.interfaces.fsl.MeanImage` (with the default `dimension='T'`), saving a subprocess call and a full read/write cycle of the 4D file.
+	"""
+	input_spec = TemporalMeanInputSpec
+	output_spec = TemporalMeanOutputSpec
+
+	def _run_interface(self, runtime):
+		import nibabel as nib
+
+		# Keeping the file open lets chunks of compressed files be read sequentially, rather than decompressing from the start for each chunk.
+		img = nib.load(self.inputs.in_file, keep_file_open=True)
+		shape = img.shape
+		if len(shape) < 4:
+			shape = shape + (1,)
+		volumes = shape[3]
+		chunk_size = max(self.inputs.chunk_size, 1)
+
+		sums = np.zeros(shape[:3], dtype=np.float64)
+		squares = np.zeros(shape[:3], dtype=np.float64)
+		for start in range(0, volumes, chunk_size):
+			stop = min(start + chunk_size, volumes)
+			if len(img.shape) < 4:
+				chunk = np.asarray(img.dataobj, dtype=np.float64)[..., np.newaxis]
+			else:
+				chunk = np.asarray(img.dataobj[..., start:stop], dtype=np.float64)
+			sums += chunk.sum(axis=3)
+			squares += (chunk**2).sum(axis=3)
+		mean = sums / volumes
+
+		header = img.header.copy()
+		header.set_data_dtype(np.float32)
+
+		self.result = os.path.abspath(self.inputs.out_file)
+		self._write(mean, img, header, self.result)
+
+		self.std_result = None
+		self.tsnr_result = None
+		if isdefined(self.inputs.std_file) or isdefined(self.inputs.tsnr_file):
+			variance = squares / volumes - mean**2
+			std = np.sqrt(np.clip(variance, 0, None))
+			if isdefined(self.inputs.std_file):
+				self.std_result = os.path.abspath(self.inputs.std_file)
+				self._write(std, img, header, self.std_result)
+			if isdefined(self.inputs.tsnr_file):
+				tsnr = np.zeros_like(mean)
+				np.divide(mean, std, out=tsnr, where=std > 0)
+				self.tsnr_result = os.path.abspath(self.inputs.tsnr_file)
+				self._write(tsnr, img, header, self.tsnr_result)
+
+		return runtime
+
+	def _write(self, data, img, header, out_file):
+		import nibabel as nib
+		out_img = nib.Nifti1Image(data.astype(np.float32), img.affine, header)
+		nib.save(out_img, out_file)
+
+	def _list_outputs(self):
+		outputs = self._outputs().get()
+		outputs['out_file'] = self.result
+		if self.std_result:
+			outputs['std_file'] = self.std_result
+		if self.tsnr_result:
+			outputs['tsnr_file'] = self.tsnr_result
+		return outputs
+
+class TemporalBandpassInputSpec(BaseInterfaceInputSpec):
+	in_file = File(exists=True, mandatory=True,
+		desc="4D NIfTI time series",
+		)
+	out_file = traits.Str(
+		default_value="bandpassed.nii.gz",
+		usedefault=True,
+		desc="image written after calculations",
+		)
+	highpass_sigma = traits.Float(-1,
+		usedefault=True,
+		desc="Highpass filter sigma, in volumes (nonpositive values disable the highpass filter)",
+		)
+	lowpass_sigma = traits.Float(-1,
+		usedefault=True,
+		desc="Lowpass filter sigma, in volumes (nonpositive values disable the lowpass filter)",
+		)
+	max_memory_gb = traits.Float(1.,
+		usedefault=True,
+		nohash=True,
+		desc="Approximate upper bound on the memory used for the filtering, based on which the number of voxels held in memory at any one time is chosen",
+		)
+
+class TemporalBandpassOutputSpec(TraitedSpec):
+	out_file = File(exists=True)
+
+class TemporalBandpass(BaseInterface):
+	"""Temporally filter a 4D NIfTI file in-process, with the semantics of `fslmaths -bptf`.
+
+	This is a drop-in replacement for `nipype.interfaces.fsl.maths.TemporalFilter`, which holds the entire time series in memory.
+	Here, the data is filtered in slabs of voxels small enough to keep memory usage within `max_memory_gb` (see `samri.pipelines.utils.temporal_bandpass`), so that the node memory estimate can be set to the same value.
+	Note that the output is always written as float32.
+	"""
+	input_spec = TemporalBandpassInputSpec
+	output_spec = TemporalBandpassOutputSpec
+
+	def _run_interface(self, runtime):
+		from samri.pipelines.utils import temporal_bandpass
+
+		self.result = temporal_bandpass(self.inputs.in_file, self.inputs.out_file,
+			highpass_sigma=self.inputs.highpass_sigma,
+			lowpass_sigma=self.inputs.lowpass_sigma,
+			max_memory_gb=self.inputs.max_memory_gb,
+			)
+		return runtime
+
+	def _list_outputs(self):
+		outputs = self._outputs().get()
+		outputs['out_file'] = os.path.abspath(self.inputs.out_file)
+		return outputs
+
+class ChunkedApplyTransformsInputSpec(BaseInterfaceInputSpec):
+	input_image = File(exists=True, mandatory=True,
+		desc="4D time series to be resampled into the reference space",
+		)
+	reference_image = File(exists=True, mandatory=True,
+		desc="Image defining the output grid",
+		)
+	transforms = InputMultiPath(File(exists=True),
+		xor=['displacement_field'],
+		desc="ANTs transform files, in the order accepted by `antsApplyTransforms`",
+		)
+	invert_transform_flags = InputMultiPath(traits.Bool(),
+		desc="Whether to invert each of the transforms",
+		)
+	displacement_field = File(exists=True,
+		xor=['transforms'],
+		desc="Precomputed ITK displacement field (on the reference grid) mapping reference to input points",
+		)
+	interpolation = traits.Enum('Linear', 'NearestNeighbor', 'BSpline',
+		usedefault=True,
+		)
+	interpolation_parameters = traits.Tuple(traits.Int(),
+		desc="B-spline order (only considered for 'BSpline' interpolation, defaults to 3)",
+		)
+	output_image = traits.Str(
+		default_value="warped.nii.gz",
+		usedefault=True,
+		desc="image written after calculations",
+		)
+	chunk_size = traits.Int(16,
+		usedefault=True,
+		desc="Number of volumes to hold in memory at any one time",
+		)
+	max_memory_gb = traits.Float(
+		nohash=True,
+		desc="Approximate upper bound on the memory used for the resampling, based on which the number of volumes held in memory at any one time is chosen (overriding `chunk_size`)",
+		)
+	num_threads = traits.Int(1,
+		usedefault=True,
+		nohash=True,
+		desc="Number of threads across which to resample the volumes of a chunk",
+		)
+
+class ChunkedApplyTransformsOutputSpec(TraitedSpec):
+	output_image = File(exists=True)
+
+class ChunkedApplyTransforms(BaseInterface):
+	"""Apply a chain of ANTs transforms to a 4D time series in-process.
+
+	The transform chain is composed once into a dense displacement field on the reference grid (this is the only step delegated to `antsApplyTransforms`, and it operates on a single 3D image).
+	The time series is then resampled with `scipy.ndimage.map_coordinates` in chunks of `chunk_size` volumes, spread over `num_threads` threads, and streamed to disk, so that memory usage is bounded by the chunk size rather than by the length of the series.
+	Alternatively, the chunk size can be chosen to keep memory usage within `max_memory_gb`, so that the node memory estimate can be set to the same value.
+	This is a replacement for `nipype.interfaces.ants.ApplyTransforms` with `input_image_type=3`.
+	"""
+	input_spec = ChunkedApplyTransformsInputSpec
+	output_spec = ChunkedApplyTransformsOutputSpec
+
+	def _displacement_field(self):
+		from nipype.interfaces import ants
+
+		if isdefined(self.inputs.displacement_field):
+			return self.inputs.displacement_field
+		composite = ants.ApplyTransforms()
+		composite.inputs.dimension = 3
+		composite.inputs.input_image = self.inputs.reference_image
+		composite.inputs.reference_image = self.inputs.reference_image
+		composite.inputs.transforms = self.inputs.transforms
+		if isdefined(self.inputs.invert_transform_flags):
+			composite.inputs.invert_transform_flags = self.inputs.invert_transform_flags
+		composite.inputs.print_out_composite_warp_file = True
+		composite.inputs.output_image = os.path.abspath('composite_displacement_field.nii.gz')
+		composite_res = composite.run()
+		return composite_res.outputs.output_image
+
+	def _run_interface(self, runtime):
+		import nibabel as nib
+		from joblib import Parallel, delayed
+		from scipy import ndimage
+		from samri.pipelines.utils import write_nifti_volumes
+
+		# Keeping the file open lets chunks of compressed files be read sequentially, rather than decompressing from the start for each chunk.
+		img = nib.load(self.inputs.input_image, keep_file_open=True)
+		reference = nib.load(self.inputs.reference_image)
+		field = nib.load(self._displacement_field())
+		ref_shape = reference.shape[:3]
+
+		# ITK displacements are recorded in LPS physical space, NIfTI affines map to RAS.
+		displacement = np.asarray(field.dataobj, dtype=np.float64).reshape(ref_shape + (3,))
+		displacement[..., :2] *= -1
+		grid = np.indices(ref_shape, dtype=np.float64).reshape(3, -1)
+		points = reference.affine[:3, :3].dot(grid) + reference.affine[:3, 3:]
+		points += displacement.reshape(-1, 3).T
+		del displacement
+		inverse = np.linalg.inv(img.affine)
+		coordinates = inverse[:3, :3].dot(points) + inverse[:3, 3:]
+		del points
+
+		if self.inputs.interpolation == 'NearestNeighbor':
+			order = 0
+		elif self.inputs.interpolation == 'Linear':
+			order = 1
+		elif isdefined(self.inputs.interpolation_parameters):
+			order = self.inputs.interpolation_parameters[0]
+		else:
+			order = 3
+
+		def resample(volume):
+			return ndimage.map_coordinates(volume, coordinates,
+				order=order,
+				mode='constant',
+				cval=0.,
+				).reshape(ref_shape)
+
+		volumes = img.shape[3] if len(img.shape) > 3 else 1
+		if isdefined(self.inputs.max_memory_gb):
+			# The coordinates are held throughout, and each volume is held as float64 input, resampled output, and stacked output.
+			input_voxels = int(np.prod(img.shape[:3]))
+			reference_voxels = int(np.prod(ref_shape))
+			available = self.inputs.max_memory_gb * 2**30 - coordinates.nbytes
+			chunk_size = max(int(available // (8 * input_voxels + 16 * reference_voxels)), 1)
+		else:
+			chunk_size = max(self.inputs.chunk_size, 1)
+
+		def chunks():
+			for start in range(0, volumes, chunk_size):
+				stop = min(start + chunk_size, volumes)
+				if len(img.shape) > 3:
+					chunk = np.asarray(img.dataobj[..., start:stop], dtype=np.float64)
+				else:
+					chunk = np.asarray(img.dataobj, dtype=np.float64)[..., np.newaxis]
+				resampled = Parallel(n_jobs=self.inputs.num_threads, backend="threading")(
+					delayed(resample)(chunk[..., i]) for i in range(chunk.shape[3])
+					)
+				yield np.stack(resampled, axis=3)
+
+		header = reference.header.copy()
+		header.set_data_shape(ref_shape + ((volumes,) if len(img.shape) > 3 else ()))
+		zooms = reference.header.get_zooms()[:3]
+		if len(img.shape) > 3:
+			zooms = zooms + img.header.get_zooms()[3:4]
+		header.set_zooms(zooms)
+		header.set_xyzt_units(*img.header.get_xyzt_units())
+		header.set_data_dtype(np.float32)
+		header.set_qform(reference.affine)
+		header.set_sform(reference.affine)
+
+		self.result = write_nifti_volumes(self.inputs.output_image, header, chunks())
+
+		return runtime
+
+	def _list_outputs(self):
+		outputs = self._outputs().get()
+		outputs['output_image'] = self.result
+		return outputs
+
+class CroppedRegistrationInputSpec(RegistrationInputSpec):
+	crop_mask = File(exists=True,
+		desc="Mask (on the fixed image grid) to the bounding box of which the fixed image and fixed image masks are cropped before registration",
+		)
+	crop_margin = traits.Int(4,
+		usedefault=True,
+		desc="Number of voxels by which to dilate the cropping bounding boxes",
+		)
+	moving_threshold = traits.Float(0.05,
+		usedefault=True,
+		desc="Fraction of the robust (99.5th percentile) moving image maximum below which voxels are considered background; the moving image is cropped to the bounding box of its foreground, a value of 0 disables moving image cropping",
+		)
+
+class CroppedRegistration(Registration):
+	"""ANTs registration of images cropped to the extent of the region of interest.
+
+	The fixed image (and fixed image masks) are cropped to the dilated bounding box of `crop_mask`, and the moving image to the dilated bounding box of its foreground, before `antsRegistration` is called.
+	Cropping only changes the voxel grid and not the physical coordinates of the remaining voxels, so the resulting transforms are directly applicable to the uncropped images.
+	"""
+	input_spec = CroppedRegistrationInputSpec
+
+	def _crop(self, in_file, extent, prefix):
+		import nibabel as nib
+
+		img = nib.load(in_file)
+		out_file = os.path.abspath(prefix + os.path.basename(in_file))
+		nib.save(img.slicer[extent], out_file)
+		return out_file
+
+	def _cropped_registration(self):
+		"""Registration interface with the same inputs as this one, except that the images are replaced by their cropped versions."""
+		from samri.pipelines.utils import bounding_box
+
+		inputs = self.inputs.get_traitsfree()
+		for name in ['crop_mask', 'crop_margin', 'moving_threshold']:
+			inputs.pop(name, None)
+		registration = Registration(**inputs)
+		if isdefined(self.inputs.crop_mask):
+			mask = np.asanyarray(load(self.inputs.crop_mask).dataobj)
+			extent = bounding_box(mask, self.inputs.crop_margin)
+			registration.inputs.fixed_image = [self._crop(i, extent, 'crop_fixed_') for i in self.inputs.fixed_image]
+			if isdefined(self.inputs.fixed_image_masks):
+				registration.inputs.fixed_image_masks = [i if i == 'NULL' else self._crop(i, extent, 'crop_mask_') for i in self.inputs.fixed_image_masks]
+		if self.inputs.moving_threshold > 0:
+			moving_images = []
+			for i in self.inputs.moving_image:
+				data = np.asanyarray(load(i).dataobj)
+				foreground = data > self.inputs.moving_threshold * np.percentile(data, 99.5)
+				extent = bounding_box(foreground, self.inputs.crop_margin)
+				moving_images.append(self._crop(i, extent, 'crop_moving_'))
+			registration.inputs.moving_image = moving_images
+		return registration
+
+	def _run_interface(self, runtime, correct_return_codes=(0,)):
+		self._registration = self._cropped_registration()
+		runtime = self._registration._run_interface(runtime, correct_return_codes)
+		self._elapsed_time = self._registration._elapsed_time
+		self._metric_value = self._registration._metric_value
+		return runtime
+
+	def _list_outputs(self):
+		return self._registration._list_outputs()
+
+class DeliveryDataSinkInputSpec(DataSinkInputSpec):
+	delivery = traits.Enum('hardlink', 'reflink', 'move', 'copy',
+		usedefault=True,
+		desc="How to deliver files to the output directory, see `samri.pipelines.utils.deliver_file`; 'move' is only safe for files which no other node still needs to read",
+		)
+
+class DeliveryDataSink(DataSink):
+	"""DataSink which hardlinks, reflinks, or moves files into the output directory, and only falls back to copying if source and target are on different file systems.
+
+	Unlike `nipype.interfaces.io.DataSink`, existing targets are replaced without being hashed.
+	Remote (S3) base directories cannot be linked to, and are delivered to by `nipype.interfaces.io.DataSink`, ignoring the `delivery` input.
+	"""
+	input_spec = DeliveryDataSinkInputSpec
+
+	def _list_outputs(self):
+		from nipype.interfaces.io import copytree
+		from nipype.utils.filemanip import ensure_list
+		from samri.pipelines.utils import deliver_file
+
+		s3_flag, _ = self._check_s3_base_dir()
+		if s3_flag:
+			return super(DeliveryDataSink, self)._list_outputs()
+
+		outputs = self.output_spec().get()
+		out_files = []
+		outdir = self.inputs.base_directory
+		if not isdefined(outdir):
+			outdir = '.'
+		if isdefined(self.inputs.container):
+			outdir = os.path.join(outdir, self.inputs.container)
+		outdir = os.path.abspath(outdir)
+
+		for key, files in list(self.inputs._outputs.items()):
+			if not isdefined(files):
+				continue
+			files = ensure_list(files)
+			if isinstance(files[0], list):
+				files = [item for sublist in files for item in sublist]
+			key_dir = os.path.join(outdir, *[d for d in key.split('.') if d[0] != '@'])
+			for src in files:
+				src = os.path.abspath(src)
+				if not os.path.isfile(src):
+					src = os.path.join(src, '')
+				dst = self._substitute(os.path.join(key_dir, self._get_dst(src)))
+				if os.path.isfile(src):
+					os.makedirs(os.path.dirname(dst), exist_ok=True)
+					deliver_file(src, dst, self.inputs.delivery)
+				elif os.path.isdir(src):
+					if os.path.exists(dst) and self.inputs.remove_dest_dir:
+						shutil.rmtree(dst)
+					copytree(src, dst)
+				out_files.append(dst)
+		outputs['out_file'] = out_files
+		return outputs
+
 class MEICAInputSpec(CommandLineInputSpec):
 	echo_files = traits.List(File(exists=True), mandatory=True, position=0, argstr="-d %s", desc="4D files, for each echo time (called DSINPUTS by meica.py)")
 	echo_times = traits.List(traits.Float(), mandatory=True, position=1, argstr="-e %s", desc='Echo times (in ms) corresponding to the input files (called TES by meica.py)')
@@ -630,6 +1105,609 @@ class Bru2(CommandLine):
 				os.path.basename(os.path.normpath(self.inputs.input_dir)))
 			return outfile
 
+class NativeBru2InputSpec(BaseInterfaceInputSpec):
+	input_dir = Directory(exists=True, mandatory=True,
+		desc="ParaVision scan directory",
+		)
+	actual_size = traits.Bool(False,
+		usedefault=True,
+		desc="Keep actual size - otherwise x10 scale so animals match human.",
+		)
+	force_conversion = traits.Bool(False,
+		usedefault=True,
+		desc="Force conversion of localizers images (multiple slice orientations).",
+		)
+	compress = traits.Bool(False,
+		usedefault=True,
+		desc='gz compress images (".nii.gz").',
+		)
+	compresslevel = traits.Range(low=1, high=9,
+		desc="Gzip compression level, from 1 (fastest) to 9 (smallest), used if the compress option is selected",
+		)
+	output_filename = traits.Str(
+		desc='Output filename (".nii" will be appended, or ".nii.gz" if the compress option is selected)',
+		)
+	flip = traits.Bool(False,
+		usedefault=True,
+		desc="Rotate the image by 180 degrees around the slice axis while writing it (as `samri.pipelines.extra_functions.flip_if_needed` does for \"Prone\" scans)",
+		)
+	pdata = traits.Int(1,
+		usedefault=True,
+		desc="Number of the reconstruction (`pdata` subdirectory) to convert",
+		)
+	chunk_size = traits.Int(16,
+		usedefault=True,
+		desc="Number of volumes to hold in memory at any one time",
+		)
+
+class NativeBru2(BaseInterface):
+	"""Convert Bruker ParaVision `2dseq` files to NIfTI in-process.
+
+	This is a drop-in replacement for `Bru2`, saving a subprocess call per scan.
+	The `2dseq` file is memory-mapped and written out in a single streaming pass, which also applies the optional flip, so that no separate pass over the data is needed.
+	"""
+	input_spec = NativeBru2InputSpec
+	output_spec = Bru2OutputSpec
+
+	def _run_interface(self, runtime):
+		from samri.pipelines.utils import bruker_to_nifti
+
+		compresslevel = None
+		if isdefined(self.inputs.compresslevel):
+			compresslevel = self.inputs.compresslevel
+		bruker_to_nifti(self.inputs.input_dir, self._nii_file(),
+			actual_size=self.inputs.actual_size,
+			chunk_size=self.inputs.chunk_size,
+			compresslevel=compresslevel,
+			flip=self.inputs.flip,
+			force_conversion=self.inputs.force_conversion,
+			pdata=self.inputs.pdata,
+			)
+		return runtime
+
+	def _nii_file(self):
+		if isdefined(self.inputs.output_filename):
+			output_filename = os.path.abspath(self.inputs.output_filename)
+		else:
+			output_filename = os.path.join(os.getcwd(), os.path.basename(os.path.normpath(self.inputs.input_dir)))
+		if self.inputs.compress:
+			return output_filename + ".nii.gz"
+		return output_filename + ".nii"
+
+	def _list_outputs(self):
+		outputs = self._outputs().get()
+		outputs["nii_file"] = self._nii_file()
+		return outputs
+
+class CachedFEATModelInputSpec(Level1DesignInputSpec):
+	cache_dir = Directory(mandatory=True,
+		desc="Directory in which to store the generated designs, shared by all nodes which should reuse each other's designs",
+		)
+
+class CachedFEATModel(BaseInterface):
+	"""Generate an FSL design (as `Level1Design` followed by `FEATModel` would), reusing designs already generated for equivalent model specifications.
+
+	Designs are stored in `cache_dir` under a key derived from the canonicalized event onsets and durations, the regressors, the repetition time, the number of volumes, the basis set, and the contrasts (see `samri.pipelines.utils.design_cache_key`).
+	Scans which share the same design thus run `feat_model` (including the design image rendering) only once.
+	"""
+	input_spec = CachedFEATModelInputSpec
+	output_spec = FEATModelOutpuSpec
+
+	_parameters = ['interscan_interval', 'bases', 'orthogonalization', 'model_serial_correlations', 'contrasts']
+
+	def _run_interface(self, runtime):
+		import tempfile
+		from nipype.interfaces.fsl import FEATModel
+		from nipype.interfaces.fsl.model import Level1Design
+		from samri.pipelines.utils import design_cache_key
+
+		parameters = {}
+		for name in self._parameters:
+			value = getattr(self.inputs, name)
+			if isdefined(value):
+				parameters[name] = value
+		key = design_cache_key(self.inputs.session_info, **parameters)
+		cache_dir = os.path.abspath(self.inputs.cache_dir)
+		os.makedirs(cache_dir, exist_ok=True)
+		self.design_dir = os.path.join(cache_dir, key)
+		if not os.path.isdir(self.design_dir):
+			temporary_dir = tempfile.mkdtemp(prefix='.{}_'.format(key), dir=cache_dir)
+			cwd = os.getcwd()
+			try:
+				os.chdir(temporary_dir)
+				level1design = Level1Design()
+				level1design.inputs.session_info = self.inputs.session_info
+				for name, value in parameters.items():
+					setattr(level1design.inputs, name, value)
+				level1design_res = level1design.run()
+				modelgen = FEATModel()
+				modelgen.inputs.fsf_file = level1design_res.outputs.fsf_files
+				modelgen.inputs.ev_files = level1design_res.outputs.ev_files
+				modelgen.run()
+			finally:
+				os.chdir(cwd)
+			try:
+				os.rename(temporary_dir, self.design_dir)
+			except OSError:
+				# An equivalent design was generated concurrently.
+				shutil.rmtree(temporary_dir)
+		return runtime
+
+	def _list_outputs(self):
+		from glob import glob
+
+		outputs = self._outputs().get()
+		for output, pattern in [
+				('design_file', 'run*.mat'),
+				('design_image', 'run*[0-9].png'),
+				('design_cov', 'run*_cov.png'),
+				('con_file', 'run*.con'),
+				('fcon_file', 'run*.fts'),
+				]:
+			matches = sorted(glob(os.path.join(self.design_dir, pattern)))
+			if matches:
+				outputs[output] = matches[0]
+		return outputs
+
+class GLMStatisticsInputSpec(BaseInterfaceInputSpec):
+	in_file = File(exists=True, mandatory=True,
+		desc="4D NIfTI time series",
+		)
+	mask = File(exists=True,
+		desc="Mask image, only nonzero voxels of which are fitted",
+		)
+	out_file = traits.Str(
+		desc="output file name for the parameter estimates",
+		)
+	out_cope = traits.Str(
+		desc="output file name for the contrasts of parameter estimates",
+		)
+	out_varcb_name = traits.Str(
+		desc="output file name for the variance of the contrasts of parameter estimates",
+		)
+	out_t_name = traits.Str(
+		desc="output file name for the t-statistics",
+		)
+	out_z_name = traits.Str(
+		desc="output file name for the z-statistics",
+		)
+	out_p_name = traits.Str(
+		desc="output file name for the p-values of the z-statistics",
+		)
+	out_f_name = traits.Str(
+		desc="output file name for the F-value of the full model fit",
+		)
+	out_pf_name = traits.Str(
+		desc="output file name for the p-value of the full model fit",
+		)
+	out_sigsq_name = traits.Str(
+		desc="output file name for the residual noise variance",
+		)
+	out_glm_name = traits.Str(
+		desc="output file name for a consolidated 4D file containing all of the above statistics, which are mapped to their volumes in a JSON sidecar",
+		)
+	chunk_size = traits.Int(16,
+		usedefault=True,
+		desc="Number of volumes to hold in memory at any one time",
+		)
+	block_size = traits.Int(16384,
+		usedefault=True,
+		desc="Number of voxels for which to compute the estimates at any one time",
+		)
+
+class NativeGLMInputSpec(GLMStatisticsInputSpec):
+	design = File(exists=True, mandatory=True,
+		desc="FSL VEST design matrix file (e.g. `design.mat` as written by `FEATModel`)",
+		)
+	contrasts = File(exists=True, mandatory=True,
+		desc="FSL VEST contrast matrix file (e.g. `design.con` as written by `FEATModel`)",
+		)
+	prewhiten = traits.Bool(False,
+		usedefault=True,
+		desc="Whether to refit the model after voxelwise AR(1) prewhitening",
+		)
+
+class NativeGLMOutputSpec(GLMOutputSpec):
+	out_glm = File(exists=True)
+	out_glm_sidecar = File(exists=True)
+
+class NativeGLM(BaseInterface):
+	"""Fit a voxelwise GLM to a 4D NIfTI time series in-process.
+
+	This is a drop-in replacement for `nipype.interfaces.fsl.GLM`, accepting the same design and contrast files, and writing the same statistics (each only if a file name is given for it).
+	The data is read once, in chunks of `chunk_size` volumes, and the estimates are computed in vectorized blocks of `block_size` voxels (see `samri.pipelines.utils.glm_fit`), which bounds memory usage and allows multiple scans to be processed side by side.
+	Alternatively, all statistics can be written to a single consolidated file (`out_glm_name`), which can be read via `samri.utilities.statistic_image`.
+	"""
+	input_spec = NativeGLMInputSpec
+	output_spec = NativeGLMOutputSpec
+
+	_statistics = [
+		('out_file', 'out_file', 'betas'),
+		('out_cope', 'out_cope', 'cope'),
+		('out_varcb_name', 'out_varcb', 'varcb'),
+		('out_t_name', 'out_t', 'tstat'),
+		('out_z_name', 'out_z', 'zstat'),
+		('out_p_name', 'out_p', 'pstat'),
+		('out_f_name', 'out_f', 'fstat'),
+		('out_pf_name', 'out_pf', 'pfstat'),
+		('out_sigsq_name', 'out_sigsq', 'sigsq'),
+		]
+
+	def _run_interface(self, runtime):
+		from samri.pipelines.utils import glm_fit, read_vest
+
+		design, _ = read_vest(self.inputs.design)
+		contrasts, contrasts_header = read_vest(self.inputs.contrasts)
+		mask = self.inputs.mask if isdefined(self.inputs.mask) else None
+		statistics = glm_fit(self.inputs.in_file, design, contrasts,
+			mask=mask,
+			prewhiten=self.inputs.prewhiten,
+			chunk_size=self.inputs.chunk_size,
+			block_size=self.inputs.block_size,
+			)
+		contrast_names = [contrasts_header.get('ContrastName{}'.format(i + 1), str(i + 1)) for i in range(len(contrasts))]
+		self._write_statistics(statistics, contrast_names)
+		return runtime
+
+	def _write_statistics(self, statistics, contrast_names):
+		import nibabel as nib
+
+		img = nib.load(self.inputs.in_file)
+		for name, _, statistic in self._statistics:
+			out_file = getattr(self.inputs, name)
+			if not isdefined(out_file):
+				continue
+			data = statistics[statistic]
+			if data.shape[3] == 1:
+				data = data[..., 0]
+			self._save(data, img, os.path.abspath(out_file))
+
+		if isdefined(self.inputs.out_glm_name):
+			import json
+			from samri.utilities import statistics_sidecar
+
+			volumes = {}
+			start = 0
+			for _, _, statistic in self._statistics:
+				count = statistics[statistic].shape[3]
+				volumes[statistic] = list(range(start, start + count))
+				start += count
+			data = np.concatenate([statistics[statistic] for _, _, statistic in self._statistics], axis=3)
+			out_glm = os.path.abspath(self.inputs.out_glm_name)
+			self._save(data, img, out_glm)
+			with open(statistics_sidecar(out_glm), 'w') as f:
+				json.dump({'Statistics': volumes, 'Contrasts': contrast_names}, f, indent=1)
+
+	def _save(self, data, img, out_file):
+		import nibabel as nib
+
+		header = img.header.copy()
+		header.set_data_shape(data.shape)
+		header.set_data_dtype(np.float32)
+		nib.save(nib.Nifti1Image(data, img.affine, header), out_file)
+
+	def _list_outputs(self):
+		outputs = self._outputs().get()
+		for name, output, _ in self._statistics:
+			out_file = getattr(self.inputs, name)
+			if isdefined(out_file):
+				outputs[output] = os.path.abspath(out_file)
+		if isdefined(self.inputs.out_glm_name):
+			from samri.utilities import statistics_sidecar
+
+			outputs['out_glm'] = os.path.abspath(self.inputs.out_glm_name)
+			outputs['out_glm_sidecar'] = statistics_sidecar(outputs['out_glm'])
+		return outputs
+
+class SeedGLMInputSpec(GLMStatisticsInputSpec):
+	seed_mask = File(exists=True, xor=['seed_voxels'],
+		desc="Seed mask image, on the same grid as the time series",
+		)
+	seed_voxels = traits.List(traits.Int(), xor=['seed_mask'],
+		desc="Precomputed seed voxel indices (see `samri.pipelines.utils.seed_voxels`), which can be reused across scans",
+		)
+	top_voxel = File(exists=True, requires=['seed_mask'],
+		desc="Image based on the within-seed top-value voxel of which to restrict the seed",
+		)
+	metric = traits.Enum('mean', 'median',
+		usedefault=True,
+		desc="Whether to use the volume-wise seed mean or median as the regressor",
+		)
+	highpass_cutoff = traits.Float(0,
+		usedefault=True,
+		desc="Highpass filter cutoff for the regressor, in seconds, nonpositive values disable the filter",
+		)
+	tr = traits.Float(1,
+		usedefault=True,
+		desc="Repetition time, in seconds",
+		)
+	out_design_name = traits.Str(
+		desc="output file name for the FSL VEST design matrix",
+		)
+
+class SeedGLMOutputSpec(NativeGLMOutputSpec):
+	out_design = File(exists=True)
+
+class SeedGLM(NativeGLM):
+	"""Fit a seed-based functional connectivity GLM to a 4D NIfTI time series in-process.
+
+	This replaces the seed time course extraction, regressor creation, FEAT design, and `fsl_glm` steps by a single node, which reads the time series only once (see `samri.pipelines.utils.seed_glm_fit`).
+	The seed voxels can be passed precomputed, so that no mask needs to be rebuilt per scan.
+	The statistics are written as by `NativeGLM`, and the design matrix can additionally be written as an FSL VEST file.
+	"""
+	input_spec = SeedGLMInputSpec
+	output_spec = SeedGLMOutputSpec
+
+	def _run_interface(self, runtime):
+		from samri.pipelines.utils import seed_glm_fit, seed_voxels, write_vest
+
+		if isdefined(self.inputs.seed_voxels):
+			seed = self.inputs.seed_voxels
+		elif isdefined(self.inputs.seed_mask):
+			top_voxel = self.inputs.top_voxel if isdefined(self.inputs.top_voxel) else ''
+			seed = seed_voxels(self.inputs.seed_mask, top_voxel=top_voxel)
+		else:
+			raise ValueError('Either `seed_mask` or `seed_voxels` needs to be specified.')
+		mask = self.inputs.mask if isdefined(self.inputs.mask) else None
+		statistics, design = seed_glm_fit(self.inputs.in_file, seed,
+			mask=mask,
+			metric=self.inputs.metric,
+			highpass_cutoff=self.inputs.highpass_cutoff,
+			tr=self.inputs.tr,
+			chunk_size=self.inputs.chunk_size,
+			block_size=self.inputs.block_size,
+			)
+		self._write_statistics(statistics, ['seed'])
+		if isdefined(self.inputs.out_design_name):
+			write_vest(os.path.abspath(self.inputs.out_design_name), design, {'PPheights': '{:e}'.format(np.ptp(design))})
+		return runtime
+
+	def _list_outputs(self):
+		outputs = super(SeedGLM, self)._list_outputs()
+		if isdefined(self.inputs.out_design_name):
+			outputs['out_design'] = os.path.abspath(self.inputs.out_design_name)
+		return outputs
+
+class NativeFLAMEOInputSpec(BaseInterfaceInputSpec):
+	cope_files = InputMultiPath(File(exists=True), mandatory=True,
+		desc="First-level contrast maps, one per row of the design",
+		)
+	var_cope_files = InputMultiPath(File(exists=True),
+		desc="First-level contrast variance maps, corresponding to `cope_files`",
+		)
+	mask_file = File(exists=True, mandatory=True,
+		desc="Mask image, only nonzero voxels of which are fitted",
+		)
+	design_file = File(exists=True, mandatory=True,
+		desc="FSL VEST design matrix file (e.g. `design.mat` as written by `L2Model` or `MultipleRegressDesign`)",
+		)
+	t_con_file = File(exists=True, mandatory=True,
+		desc="FSL VEST t-contrast file (e.g. `design.con`)",
+		)
+	f_con_file = File(exists=True,
+		desc="FSL VEST F-test file (e.g. `design.fts`)",
+		)
+	cov_split_file = File(exists=True,
+		desc="FSL VEST variance group file (e.g. `design.grp`), only a single variance group is supported",
+		)
+	run_mode = traits.Enum('ols', 'fe', 'flame1', 'flame12', mandatory=True,
+		desc="Estimation model, 'flame12' is treated as 'flame1'",
+		)
+	cope_statistic = traits.Str('cope',
+		usedefault=True,
+		desc="Statistic to read from consolidated first-level statistics files listed in `cope_files`",
+		)
+	varcope_statistic = traits.Str('varcb',
+		usedefault=True,
+		desc="Statistic to read from consolidated first-level statistics files listed in `var_cope_files`",
+		)
+	volume = traits.Int(
+		desc="Volume to select from 4D first-level maps (e.g. one of multiple contrasts)",
+		)
+	block_size = traits.Int(16384,
+		usedefault=True,
+		desc="Number of voxels for which to compute the estimates at any one time",
+		)
+
+class NativeFLAMEO(BaseInterface):
+	"""Fit a second-level (group) model to first-level contrast maps in-process.
+
+	This is a replacement for `nipype.interfaces.fsl.FLAMEO`, accepting the same design files, and writing the same statistics to a `stats` directory, but taking lists of first-level maps instead of merged 4D files.
+	The maps are read through temporary memory-mapped stacks, and the estimates computed in vectorized blocks of `block_size` voxels (see `samri.pipelines.utils.l2_fit`), so that no merged files need to be written and multiple groups can be fitted side by side.
+	"""
+	input_spec = NativeFLAMEOInputSpec
+	output_spec = FLAMEOOutputSpec
+
+	_statistics = [
+		('pes', 'pe', 'pe'),
+		('copes', 'cope', 'cope'),
+		('var_copes', 'varcope', 'varcope'),
+		('tstats', 'tstat', 'tstat'),
+		('zstats', 'zstat', 'zstat'),
+		('fstats', 'fstat', 'fstat'),
+		('zfstats', 'zfstat', 'zfstat'),
+		('mrefvars', 'mrefvars', 'mean_random_effects_var'),
+		]
+
+	def _run_interface(self, runtime):
+		import nibabel as nib
+		from samri.pipelines.utils import l2_fit, read_vest
+
+		design, _ = read_vest(self.inputs.design_file)
+		t_contrasts, _ = read_vest(self.inputs.t_con_file)
+		f_contrasts = None
+		if isdefined(self.inputs.f_con_file):
+			f_contrasts, _ = read_vest(self.inputs.f_con_file)
+		if isdefined(self.inputs.cov_split_file):
+			groups, _ = read_vest(self.inputs.cov_split_file)
+			if len(np.unique(groups)) > 1:
+				raise ValueError('Only a single variance group is supported, but "{}" specifies {}.'.format(self.inputs.cov_split_file, len(np.unique(groups))))
+		var_cope_files = self.inputs.var_cope_files if isdefined(self.inputs.var_cope_files) else None
+		volume = self.inputs.volume if isdefined(self.inputs.volume) else None
+		statistics = l2_fit(self.inputs.cope_files, design, t_contrasts,
+			var_cope_files=var_cope_files,
+			f_contrasts=f_contrasts,
+			mask=self.inputs.mask_file,
+			run_mode=self.inputs.run_mode,
+			cope_statistic=self.inputs.cope_statistic,
+			varcope_statistic=self.inputs.varcope_statistic,
+			volume=volume,
+			block_size=self.inputs.block_size,
+			)
+
+		img = nib.load(self.inputs.mask_file)
+		stats_dir = os.path.abspath('stats')
+		if not os.path.exists(stats_dir):
+			os.makedirs(stats_dir)
+		for _, statistic, prefix in self._statistics:
+			if statistic == 'mrefvars' and not self.inputs.run_mode.startswith('flame'):
+				continue
+			for i in range(statistics[statistic].shape[3]):
+				header = img.header.copy()
+				header.set_data_dtype(np.float32)
+				out_file = os.path.join(stats_dir, '{}{}.nii.gz'.format(prefix, i + 1))
+				nib.save(nib.Nifti1Image(statistics[statistic][..., i], img.affine, header), out_file)
+		return runtime
+
+	def _list_outputs(self):
+		from glob import glob
+
+		outputs = self._outputs().get()
+		stats_dir = os.path.abspath('stats')
+		outputs['stats_dir'] = stats_dir
+		for output, _, prefix in self._statistics:
+			files = sorted(glob(os.path.join(stats_dir, '{}[0-9]*.nii.gz'.format(prefix))), key=lambda x: int(os.path.basename(x)[len(prefix):-len('.nii.gz')]))
+			if files:
+				outputs[output] = files
+		return outputs
+
+class PermutationTestInputSpec(BaseInterfaceInputSpec):
+	cope_files = InputMultiPath(File(exists=True), mandatory=True,
+		desc="First-level contrast maps, one per row of the design",
+		)
+	mask = File(exists=True, mandatory=True,
+		desc="Mask image, only nonzero voxels of which are tested",
+		)
+	design_mat = File(exists=True, mandatory=True,
+		desc="FSL VEST design matrix file (e.g. `design.mat` as written by `L2Model` or `MultipleRegressDesign`)",
+		)
+	tcon = File(exists=True, mandatory=True,
+		desc="FSL VEST t-contrast file (e.g. `design.con`)",
+		)
+	base_name = traits.Str('randomise',
+		usedefault=True,
+		desc="Prefix of the output file names, which otherwise follow FSL's `randomise`",
+		)
+	num_perm = traits.Int(5000,
+		usedefault=True,
+		desc="Number of sign-flips or permutations, which are enumerated exhaustively if there are no more possible",
+		)
+	method = traits.Enum('flip', 'permute',
+		usedefault=True,
+		desc="Whether to sign-flip (assuming symmetric errors) or permute (assuming exchangeable errors) the residuals",
+		)
+	tfce = traits.Bool(True,
+		usedefault=True,
+		desc="Whether to compute threshold-free cluster enhanced p-values",
+		)
+	seed = traits.Int(
+		desc="Seed for the random generation of sign-flips or permutations",
+		)
+	cope_statistic = traits.Str('cope',
+		usedefault=True,
+		desc="Statistic to read from consolidated first-level statistics files listed in `cope_files`",
+		)
+	volume = traits.Int(
+		desc="Volume to select from 4D first-level maps (e.g. one of multiple contrasts)",
+		)
+	batch_size = traits.Int(64,
+		usedefault=True,
+		nohash=True,
+		desc="Number of permutations for which to compute the statistics at any one time in each process",
+		)
+	block_size = traits.Int(16384,
+		usedefault=True,
+		nohash=True,
+		desc="Number of voxels for which to compute the statistics at any one time",
+		)
+	num_threads = traits.Int(1,
+		usedefault=True,
+		nohash=True,
+		desc="Number of processes across which to distribute the permutations",
+		)
+
+class PermutationTestOutputSpec(RandomiseOutputSpec):
+	vox_p_files = OutputMultiPath(File(exists=True),
+		desc="uncorrected voxelwise p-value (as 1-p) files",
+		)
+	vox_corrected_p_files = OutputMultiPath(File(exists=True),
+		desc="family-wise error corrected voxelwise p-value (as 1-p) files",
+		)
+
+class PermutationTest(BaseInterface):
+	"""Non-parametric inference for the t-contrasts of a second-level (group) model, in-process.
+
+	This is a replacement for `nipype.interfaces.fsl.Randomise`, accepting the same design files, and writing the same statistics, but taking lists of first-level maps instead of merged 4D files.
+	The sign-flips or permutations are computed as batched matrix products over voxel blocks, and distributed across `num_threads` processes (see `samri.pipelines.utils.permutation_test`).
+	The `t_p_files` and `t_corrected_p_files` outputs refer to the TFCE p-values if `tfce` is true, and to the voxelwise p-values otherwise.
+	"""
+	input_spec = PermutationTestInputSpec
+	output_spec = PermutationTestOutputSpec
+
+	_statistics = [
+		('tstat', '{}_tstat{}.nii.gz'),
+		('vox_p', '{}_vox_p_tstat{}.nii.gz'),
+		('vox_corrp', '{}_vox_corrp_tstat{}.nii.gz'),
+		('tfce_p', '{}_tfce_p_tstat{}.nii.gz'),
+		('tfce_corrp', '{}_tfce_corrp_tstat{}.nii.gz'),
+		]
+
+	def _run_interface(self, runtime):
+		import nibabel as nib
+		from samri.pipelines.utils import permutation_test, read_vest
+
+		design, _ = read_vest(self.inputs.design_mat)
+		contrasts, _ = read_vest(self.inputs.tcon)
+		statistics = permutation_test(self.inputs.cope_files, design, contrasts,
+			mask=self.inputs.mask,
+			permutations=self.inputs.num_perm,
+			method=self.inputs.method,
+			tfce_enhancement=self.inputs.tfce,
+			cope_statistic=self.inputs.cope_statistic,
+			volume=self.inputs.volume if isdefined(self.inputs.volume) else None,
+			batch_size=self.inputs.batch_size,
+			block_size=self.inputs.block_size,
+			n_jobs=self.inputs.num_threads,
+			seed=self.inputs.seed if isdefined(self.inputs.seed) else None,
+			)
+
+		img = nib.load(self.inputs.mask)
+		header = img.header.copy()
+		header.set_data_dtype(np.float32)
+		for statistic, file_name in self._statistics:
+			if statistic not in statistics:
+				continue
+			for i in range(statistics[statistic].shape[3]):
+				out_file = os.path.abspath(file_name.format(self.inputs.base_name, i + 1))
+				nib.save(nib.Nifti1Image(statistics[statistic][..., i], img.affine, header), out_file)
+		return runtime
+
+	def _list_outputs(self):
+		from samri.pipelines.utils import read_vest
+
+		outputs = self._outputs().get()
+		contrasts, _ = read_vest(self.inputs.tcon)
+		files = {}
+		for statistic, file_name in self._statistics:
+			files[statistic] = [os.path.abspath(file_name.format(self.inputs.base_name, i + 1)) for i in range(len(contrasts))]
+		outputs['tstat_files'] = files['tstat']
+		outputs['vox_p_files'] = files['vox_p']
+		outputs['vox_corrected_p_files'] = files['vox_corrp']
+		prefix = 'tfce' if self.inputs.tfce else 'vox'
+		outputs['t_p_files'] = files[prefix + '_p']
+		outputs['t_corrected_p_files'] = files[prefix + '_corrp']
+		return outputs
+
 class CompositeTransformUtilInputSpec(ANTSCommandInputSpec):
 	process = traits.Enum('assemble', 'disassemble', argstr='--%s',
 		position=1, usedefault=True,
@@ -13,21 +13,22 @@ from shutil import copyfile
 from copy import deepcopy
 from itertools import product
 from nipype.interfaces import fsl
-from nipype.interfaces.fsl.model import Level1Design
 #from nipype.algorithms.modelgen import SpecifyModel
 
-from samri.pipelines.extra_interfaces import SpecifyModel
-from samri.pipelines.extra_functions import select_from_datafind_df, corresponding_eventfile, get_bids_scan, physiofile_ts, eventfile_add_habituation, regressor
-from samri.pipelines.utils import bids_dict_to_source, copy_bids_files, ss_to_path, iterfield_selector, datasource_exclude, bids_dict_to_dir
+from samri.pipelines.extra_interfaces import SpecifyModel, DeliveryDataSink, NativeGLM, NativeFLAMEO, PermutationTest, SeedGLM, CachedFEATModel, TemporalBandpass
+from samri.pipelines.extra_functions import select_from_datafind_df, corresponding_eventfile, get_bids_scan, physiofile_ts, eventfile_add_habituation, regressor, merge_statistics
+from samri.pipelines.utils import bids_dict_to_source, copy_bids_files, ss_to_path, iterfield_selector, datasource_exclude, bids_dict_to_dir, set_nifti_output_type
 from samri.report.roi import ts
-from samri.utilities import N_PROCS
+from samri.utilities import N_PROCS, GLM_STATISTICS_DESC
 
 N_PROCS=max(N_PROCS-2, 1)
 
 def l1(preprocessing_dir,
 	bf_path='',
+	compress_intermediates=True,
 	convolution='gamma',
 	debug=False,
+	delivery=None,
 	exclude={},
 	habituation='confound',
 	highpass_sigma=225,
@@ -44,6 +45,9 @@ def l1(preprocessing_dir,
 	n_jobs_percentage=1,
 	invert=False,
 	user_defined_contrasts=False,
+	native_glm=False,
+	prewhiten=False,
+	consolidate_statistics=False,
 	):
 	"""Calculate subject level GLM statistic scores.
 
@@ -53,8 +57,16 @@ def l1(preprocessing_dir,
 	bf_path : str, optional
 		Basis set path. It should point to a text file in the so-called FEAT/FSL "#2" format (1 entry per volume).
 		If selected, this overrides the `convolution` option and sets it to "custom".
+	compress_intermediates : bool, optional
+		Whether to write gzip-compressed intermediate files in the work directory.
+		The statistic maps are written compressed either way, as their file names are set explicitly.
 	convolution : str or dict, optional
 		Select convolution method.
+	delivery : {'hardlink', 'reflink', 'copy'}, optional
+		How to deliver the results from the work directory to the output directory.
+		'hardlink' and 'reflink' avoid duplicating the data on disk and fall back to copying if the work and output directories are on different file systems.
+		Hardlinked outputs share their data with the work directory files, so that modifying either modifies both.
+		If unspecified, results are hardlinked if the work directory is removed (i.e. if `keep_work` is `False`), and copied otherwise.
 	exclude : dict
 		A dictionary with any combination of "sessions", "subjects", "tasks" as keys and corresponding identifiers as values.
 		If this is specified matching entries will be excluded in the analysis.
@@ -82,6 +94,16 @@ def l1(preprocessing_dir,
 		This has to point to an existing NIfTI file containing zero and one values only.
 	n_jobs_percentage : float, optional
 		Percentage of the cores present on the machine which to maximally use for deploying jobs in parallel.
+	native_glm : bool, optional
+		Whether to fit the GLM in-process (via `samri.pipelines.extra_interfaces.NativeGLM`) rather than via FSL's `fsl_glm`.
+		The native fit bounds its memory usage, so that more scans can be processed side by side.
+	prewhiten : bool, optional
+		Whether to account for serial correlations by voxelwise AR(1) prewhitening.
+		This is only supported with `native_glm`.
+	consolidate_statistics : bool, optional
+		Whether to write all statistics of each scan into a single consolidated 4D float32 NIfTI file (with a `desc-glm` BIDS field), rather than one file per statistic.
+		The statistics are mapped to their volumes in a JSON sidecar, and can be read transparently via `samri.utilities.statistic_image`.
+		This is only supported with `native_glm`.
 	temporal_derivatives : int, optional
 		Whether to add temporal derivatives of the main regressors in the model. This only applies if the convolution parameter is set to 'dgamma' or 'gamma'.
 	tr : int, optional
@@ -125,7 +147,8 @@ def l1(preprocessing_dir,
 	specify_model.inputs.time_repetition = tr
 	specify_model.inputs.high_pass_filter_cutoff = highpass_sigma
 
-	level1design = pe.Node(interface=Level1Design(), name="level1design")
+	level1design = pe.Node(interface=CachedFEATModel(), name="level1design")
+	level1design.inputs.cache_dir = path.join(workdir,'design_cache')
 	level1design.inputs.interscan_interval = tr
 	if bf_path:
 		convolution = 'custom'
@@ -146,15 +169,20 @@ def l1(preprocessing_dir,
 		raise ValueError('You have specified an invalid value for the "convoltion" parameter of.')
 	level1design.inputs.model_serial_correlations = True
 
-	modelgen = pe.Node(interface=fsl.FEATModel(), name='modelgen')
-
-	glm = pe.Node(interface=fsl.GLM(), name='glm', iterfield='design')
+	if native_glm:
+		glm = pe.Node(interface=NativeGLM(), name='glm')
+		glm.inputs.prewhiten = prewhiten
+		glm.interface.mem_gb = 1
+	elif prewhiten:
+		raise ValueError('Prewhitening is only performed by the native GLM, please also set `native_glm=True`.')
+	else:
+		glm = pe.Node(interface=fsl.GLM(), name='glm', iterfield='design')
+		glm.interface.mem_gb = 6
 	if mask == 'mouse':
 		mask = '/usr/share/mouse-brain-templates/dsurqec_200micron_mask.nii'
 		glm.inputs.mask = path.abspath(path.expanduser(mask))
 	else:
 		glm.inputs.mask = path.abspath(path.expanduser(mask))
-	glm.interface.mem_gb = 6
 
 	try:
 		from bids.grabbids import BIDSLayout
@@ -187,49 +215,65 @@ def l1(preprocessing_dir,
 	design_rename = pe.Node(interface=util.Rename(), name='design_rename')
 	designimage_rename = pe.Node(interface=util.Rename(), name='designimage_rename')
 
-	datasink = pe.Node(nio.DataSink(), name='datasink')
+	if delivery is None:
+		delivery = 'copy' if keep_work else 'hardlink'
+	datasink = pe.Node(DeliveryDataSink(), name='datasink')
+	datasink.inputs.delivery = delivery
 	datasink.inputs.base_directory = path.join(out_base,workflow_name)
 	datasink.inputs.parameterization = False
 
 	workflow_connections = [
 		(get_scan, eventfile, [('nii_path', 'timecourse_file')]),
 		(specify_model, level1design, [('session_info', 'session_info')]),
-		(level1design, modelgen, [('ev_files', 'ev_files')]),
-		(level1design, modelgen, [('fsf_files', 'fsf_file')]),
-		(modelgen, glm, [('design_file', 'design')]),
-		(modelgen, glm, [('con_file', 'contrasts')]),
+		(level1design, glm, [('design_file', 'design')]),
+		(level1design, glm, [('con_file', 'contrasts')]),
 		(get_scan, datasink, [(('dict_slice',bids_dict_to_dir), 'container')]),
-		(get_scan, betas_filename, [('dict_slice', 'bids_dictionary')]),
-		(get_scan, cope_filename, [('dict_slice', 'bids_dictionary')]),
-		(get_scan, varcb_filename, [('dict_slice', 'bids_dictionary')]),
-		(get_scan, tstat_filename, [('dict_slice', 'bids_dictionary')]),
-		(get_scan, zstat_filename, [('dict_slice', 'bids_dictionary')]),
-		(get_scan, pstat_filename, [('dict_slice', 'bids_dictionary')]),
-		(get_scan, pfstat_filename, [('dict_slice', 'bids_dictionary')]),
 		(get_scan, design_filename, [('dict_slice', 'bids_dictionary')]),
 		(get_scan, designimage_filename, [('dict_slice', 'bids_dictionary')]),
-		(betas_filename, glm, [('filename', 'out_file')]),
-		(cope_filename, glm, [('filename', 'out_cope')]),
-		(varcb_filename, glm, [('filename', 'out_varcb_name')]),
-		(tstat_filename, glm, [('filename', 'out_t_name')]),
-		(zstat_filename, glm, [('filename', 'out_z_name')]),
-		(pstat_filename, glm, [('filename', 'out_p_name')]),
-		(pfstat_filename, glm, [('filename', 'out_pf_name')]),
-		(modelgen, design_rename, [('design_file', 'in_file')]),
-		(modelgen, designimage_rename, [('design_image', 'in_file')]),
+		(level1design, design_rename, [('design_file', 'in_file')]),
+		(level1design, designimage_rename, [('design_image', 'in_file')]),
 		(design_filename, design_rename, [('filename', 'format_string')]),
 		(designimage_filename, designimage_rename, [('filename', 'format_string')]),
-		(glm, datasink, [('out_pf', '@pfstat')]),
-		(glm, datasink, [('out_p', '@pstat')]),
-		(glm, datasink, [('out_z', '@zstat')]),
-		(glm, datasink, [('out_t', '@tstat')]),
-		(glm, datasink, [('out_cope', '@cope')]),
-		(glm, datasink, [('out_varcb', '@varcb')]),
-		(glm, datasink, [('out_file', '@betas')]),
 		(design_rename, datasink, [('out_file', '@design')]),
 		(designimage_rename, datasink, [('out_file', '@designimage')]),
 		]
 
+	if consolidate_statistics:
+		if not native_glm:
+			raise ValueError('Consolidated statistics files are only written by the native GLM, please also set `native_glm=True`.')
+		glm_filename = pe.Node(name='glm_filename', interface=util.Function(function=bids_dict_to_source,input_names=inspect.getargspec(bids_dict_to_source)[0], output_names=['filename']))
+		glm_filename.inputs.source_format = out_file_name_base.format(GLM_STATISTICS_DESC,'nii.gz')
+		workflow_connections.extend([
+			(get_scan, glm_filename, [('dict_slice', 'bids_dictionary')]),
+			(glm_filename, glm, [('filename', 'out_glm_name')]),
+			(glm, datasink, [('out_glm', '@glm')]),
+			(glm, datasink, [('out_glm_sidecar', '@glm_sidecar')]),
+			])
+	else:
+		workflow_connections.extend([
+			(get_scan, betas_filename, [('dict_slice', 'bids_dictionary')]),
+			(get_scan, cope_filename, [('dict_slice', 'bids_dictionary')]),
+			(get_scan, varcb_filename, [('dict_slice', 'bids_dictionary')]),
+			(get_scan, tstat_filename, [('dict_slice', 'bids_dictionary')]),
+			(get_scan, zstat_filename, [('dict_slice', 'bids_dictionary')]),
+			(get_scan, pstat_filename, [('dict_slice', 'bids_dictionary')]),
+			(get_scan, pfstat_filename, [('dict_slice', 'bids_dictionary')]),
+			(betas_filename, glm, [('filename', 'out_file')]),
+			(cope_filename, glm, [('filename', 'out_cope')]),
+			(varcb_filename, glm, [('filename', 'out_varcb_name')]),
+			(tstat_filename, glm, [('filename', 'out_t_name')]),
+			(zstat_filename, glm, [('filename', 'out_z_name')]),
+			(pstat_filename, glm, [('filename', 'out_p_name')]),
+			(pfstat_filename, glm, [('filename', 'out_pf_name')]),
+			(glm, datasink, [('out_pf', '@pfstat')]),
+			(glm, datasink, [('out_p', '@pstat')]),
+			(glm, datasink, [('out_z', '@zstat')]),
+			(glm, datasink, [('out_t', '@tstat')]),
+			(glm, datasink, [('out_cope', '@cope')]),
+			(glm, datasink, [('out_varcb', '@varcb')]),
+			(glm, datasink, [('out_file', '@betas')]),
+			])
+
 	if habituation:
 		level1design.inputs.orthogonalization = {1: {0:0,1:0,2:0}, 2: {0:1,1:1,2:0}}
 		specify_model.inputs.bids_condition_column = 'samri_l1_regressors'
@@ -267,9 +311,9 @@ def l1(preprocessing_dir,
 		raise ValueError('The value you have provided for the `habituation` parameter, namely "{}", is invalid. Please choose one of: {{None, False,"","confound","in_main_contrast","separate_contrast"}}'.format(habituation))
 
 	if highpass_sigma or lowpass_sigma:
-		bandpass = pe.Node(interface=fsl.maths.TemporalFilter(), name="bandpass")
+		bandpass = pe.Node(interface=TemporalBandpass(), name="bandpass", mem_gb=1)
 		bandpass.inputs.highpass_sigma = highpass_sigma
-		bandpass.interface.mem_gb = 16
+		bandpass.inputs.max_memory_gb = bandpass.mem_gb
 		if lowpass_sigma:
 			bandpass.inputs.lowpass_sigma = lowpass_sigma
 		else:
@@ -322,6 +366,7 @@ def l1(preprocessing_dir,
 	workflow.connect(workflow_connections)
 	workflow.base_dir = out_base
 	workflow.config = workflow_config
+	set_nifti_output_type(workflow, compress_intermediates)
 	try:
 		workflow.write_graph(dotfilename=path.join(workflow.base_dir,workdir_name,"graph.dot"), graph2use="hierarchical", format="png")
 	except OSError:
@@ -351,6 +396,9 @@ def l1_physio(preprocessing_dir, physiology_identifier,
 	modality="cbv",
 	n_jobs_percentage=1,
 	invert=False,
+	native_glm=False,
+	prewhiten=False,
+	consolidate_statistics=False,
 	):
 	"""Calculate subject level GLM statistic scores.
 
@@ -386,6 +434,16 @@ def l1_physio(preprocessing_dir, physiology_identifier,
 		This has to point to an existing NIfTI file containing zero and one values only.
 	n_jobs_percentage : float, optional
 		Percentage of the cores present on the machine which to maximally use for deploying jobs in parallel.
+	native_glm : bool, optional
+		Whether to fit the GLM in-process (via `samri.pipelines.extra_interfaces.NativeGLM`) rather than via FSL's `fsl_glm`.
+		The native fit bounds its memory usage, so that more scans can be processed side by side.
+	prewhiten : bool, optional
+		Whether to account for serial correlations by voxelwise AR(1) prewhitening.
+		This is only supported with `native_glm`.
+	consolidate_statistics : bool, optional
+		Whether to write all statistics of each scan into a single consolidated 4D float32 NIfTI file (with a `desc-glm` BIDS field), rather than one file per statistic.
+		The statistics are mapped to their volumes in a JSON sidecar, and can be read transparently via `samri.utilities.statistic_image`.
+		This is only supported with `native_glm`.
 	temporal_derivatives : int, optional
 		Whether to add temporal derivatives of the main regressors in the model. This only applies if the convolution parameter is set to 'dgamma' or 'gamma'.
 	tr : int, optional
@@ -430,7 +488,8 @@ def l1_physio(preprocessing_dir, physiology_identifier,
 		invert = pe.Node(interface=fsl.ImageMaths(), name="invert")
 		invert.inputs.op_string = '-mul -1'
 
-	level1design = pe.Node(interface=Level1Design(), name="level1design")
+	level1design = pe.Node(interface=CachedFEATModel(), name="level1design")
+	level1design.inputs.cache_dir = path.join(workdir,'design_cache')
 	level1design.inputs.interscan_interval = tr
 	if bf_path:
 		convolution = 'custom'
@@ -454,15 +513,20 @@ def l1_physio(preprocessing_dir, physiology_identifier,
 		raise ValueError('You have specified an invalid value for the "convoltion" parameter of.')
 	level1design.inputs.model_serial_correlations = True
 
-	modelgen = pe.Node(interface=fsl.FEATModel(), name='modelgen')
-
-	glm = pe.Node(interface=fsl.GLM(), name='glm', iterfield='design')
+	if native_glm:
+		glm = pe.Node(interface=NativeGLM(), name='glm')
+		glm.inputs.prewhiten = prewhiten
+		glm.interface.mem_gb = 1
+	elif prewhiten:
+		raise ValueError('Prewhitening is only performed by the native GLM, please also set `native_glm=True`.')
+	else:
+		glm = pe.Node(interface=fsl.GLM(), name='glm', iterfield='design')
+		glm.interface.mem_gb = 6
 	if mask == 'mouse':
 		mask = '/usr/share/mouse-brain-templates/dsurqec_200micron_mask.nii'
 		glm.inputs.mask = path.abspath(path.expanduser(mask))
 	else:
 		glm.inputs.mask = path.abspath(path.expanduser(mask))
-	glm.interface.mem_gb = 6
 
 	try:
 		from bids.grabbids import BIDSLayout
@@ -503,46 +567,59 @@ def l1_physio(preprocessing_dir, physiology_identifier,
 		(physiofile, make_regressor, [('ts', 'timecourse')]),
 		(physiofile, make_regressor, [('nii_file', 'scan_path')]),
 		(make_regressor, level1design, [('output', 'session_info')]),
-		(level1design, modelgen, [('ev_files', 'ev_files')]),
-		(level1design, modelgen, [('fsf_files', 'fsf_file')]),
-		(modelgen, glm, [('design_file', 'design')]),
-		(modelgen, glm, [('con_file', 'contrasts')]),
+		(level1design, glm, [('design_file', 'design')]),
+		(level1design, glm, [('con_file', 'contrasts')]),
 		(get_scan, datasink, [(('dict_slice',bids_dict_to_dir), 'container')]),
-		(get_scan, betas_filename, [('dict_slice', 'bids_dictionary')]),
-		(get_scan, cope_filename, [('dict_slice', 'bids_dictionary')]),
-		(get_scan, varcb_filename, [('dict_slice', 'bids_dictionary')]),
-		(get_scan, tstat_filename, [('dict_slice', 'bids_dictionary')]),
-		(get_scan, zstat_filename, [('dict_slice', 'bids_dictionary')]),
-		(get_scan, pstat_filename, [('dict_slice', 'bids_dictionary')]),
-		(get_scan, pfstat_filename, [('dict_slice', 'bids_dictionary')]),
 		(get_scan, design_filename, [('dict_slice', 'bids_dictionary')]),
 		(get_scan, designimage_filename, [('dict_slice', 'bids_dictionary')]),
-		(betas_filename, glm, [('filename', 'out_file')]),
-		(cope_filename, glm, [('filename', 'out_cope')]),
-		(varcb_filename, glm, [('filename', 'out_varcb_name')]),
-		(tstat_filename, glm, [('filename', 'out_t_name')]),
-		(zstat_filename, glm, [('filename', 'out_z_name')]),
-		(pstat_filename, glm, [('filename', 'out_p_name')]),
-		(pfstat_filename, glm, [('filename', 'out_pf_name')]),
-		(modelgen, design_rename, [('design_file', 'in_file')]),
-		(modelgen, designimage_rename, [('design_image', 'in_file')]),
+		(level1design, design_rename, [('design_file', 'in_file')]),
+		(level1design, designimage_rename, [('design_image', 'in_file')]),
 		(design_filename, design_rename, [('filename', 'format_string')]),
 		(designimage_filename, designimage_rename, [('filename', 'format_string')]),
-		(glm, datasink, [('out_pf', '@pfstat')]),
-		(glm, datasink, [('out_p', '@pstat')]),
-		(glm, datasink, [('out_z', '@zstat')]),
-		(glm, datasink, [('out_t', '@tstat')]),
-		(glm, datasink, [('out_cope', '@cope')]),
-		(glm, datasink, [('out_varcb', '@varcb')]),
-		(glm, datasink, [('out_file', '@betas')]),
 		(design_rename, datasink, [('out_file', '@design')]),
 		(designimage_rename, datasink, [('out_file', '@designimage')]),
 		]
 
+	if consolidate_statistics:
+		if not native_glm:
+			raise ValueError('Consolidated statistics files are only written by the native GLM, please also set `native_glm=True`.')
+		glm_filename = pe.Node(name='glm_filename', interface=util.Function(function=bids_dict_to_source,input_names=inspect.getargspec(bids_dict_to_source)[0], output_names=['filename']))
+		glm_filename.inputs.source_format = out_file_name_base.format(GLM_STATISTICS_DESC,'nii.gz')
+		workflow_connections.extend([
+			(get_scan, glm_filename, [('dict_slice', 'bids_dictionary')]),
+			(glm_filename, glm, [('filename', 'out_glm_name')]),
+			(glm, datasink, [('out_glm', '@glm')]),
+			(glm, datasink, [('out_glm_sidecar', '@glm_sidecar')]),
+			])
+	else:
+		workflow_connections.extend([
+			(get_scan, betas_filename, [('dict_slice', 'bids_dictionary')]),
+			(get_scan, cope_filename, [('dict_slice', 'bids_dictionary')]),
+			(get_scan, varcb_filename, [('dict_slice', 'bids_dictionary')]),
+			(get_scan, tstat_filename, [('dict_slice', 'bids_dictionary')]),
+			(get_scan, zstat_filename, [('dict_slice', 'bids_dictionary')]),
+			(get_scan, pstat_filename, [('dict_slice', 'bids_dictionary')]),
+			(get_scan, pfstat_filename, [('dict_slice', 'bids_dictionary')]),
+			(betas_filename, glm, [('filename', 'out_file')]),
+			(cope_filename, glm, [('filename', 'out_cope')]),
+			(varcb_filename, glm, [('filename', 'out_varcb_name')]),
+			(tstat_filename, glm, [('filename', 'out_t_name')]),
+			(zstat_filename, glm, [('filename', 'out_z_name')]),
+			(pstat_filename, glm, [('filename', 'out_p_name')]),
+			(pfstat_filename, glm, [('filename', 'out_pf_name')]),
+			(glm, datasink, [('out_pf', '@pfstat')]),
+			(glm, datasink, [('out_p', '@pstat')]),
+			(glm, datasink, [('out_z', '@zstat')]),
+			(glm, datasink, [('out_t', '@tstat')]),
+			(glm, datasink, [('out_cope', '@cope')]),
+			(glm, datasink, [('out_varcb', '@varcb')]),
+			(glm, datasink, [('out_file', '@betas')]),
+			])
+
 	if highpass_sigma or lowpass_sigma:
-		bandpass = pe.Node(interface=fsl.maths.TemporalFilter(), name="bandpass")
+		bandpass = pe.Node(interface=TemporalBandpass(), name="bandpass", mem_gb=1)
 		bandpass.inputs.highpass_sigma = highpass_sigma
-		bandpass.interface.mem_gb = 16
+		bandpass.inputs.max_memory_gb = bandpass.mem_gb
 		if lowpass_sigma:
 			bandpass.inputs.lowpass_sigma = lowpass_sigma
 		else:
@@ -620,6 +697,7 @@ def seed(preprocessing_dir, seed_mask,
 	invert=False,
 	metric='mean',
 	top_voxel='',
+	native_glm=False,
 	):
 	"""Calculate subject level seed-based functional connectivity via the `fsl_glm` command.
 
@@ -659,6 +737,9 @@ def seed(preprocessing_dir, seed_mask,
 	top_voxel : str or list, optional
 		Path to NIfTI file or files based on the within-mask top-value voxel of which to create a sub-mask for time course extraction.
 		Note that this file *needs* to be in the exact same affine space as the `seed_mask` file.
+	native_glm : bool, optional
+		Whether to fit the seed GLM in-process (via `samri.pipelines.extra_interfaces.SeedGLM`) rather than via FEAT and FSL's `fsl_glm`.
+		This reads each time series only once, and (unless `top_voxel` is specified) selects the seed voxels only once for all scans.
 	"""
 
 	from samri.pipelines.utils import bids_data_selection
@@ -685,40 +766,53 @@ def seed(preprocessing_dir, seed_mask,
 	get_scan.inputs.bids_base = preprocessing_dir
 	get_scan.iterables = ("ind_type", ind)
 
-	compute_seed = pe.Node(name='compute_seed', interface=util.Function(function=ts,input_names=inspect.getargspec(ts)[0], output_names=['means','medians']))
 	if erode_iterations:
 		from samri.report.roi import erode
 		eroded_seed = '/var/tmp/samri_seed_eroded_{}.nii.gz'.format(erode_iterations)
 		erode(path.abspath(path.expanduser(seed_mask)), iterations=erode_iterations, save_as=eroded_seed)
-		compute_seed.inputs.mask = eroded_seed
+		seed_mask = eroded_seed
 	else:
-		compute_seed.inputs.mask = path.abspath(path.expanduser(seed_mask))
-
-	make_regressor = pe.Node(name='make_regressor', interface=util.Function(function=regressor,input_names=inspect.getargspec(regressor)[0], output_names=['output']))
-	make_regressor.inputs.hpf = highpass_sigma
-	make_regressor.inputs.name = 'seed'
+		seed_mask = path.abspath(path.expanduser(seed_mask))
 
 	if invert:
 		invert = pe.Node(interface=fsl.ImageMaths(), name="invert")
 		invert.inputs.op_string = '-mul -1'
 
-	level1design = pe.Node(interface=Level1Design(), name="level1design")
-	level1design.inputs.interscan_interval = tr
-	level1design.inputs.bases = {'none': {}}
-	level1design.inputs.model_serial_correlations = True
-	level1design.inputs.contrasts = [('stim','T', ['seed'],[1])]
-
-	modelgen = pe.Node(interface=fsl.FEATModel(), name='modelgen')
-
-	glm = pe.Node(interface=fsl.GLM(), name='glm', iterfield='design')
-
 	if mask == 'mouse':
 		mask = '/usr/share/mouse-brain-templates/dsurqec_200micron_mask.nii'
-		(make_regressor, level1design, [('output', 'session_info')]),
-		glm.inputs.mask = path.abspath(path.expanduser(mask))
+	mask = path.abspath(path.expanduser(mask))
+
+	if metric not in ['mean', 'median']:
+		raise ValueError('Accepted values for the `metric` parameter are "mean" and "median". You specified {}'.format(metric))
+	if native_glm:
+		from samri.pipelines.utils import seed_voxels
+		glm = pe.Node(interface=SeedGLM(), name='glm', mem_gb=1)
+		glm.inputs.mask = mask
+		glm.inputs.metric = metric
+		glm.inputs.highpass_cutoff = highpass_sigma or 0
+		glm.inputs.tr = tr
+		if top_voxel:
+			glm.inputs.seed_mask = seed_mask
+		else:
+			glm.inputs.seed_voxels = seed_voxels(seed_mask).tolist()
 	else:
-		glm.inputs.mask = path.abspath(path.expanduser(mask))
-	glm.interface.mem_gb = 6
+		compute_seed = pe.Node(name='compute_seed', interface=util.Function(function=ts,input_names=inspect.getargspec(ts)[0], output_names=['means','medians']))
+		compute_seed.inputs.mask = seed_mask
+
+		make_regressor = pe.Node(name='make_regressor', interface=util.Function(function=regressor,input_names=inspect.getargspec(regressor)[0], output_names=['output']))
+		make_regressor.inputs.hpf = highpass_sigma
+		make_regressor.inputs.name = 'seed'
+
+		level1design = pe.Node(interface=CachedFEATModel(), name="level1design")
+		level1design.inputs.cache_dir = path.join(workdir,'design_cache')
+		level1design.inputs.interscan_interval = tr
+		level1design.inputs.bases = {'none': {}}
+		level1design.inputs.model_serial_correlations = True
+		level1design.inputs.contrasts = [('stim','T', ['seed'],[1])]
+
+		glm = pe.Node(interface=fsl.GLM(), name='glm', iterfield='design')
+		glm.inputs.mask = mask
+		glm.interface.mem_gb = 6
 
 	try:
 		from bids.grabbids import BIDSLayout
@@ -745,18 +839,11 @@ def seed(preprocessing_dir, seed_mask,
 	design_filename = pe.Node(name='design', interface=util.Function(function=bids_dict_to_source,input_names=inspect.getargspec(bids_dict_to_source)[0], output_names=['filename']))
 	design_filename.inputs.source_format = out_file_name_base.format('design','mat')
 
-	design_rename = pe.Node(interface=util.Rename(), name='design_rename')
-
 	datasink = pe.Node(nio.DataSink(), name='datasink')
 	datasink.inputs.base_directory = path.join(out_base,workflow_name)
 	datasink.inputs.parameterization = False
 
 	workflow_connections = [
-		(make_regressor, level1design, [('output', 'session_info')]),
-		(level1design, modelgen, [('ev_files', 'ev_files')]),
-		(level1design, modelgen, [('fsf_files', 'fsf_file')]),
-		(modelgen, glm, [('design_file', 'design')]),
-		(modelgen, glm, [('con_file', 'contrasts')]),
 		(get_scan, datasink, [(('dict_slice',bids_dict_to_dir), 'container')]),
 		(get_scan, betas_filename, [('dict_slice', 'bids_dictionary')]),
 		(get_scan, cope_filename, [('dict_slice', 'bids_dictionary')]),
@@ -773,8 +860,6 @@ def seed(preprocessing_dir, seed_mask,
 		(zstat_filename, glm, [('filename', 'out_z_name')]),
 		(pstat_filename, glm, [('filename', 'out_p_name')]),
 		(pfstat_filename, glm, [('filename', 'out_pf_name')]),
-		(modelgen, design_rename, [('design_file', 'in_file')]),
-		(design_filename, design_rename, [('filename', 'format_string')]),
 		(glm, datasink, [('out_pf', '@pfstat')]),
 		(glm, datasink, [('out_p', '@pstat')]),
 		(glm, datasink, [('out_z', '@zstat')]),
@@ -782,51 +867,63 @@ def seed(preprocessing_dir, seed_mask,
 		(glm, datasink, [('out_cope', '@cope')]),
 		(glm, datasink, [('out_varcb', '@varcb')]),
 		(glm, datasink, [('out_file', '@betas')]),
-		(design_rename, datasink, [('out_file', '@design')]),
 		]
 
+	if native_glm:
+		workflow_connections.extend([
+			(design_filename, glm, [('filename', 'out_design_name')]),
+			(glm, datasink, [('out_design', '@design')]),
+			])
+	else:
+		design_rename = pe.Node(interface=util.Rename(), name='design_rename')
+		workflow_connections.extend([
+			(make_regressor, level1design, [('output', 'session_info')]),
+			(level1design, glm, [('design_file', 'design')]),
+			(level1design, glm, [('con_file', 'contrasts')]),
+			(level1design, design_rename, [('design_file', 'in_file')]),
+			(design_filename, design_rename, [('filename', 'format_string')]),
+			(design_rename, datasink, [('out_file', '@design')]),
+			])
+
 	if top_voxel:
 		voxel_filename = pe.Node(name='voxel_filename', interface=util.Function(function=bids_dict_to_source,input_names=inspect.getargspec(bids_dict_to_source)[0], output_names=['filename']))
 		voxel_filename.inputs.source_format = top_voxel
 		workflow_connections.extend([
 			(get_scan, voxel_filename, [('dict_slice', 'bids_dictionary')]),
-			(voxel_filename, compute_seed, [('filename', 'top_voxel')]),
+			(voxel_filename, glm if native_glm else compute_seed, [('filename', 'top_voxel')]),
 			])
 
-	if metric == 'mean':
-		workflow_connections.extend([
-			(compute_seed, make_regressor, [('means', 'timecourse')]),
-			])
-	elif metric == 'median':
+	if not native_glm:
 		workflow_connections.extend([
-			(compute_seed, make_regressor, [('medians', 'timecourse')]),
+			(compute_seed, make_regressor, [(metric + 's', 'timecourse')]),
 			])
-	else:
-		raise ValueError('Accepted values for the `metric` parameter are "mean" and "median". You specified {}'.format(metric))
 
 	if highpass_sigma or lowpass_sigma:
-		bandpass = pe.Node(interface=fsl.maths.TemporalFilter(), name="bandpass")
+		bandpass = pe.Node(interface=TemporalBandpass(), name="bandpass", mem_gb=1)
 		bandpass.inputs.highpass_sigma = highpass_sigma
-		bandpass.interface.mem_gb = 16
+		bandpass.inputs.max_memory_gb = bandpass.mem_gb
 		if lowpass_sigma:
 			bandpass.inputs.lowpass_sigma = lowpass_sigma
 		else:
 			bandpass.inputs.lowpass_sigma = tr
 		workflow_connections.extend([
 			(get_scan, bandpass, [('nii_path', 'in_file')]),
-			(bandpass, compute_seed, [('out_file', 'img_path')]),
-			(bandpass, make_regressor, [('out_file', 'scan_path')]),
 			(bandpass, glm, [('out_file', 'in_file')]),
 			(bandpass, datasink, [('out_file', '@ts_file')]),
 			(get_scan, bandpass, [('nii_name', 'out_file')]),
 			])
+		ts_node, ts_output = bandpass, 'out_file'
 	else:
 		workflow_connections.extend([
-			(get_scan, compute_seed, [('nii_path', 'img_path')]),
-			(get_scan, make_regressor, [('nii_path', 'scan_path')]),
 			(get_scan, glm, [('nii_path', 'in_file')]),
 			(get_scan, datasink, [('nii_path', '@ts_file')]),
 			])
+		ts_node, ts_output = get_scan, 'nii_path'
+	if not native_glm:
+		workflow_connections.extend([
+			(ts_node, compute_seed, [(ts_output, 'img_path')]),
+			(ts_node, make_regressor, [(ts_output, 'scan_path')]),
+			])
 
 
 	workflow_config = {'execution': {'crashdump_dir': path.join(out_base,'crashdump'),}}
@@ -902,6 +999,8 @@ def l2_common_effect(l1_dir,
 	target_set=[],
 	run_mode='flame12',
 	select_input_volume=None,
+	native_estimation=False,
+	permutations=0,
 	):
 	"""Determine the common effect in a sample of 3D feature maps.
 
@@ -912,6 +1011,7 @@ def l2_common_effect(l1_dir,
 		Percentage of the cores present on the machine which to maximally use for deploying jobs in parallel.
 	run_mode : {'ols', 'fe', 'flame1', 'flame12'}, optional
 		Estimation model.
+		This is only used if `native_estimation` is true, FSL's FLAMEO is always run in 'ols' mode.
 	exclude : dict, optional
 		Dictionary containing keys which are BIDS field identifiers, and values which are lists of BIDS identifier values which the user wants to exclude from the matched selection (blacklist).
 	include : dict, optional
@@ -921,6 +1021,19 @@ def l2_common_effect(l1_dir,
 	select_input_volume: int, optional
 		Select one of multiple volumes in the fourth dimension of level-1 input files.
 		This is useful for level-1 files producing multiple regressors.
+	native_estimation : bool, optional
+		Whether to estimate the model in-process (via `samri.pipelines.extra_interfaces.NativeFLAMEO`) rather than via FSL's FLAMEO.
+		The level-1 maps are then read directly, rather than merged into intermediate 4D files, and the groups are estimated in parallel with a bounded memory footprint.
+		The 'flame12' run mode is estimated as 'flame1'.
+	permutations : int, optional
+		Number of sign-flips of the level-1 maps for non-parametric inference (via `samri.pipelines.extra_interfaces.PermutationTest`), in addition to the parametric estimation.
+		The resulting t-statistics, the uncorrected and family-wise error corrected TFCE p-values, and the family-wise error corrected voxelwise p-values (all as 1-p) are saved in a `permutation` subdirectory.
+		If this evaluates as false, no permutation inference is performed.
+
+	Notes
+	-----
+
+	Level-1 results may be given either as dedicated cope and varcb files, or as consolidated statistics files (as written by `samri.pipelines.glm.l1` with `consolidate_statistics=True`), from which the copes and varcopes are read directly.
 	"""
 
 	from samri.pipelines.utils import bids_data_selection
@@ -962,15 +1075,34 @@ def l2_common_effect(l1_dir,
 	except KeyError:
 		varcopes_list=data_selection[data_selection['path'].str.contains('desc-varcb')]
 		copes_list=data_selection[data_selection['path'].str.contains('desc-cope')]
-
-	copemerge = pe.Node(interface=fsl.Merge(dimension='t'),name="copemerge")
-	varcopemerge = pe.Node(interface=fsl.Merge(dimension='t'),name="varcopemerge")
+	# Consolidated level-1 statistics files (written with `l1(consolidate_statistics=True)`) contain both the copes and varcopes.
+	consolidated = len(copes_list) == 0 and data_selection['path'].str.contains('desc-{}_'.format(GLM_STATISTICS_DESC)).any()
+	if consolidated:
+		copes_list = varcopes_list = data_selection[data_selection['path'].str.contains('desc-{}_'.format(GLM_STATISTICS_DESC))]['path'].tolist()
+		copemerge = pe.Node(name='copemerge', interface=util.Function(function=merge_statistics, input_names=inspect.getargspec(merge_statistics)[0], output_names=['merged_file']))
+		copemerge.inputs.statistic = 'cope'
+		varcopemerge = pe.Node(name='varcopemerge', interface=util.Function(function=merge_statistics, input_names=inspect.getargspec(merge_statistics)[0], output_names=['merged_file']))
+		varcopemerge.inputs.statistic = 'varcb'
+		if isinstance(select_input_volume,int):
+			copemerge.inputs.volume = select_input_volume
+			varcopemerge.inputs.volume = select_input_volume
+	else:
+		copemerge = pe.Node(interface=fsl.Merge(dimension='t'),name="copemerge")
+		varcopemerge = pe.Node(interface=fsl.Merge(dimension='t'),name="varcopemerge")
 
 	level2model = pe.Node(interface=fsl.L2Model(),name='level2model')
 
-	flameo = pe.Node(interface=fsl.FLAMEO(), name="flameo")
+	if native_estimation:
+		if run_mode != 'ols' and len(varcopes_list) == 0:
+			raise ValueError('The "{}" run mode requires level-1 varcope files, but none were found.'.format(run_mode))
+		flameo = pe.Node(interface=NativeFLAMEO(), name="flameo", mem_gb=1)
+		flameo.inputs.run_mode = run_mode
+		if isinstance(select_input_volume,int):
+			flameo.inputs.volume = select_input_volume
+	else:
+		flameo = pe.Node(interface=fsl.FLAMEO(), name="flameo")
+		flameo.inputs.run_mode = "ols"
 	flameo.inputs.mask_file = mask
-	flameo.inputs.run_mode = "ols"
 
 	datasink = pe.Node(nio.DataSink(), name='datasink')
 	datasink.inputs.base_directory = out_dir
@@ -1209,7 +1341,17 @@ def l2_common_effect(l1_dir,
 	datasink_substitutions.extend([('zstat1.nii.gz', common_fields+'_'+'zstat.nii.gz')])
 	datasink.inputs.regexp_substitutions = datasink_substitutions
 
-	if isinstance(select_input_volume,int):
+	if consolidated:
+		copes.inputs.bids_dictionary_override = dict(copes.inputs.bids_dictionary_override, desc=GLM_STATISTICS_DESC)
+		varcopes.inputs.bids_dictionary_override = dict(varcopes.inputs.bids_dictionary_override, desc=GLM_STATISTICS_DESC)
+
+	if native_estimation:
+		# The level-1 maps are read directly, and need not be merged.
+		workflow_connections = [i for i in workflow_connections if i[1] not in [copemerge, varcopemerge]]
+		workflow_connections.extend([
+			(copes, flameo, [('selection', 'cope_files')]),
+			])
+	elif isinstance(select_input_volume,int) and not consolidated:
 		from samri.pipelines.extra_functions import extract_volumes
 
 		copextract = pe.Node(name='copextract', interface=util.Function(function=extract_volumes, input_names=inspect.getargspec(extract_volumes)[0], output_names=['out_files']))
@@ -1223,15 +1365,16 @@ def l2_common_effect(l1_dir,
 		workflow_connections.extend([
 			(copes, copextract, [('selection', 'in_files')]),
 			(copextract, copemerge, [('out_files', 'in_files')]),
+			(copemerge,flameo,[('merged_file','cope_file')]),
 			])
 	else:
 		workflow_connections.extend([
 			(copes, copemerge, [('selection', 'in_files')]),
+			(copemerge,flameo,[('merged_file','cope_file')]),
 			])
 
 	workflow_connections.extend([
 		(copes, level2model, [(('selection',mylen), 'num_copes')]),
-		(copemerge,flameo,[('merged_file','cope_file')]),
 		(level2model,flameo, [('design_mat','design_file')]),
 		(level2model,flameo, [('design_grp','cov_split_file')]),
 		(level2model,flameo, [('design_con','t_con_file')]),
@@ -1241,11 +1384,15 @@ def l2_common_effect(l1_dir,
 		(flameo, datasink, [('zstats', '@zstats')]),
 		])
 
-	if len(varcopes_list) != 0:
+	if len(varcopes_list) != 0 and native_estimation:
+		workflow_connections.extend([
+			(varcopes, flameo, [('selection', 'var_cope_files')]),
+			])
+	elif len(varcopes_list) != 0:
 		workflow_connections.extend([
 			(varcopemerge,flameo,[('merged_file','var_cope_file')]),
 			])
-		if isinstance(select_input_volume,int):
+		if isinstance(select_input_volume,int) and not consolidated:
 			workflow_connections.extend([
 				(varcopes, varcopextract, [('selection', 'in_files')]),
 				(varcopextract, varcopemerge, [('out_files', 'in_files')]),
@@ -1255,6 +1402,24 @@ def l2_common_effect(l1_dir,
 				(varcopes, varcopemerge, [('selection', 'in_files')]),
 				])
 
+	n_jobs = max(int(round(mp.cpu_count()*n_jobs_percentage)),2)
+	if permutations:
+		randomise = pe.Node(interface=PermutationTest(), name="randomise", n_procs=n_jobs)
+		randomise.inputs.mask = mask
+		randomise.inputs.num_perm = permutations
+		randomise.inputs.num_threads = n_jobs
+		if isinstance(select_input_volume,int):
+			randomise.inputs.volume = select_input_volume
+		workflow_connections.extend([
+			(copes, randomise, [('selection', 'cope_files')]),
+			(level2model, randomise, [('design_mat','design_mat')]),
+			(level2model, randomise, [('design_con','tcon')]),
+			(randomise, datasink, [('tstat_files', 'permutation.@tstats')]),
+			(randomise, datasink, [('t_p_files', 'permutation.@p')]),
+			(randomise, datasink, [('t_corrected_p_files', 'permutation.@corrp')]),
+			(randomise, datasink, [('vox_corrected_p_files', 'permutation.@vox_corrp')]),
+			])
+
 	crashdump_dir = path.join(out_base,'crashdump')
 	workflow_config = {'execution': {'crashdump_dir': crashdump_dir}}
 	if debug:
@@ -1275,7 +1440,6 @@ def l2_common_effect(l1_dir,
 	except OSError:
 		print('We could not write the DOT file for visualization (`dot` function from the graphviz package). This is non-critical to the processing, but you should get this fixed.')
 
-	n_jobs = max(int(round(mp.cpu_count()*n_jobs_percentage)),2)
 	workflow.run(plugin="MultiProc", plugin_args={'n_procs' : n_jobs})
 	if not keep_crashdump:
 		try:
@@ -1303,7 +1467,8 @@ def l2_controlled_effect(l1_dir,
 	workflow_name="l2_common_effect",
 	debug=False,
 	target_set=[],
-	run_mode='flame12'
+	run_mode='flame12',
+	native_estimation=False,
 	):
 	"""Determine the common effect in a sample of 3D feature maps, as established against a specified control group.
 
@@ -1317,6 +1482,7 @@ def l2_controlled_effect(l1_dir,
 		Percentage of the cores present on the machine which to maximally use for deploying jobs in parallel.
 	run_mode : {'ols', 'fe', 'flame1', 'flame12'}, optional
 		Estimation model.
+		This is only used if `native_estimation` is true, FSL's FLAMEO is always run in 'ols' mode.
 	exclude : dict, optional
 		Dictionary containing keys which are BIDS field identifiers, and values which are lists of BIDS identifier values which the user wants to exclude from the matched selection (blacklist).
 	include : dict, optional
@@ -1325,6 +1491,10 @@ def l2_controlled_effect(l1_dir,
 		Dictionary containing keys which are BIDS field identifiers, and values which are lists of BIDS identifier values which the user wants to select.
 	control_match : dict, optional
 		Dictionary containing keys which are BIDS field identifiers, and values which are lists of BIDS identifier values which the user wants to select the control group based on.
+	native_estimation : bool, optional
+		Whether to estimate the model in-process (via `samri.pipelines.extra_interfaces.NativeFLAMEO`) rather than via FSL's FLAMEO.
+		The level-1 maps are then read directly, rather than merged into intermediate 4D files.
+		The 'flame12' run mode is estimated as 'flame1'.
 	"""
 
 	from samri.pipelines.utils import bids_data_selection
@@ -1375,9 +1545,13 @@ def l2_controlled_effect(l1_dir,
 			data_selection = data_selection[data_selection[key].isin(include[key])]
 	data_selection.to_csv(path.join(workdir,'data_selection.csv'))
 
-	flameo = pe.Node(interface=fsl.FLAMEO(), name="flameo")
+	if native_estimation:
+		flameo = pe.Node(interface=NativeFLAMEO(), name="flameo", mem_gb=1)
+		flameo.inputs.run_mode = run_mode
+	else:
+		flameo = pe.Node(interface=fsl.FLAMEO(), name="flameo")
+		flameo.inputs.run_mode = "ols"
 	flameo.inputs.mask_file = mask
-	flameo.inputs.run_mode = "ols"
 
 	datasink = pe.Node(nio.DataSink(), name='datasink')
 	datasink.inputs.base_directory = out_dir
@@ -1412,9 +1586,8 @@ def l2_controlled_effect(l1_dir,
 	#copes = copeonly['path'].tolist()
 	#varcopes = data_selection[data_selection['modality']=='varcb']['path'].tolist()
 
-	copemerge = pe.Node(interface=fsl.Merge(dimension='t'),name="copemerge")
-	copemerge.inputs.in_files = copes_list
-	copemerge.inputs.merged_file = 'copes.nii.gz'
+	if native_estimation and run_mode != 'ols' and len(varcopes_list) == 0:
+		raise ValueError('The "{}" run mode requires level-1 varcope files, but none were found.'.format(run_mode))
 
 	feature = [~copeonly['control']][0]
 	control = [not i for i in feature]
@@ -1444,7 +1617,6 @@ def l2_controlled_effect(l1_dir,
 	datasink.inputs.regexp_substitutions = datasink_substitutions
 
 	workflow_connections = [
-		(copemerge,flameo,[('merged_file','cope_file')]),
 		(level2model,flameo, [('design_mat','design_file')]),
 		(level2model,flameo, [('design_grp','cov_split_file')]),
 		(level2model,flameo, [('design_fts','f_con_file')]),
@@ -1456,7 +1628,19 @@ def l2_controlled_effect(l1_dir,
 		(flameo, datasink, [('zfstats', '@zfstats')]),
 		]
 
-	if len(varcopes_list) != 0:
+	if native_estimation:
+		# The level-1 maps are read directly, and need not be merged.
+		flameo.inputs.cope_files = copes_list
+		if len(varcopes_list) != 0:
+			flameo.inputs.var_cope_files = varcopes_list
+	else:
+		copemerge = pe.Node(interface=fsl.Merge(dimension='t'),name="copemerge")
+		copemerge.inputs.in_files = copes_list
+		copemerge.inputs.merged_file = 'copes.nii.gz'
+		workflow_connections.extend([
+			(copemerge,flameo,[('merged_file','cope_file')]),
+			])
+	if len(varcopes_list) != 0 and not native_estimation:
 		varcopemerge = pe.Node(interface=fsl.Merge(dimension='t'),name="varcopemerge")
 		varcopemerge.inputs.in_files = varcopes_list
 		varcopemerge.inputs.merged_file = 'varcopes.nii.gz'
@@ -1490,6 +1674,72 @@ def dict_and_suffix(my_dictionary,key,suffix):
 	filename = str(filename)+suffix
 	return filename
 
+def l2_batch(jobs, out_dir,
+	mask='/usr/share/mouse-brain-templates/dsurqec_200micron_mask.nii',
+	run_mode='flame1',
+	n_jobs_percentage=1,
+	statistics=['cope','tstat','zstat'],
+	block_size=16384,
+	):
+	"""Estimate many independent second-level models (e.g. for many feature map sets, or many level-1 contrasts), in one shared pool of workers.
+
+	Unlike running `l2_common_effect` once per job, this builds no workflow per job: all jobs are scheduled on the same pool of worker processes, each of which loads a mask only once for all of its jobs which use it, and the models are estimated directly (via `samri.pipelines.utils.l2_fit`).
+	The completion and timing of each job is reported as it finishes, and failing jobs do not interrupt the others.
+
+	Parameters
+	----------
+
+	jobs : list of dict
+		List of dictionaries, each of which specifies one job, with the following keys:
+		'name' (str) -- identifier of the job, from which the output file names are formed;
+		'cope_files' (list of str) -- paths to the level-1 contrast maps;
+		'var_cope_files' (list of str, optional) -- paths to the corresponding level-1 variance maps, required for all run modes but 'ols';
+		'design' and 'contrasts' (array-like, optional) -- design and t-contrast matrices, by default a one-sample mean;
+		'mask', 'run_mode', and 'volume' (optional) -- job-specific values overriding `mask`, `run_mode`, and the volume selected from 4D level-1 maps, respectively.
+	out_dir : str
+		Directory in which to save the results, as `{name}_{statistic}.nii.gz`.
+	mask : str, optional
+		Path to the NIfTI mask used for jobs which do not specify their own.
+	run_mode : {'ols', 'fe', 'flame1', 'flame12'}, optional
+		Estimation model used for jobs which do not specify their own.
+	n_jobs_percentage : float, optional
+		Percentage of the cores present on the machine which to maximally use for running jobs in parallel.
+	statistics : list of str, optional
+		Statistics to save for each job, any of 'pe', 'cope', 'varcope', 'tstat', 'zstat', 'fstat', 'zfstat', and 'mrefvars'.
+	block_size : int, optional
+		Number of voxels for which to compute the estimates of a job at any one time.
+
+	Returns
+	-------
+
+	pandas.DataFrame : Summary with one row per job, containing the job name, its status ('completed' or 'failed'), its duration in seconds, the error message of failed jobs, and one column per saved statistic, containing the output paths.
+	"""
+
+	import time
+	from joblib import Parallel, delayed
+	from samri.pipelines.utils import _l2_batch_job
+
+	out_dir = path.abspath(path.expanduser(out_dir))
+	if not os.path.exists(out_dir):
+		os.makedirs(out_dir)
+
+	total = len(jobs)
+	batch_start = time.time()
+	n_jobs = max(int(round(mp.cpu_count()*n_jobs_percentage)),1)
+	# The estimation (notably the voxelwise REML loop of 'flame1') is largely pure Python, and thus needs separate processes to run in parallel.
+	results = Parallel(n_jobs=n_jobs, verbose=0, return_as='generator_unordered')(
+		delayed(_l2_batch_job)(position, job, out_dir, mask, run_mode, statistics, block_size) for position, job in enumerate(jobs)
+		)
+	records = [None] * total
+	for finished, (position, record) in enumerate(results, 1):
+		records[position] = record
+		print('[{}/{}] Job "{}" {} in {:.1f} s.{}'.format(finished, total, record['name'], record['status'], record['seconds'],
+			' ' + record['error'] if record['error'] else '',
+			))
+	summary = pd.DataFrame(records, columns=['name', 'status', 'seconds', 'error'] + list(statistics))
+	print('{} of {} jobs completed in {:.1f} s.'.format((summary['status'] == 'completed').sum(), total, time.time() - batch_start))
+	return summary
+
 def l2_anova(l1_dir,
 	keep_work=False,
 	l2_dir="",
@@ -1501,8 +1751,50 @@ def l2_anova(l1_dir,
 	n_jobs_percentage=1,
 	exclude={},
 	include={},
-	match_regex='.+/sub-(?P<sub>[a-zA-Z0-9]+)/ses-(?P<ses>[a-zA-Z0-9]+)/.*?_acq-(?P<acq>[a-zA-Z0-9]+)_task-(?P<task>[a-zA-Z0-9]+)_(?P<mod>[a-zA-Z0-9]+)_(?P<stat>(cope|varcb)+)\.(?:nii|nii\.gz)'
+	match_regex='.+/sub-(?P<sub>[a-zA-Z0-9]+)/ses-(?P<ses>[a-zA-Z0-9]+)/.*?_acq-(?P<acq>[a-zA-Z0-9]+)_task-(?P<task>[a-zA-Z0-9]+)_(?P<mod>[a-zA-Z0-9]+)_(?P<stat>(cope|varcb)+)\.(?:nii|nii\.gz)',
+	permutations=0,
+	native_estimation=False,
 	):
+	"""Determine the session effects in a sample of 3D feature maps, controlling for subject.
+
+	Parameters
+	----------
+
+	l1_dir : str
+		Directory containing the level-1 cope and varcb files.
+	keep_work : bool, optional
+		Whether to keep the work directory after the workflow has run.
+	l2_dir : str, optional
+		Directory in which to create the output and work directories.
+		If unspecified, this is the `l2` directory two levels above `l1_dir`.
+	loud : bool, optional
+		Unused, kept for compatibility.
+	tr : int, optional
+		Unused, kept for compatibility.
+	keep_crashdump : bool, optional
+		Whether to keep the crashdump directory after the workflow has run.
+	workflow_name : str, optional
+		Name of the output directory (under `l2_dir`).
+	mask : str, optional
+		Path to the mask within which to estimate the model.
+	n_jobs_percentage : float, optional
+		Percentage of the cores present on the machine which to maximally use for deploying jobs in parallel.
+	exclude : dict, optional
+		Dictionary containing keys which are BIDS field identifiers, and values which are lists of BIDS identifier values which the user wants to exclude from the matched selection (blacklist).
+	include : dict, optional
+		Dictionary containing keys which are BIDS field identifiers, and values which are lists of BIDS identifier values which the user wants to include from the matched selection (whitelist).
+	match_regex : str, optional
+		Regular expression with `sub`, `ses`, `acq`, `task`, `mod`, and `stat` groups, against which the paths of the level-1 files are matched.
+	permutations : int, optional
+		Number of sign-flips of the level-1 maps for non-parametric inference on the session t-contrasts (via `samri.pipelines.extra_interfaces.PermutationTest`), in addition to the parametric estimation.
+		The resulting t-statistics, the uncorrected and family-wise error corrected TFCE p-values, and the family-wise error corrected voxelwise p-values (all as 1-p) are saved in a `permutation` subdirectory.
+		If this evaluates as false, no permutation inference is performed.
+	native_estimation : bool, optional
+		Whether to estimate the model in-process (via `samri.pipelines.extra_interfaces.NativeFLAMEO`) rather than via FSL's FLAMEO.
+		The level-1 maps are then read once into a single masked stack, rather than merged into intermediate 4D files, and all session t-contrasts and the F-test are evaluated from one fit.
+		The 'flame12' run mode is estimated as 'flame1'.
+	"""
+	from samri.pipelines.utils import anova_design
 
 	l1_dir = path.expanduser(l1_dir)
 	if not l2_dir:
@@ -1530,37 +1822,27 @@ def l2_anova(l1_dir,
 	copes = data_selection[data_selection['modality']=='cope']['path'].tolist()
 	varcopes = data_selection[data_selection['modality']=='varcb']['path'].tolist()
 
-	copemerge = pe.Node(interface=fsl.Merge(dimension='t'),name="copemerge")
-	copemerge.inputs.in_files = copes
-	copemerge.inputs.merged_file = 'copes.nii.gz'
-
-	varcopemerge = pe.Node(interface=fsl.Merge(dimension='t'),name="varcopemerge")
-	varcopemerge.inputs.in_files = varcopes
-	varcopemerge.inputs.merged_file = 'varcopes.nii.gz'
-
 	copeonly = data_selection[data_selection['modality']=='cope']
-	regressors = {}
-	for sub in copeonly['subject'].unique():
-		regressor = [copeonly['subject'] == sub][0]
-		regressor = [int(i) for i in regressor]
-		key = "sub-"+str(sub)
-		regressors[key] = regressor
-	reference = str(copeonly['session'].unique()[0])
-	for ses in copeonly['session'].unique()[1:]:
-		regressor = [copeonly['session'] == ses][0]
-		regressor = [int(i) for i in regressor]
-		key = "ses-("+str(ses)+'-'+reference+')'
-		regressors[key] = regressor
-
-	sessions = [[i,'T',[i], [1]] for i in regressors.keys() if "ses-" in i]
-	contrasts = deepcopy(sessions)
-	contrasts.append(['anova', 'F', sessions])
+	regressors, contrasts = anova_design(copeonly, 'session', block='subject')
 
 	level2model = pe.Node(interface=fsl.MultipleRegressDesign(),name='level2model')
 	level2model.inputs.regressors = regressors
 	level2model.inputs.contrasts = contrasts
 
-	flameo = pe.Node(interface=fsl.FLAMEO(), name="flameo")
+	if native_estimation:
+		flameo = pe.Node(interface=NativeFLAMEO(), name="flameo", mem_gb=1)
+		flameo.inputs.cope_files = copes
+		flameo.inputs.var_cope_files = varcopes
+	else:
+		copemerge = pe.Node(interface=fsl.Merge(dimension='t'),name="copemerge")
+		copemerge.inputs.in_files = copes
+		copemerge.inputs.merged_file = 'copes.nii.gz'
+
+		varcopemerge = pe.Node(interface=fsl.Merge(dimension='t'),name="varcopemerge")
+		varcopemerge.inputs.in_files = varcopes
+		varcopemerge.inputs.merged_file = 'varcopes.nii.gz'
+
+		flameo = pe.Node(interface=fsl.FLAMEO(), name="flameo")
 	flameo.inputs.mask_file = mask
 	# Using 'fe' instead of 'ols' is recommended (https://dpaniukov.github.io/2016/07/14/three-level-analysis-with-fsl-and-ants-2.html)
 	# This has also been tested in SAMRI and shown to give better estimates.
@@ -1584,8 +1866,6 @@ def l2_anova(l1_dir,
 	datasink.inputs.substitutions = substitutions
 
 	workflow_connections = [
-		(copemerge,flameo,[('merged_file','cope_file')]),
-		(varcopemerge,flameo,[('merged_file','var_cope_file')]),
 		(level2model,flameo, [('design_mat','design_file')]),
 		(level2model,flameo, [('design_grp','cov_split_file')]),
 		(level2model,flameo, [('design_fts','f_con_file')]),
@@ -1596,6 +1876,27 @@ def l2_anova(l1_dir,
 		(flameo, datasink, [('fstats', '@fstats')]),
 		(flameo, datasink, [('zfstats', '@zfstats')]),
 		]
+	if not native_estimation:
+		workflow_connections.extend([
+			(copemerge,flameo,[('merged_file','cope_file')]),
+			(varcopemerge,flameo,[('merged_file','var_cope_file')]),
+			])
+
+	n_jobs = max(int(round(mp.cpu_count()*n_jobs_percentage)),2)
+	if permutations:
+		randomise = pe.Node(interface=PermutationTest(), name="randomise", n_procs=n_jobs)
+		randomise.inputs.cope_files = copes
+		randomise.inputs.mask = mask
+		randomise.inputs.num_perm = permutations
+		randomise.inputs.num_threads = n_jobs
+		workflow_connections.extend([
+			(level2model, randomise, [('design_mat','design_mat')]),
+			(level2model, randomise, [('design_con','tcon')]),
+			(randomise, datasink, [('tstat_files', 'permutation.@tstats')]),
+			(randomise, datasink, [('t_p_files', 'permutation.@p')]),
+			(randomise, datasink, [('t_corrected_p_files', 'permutation.@corrp')]),
+			(randomise, datasink, [('vox_corrected_p_files', 'permutation.@vox_corrp')]),
+			])
 
 	workdir_name = workflow_name+"_work"
 	workflow = pe.Workflow(name=workdir_name)
@@ -1608,7 +1909,6 @@ def l2_anova(l1_dir,
 	except OSError:
 		print('We could not write the DOT file for visualization (`dot` function from the graphviz package). This is non-critical to the processing, but you should get this fixed.')
 
-	n_jobs = max(int(round(mp.cpu_count()*n_jobs_percentage)),2)
 	workflow.run(plugin="MultiProc", plugin_args={'n_procs' : n_jobs})
 	if not keep_crashdump:
 		try:
@@ -3,6 +3,7 @@ from os import path
 import nipype.pipeline.engine as pe
 import nipype.interfaces.ants as ants
 from nipype.interfaces import fsl
+from samri.pipelines.extra_interfaces import ChunkedApplyTransforms, CroppedRegistration
 from samri.pipelines.utils import GENERIC_PHASES
 
 def autorotate(template,
@@ -81,13 +82,13 @@ def structural_registration(template,
         s_registration.inputs.fixed_image_masks = [path.abspath(path.expanduser(structural_mask))]
     s_registration.inputs.num_threads = num_threads
 
-	s_warp = pe.Node(ants.ApplyTransforms(), name="s_warp")
-	s_warp.inputs.reference_image = path.abspath(path.expanduser(template))
-	s_warp.inputs.input_image_type = 3
-	s_warp.inputs.interpolation = 'NearestNeighbor'
-	s_warp.inputs.invert_transform_flags = [False]
-	s_warp.inputs.terminal_output = 'file'
-	s_warp.num_threads = num_threads
+    s_warp = pe.Node(ants.ApplyTransforms(), name="s_warp")
+    s_warp.inputs.reference_image = path.abspath(path.expanduser(template))
+    s_warp.inputs.input_image_type = 3
+    s_warp.inputs.interpolation = 'NearestNeighbor'
+    s_warp.inputs.invert_transform_flags = [False]
+    s_warp.inputs.terminal_output = 'file'
+    s_warp.num_threads = num_threads
 
     # registration = pe.Node(ants.Registration(), name="s_register")
     # registration.inputs.fixed_image = path.abspath(path.expanduser(template))
@@ -153,6 +154,8 @@ def generic_registration(template,
 	phase_dictionary=GENERIC_PHASES,
 	s_phases=['s_translation','similarity','affine','syn'],
 	f_phases=['f_translation',],
+	f_warp_method='ants',
+	crop_to_mask=False,
 	):
 
 	s_phases = [phase for phase in s_phases if phase in phase_dictionary]
@@ -160,7 +163,11 @@ def generic_registration(template,
 
 	s_parameters = [phase_dictionary[selection] for selection in s_phases]
 
-	s_registration = pe.Node(ants.Registration(), name="s_register")
+	if crop_to_mask and structural_mask:
+		s_registration = pe.Node(CroppedRegistration(), name="s_register")
+		s_registration.inputs.crop_mask = path.abspath(path.expanduser(structural_mask))
+	else:
+		s_registration = pe.Node(ants.Registration(), name="s_register")
 	s_registration.inputs.fixed_image = path.abspath(path.expanduser(template))
 	s_registration.inputs.output_transform_prefix = "output_"
 	s_registration.inputs.transforms = [i["transforms"] for i in s_parameters] ##
@@ -223,14 +230,18 @@ def generic_registration(template,
 
 	#f_warp = pe.Node(ants.WarpTimeSeriesImageMultiTransform(), name='f_warp')
 	#f_warp.inputs.dimension = 4
-	f_warp = pe.Node(ants.ApplyTransforms(), name="f_warp")
+	if f_warp_method == 'native':
+		f_warp = pe.Node(ChunkedApplyTransforms(), name="f_warp", mem_gb=1)
+		f_warp.inputs.num_threads = num_threads
+		f_warp.inputs.max_memory_gb = f_warp.mem_gb
+	else:
+		f_warp = pe.Node(ants.ApplyTransforms(), name="f_warp", mem_gb=16)
+		f_warp.inputs.input_image_type = 3
 	f_warp.inputs.reference_image = path.abspath(path.expanduser(template))
-	f_warp.inputs.input_image_type = 3
 	f_warp.inputs.interpolation = 'BSpline'
 	f_warp.inputs.interpolation_parameters = (5,)
 	f_warp.inputs.invert_transform_flags = [False, False]
 	f_warp.num_threads = num_threads
-	f_warp.interface.mem_gb = 16
 
 	s_warp = pe.Node(ants.ApplyTransforms(), name="s_warp")
 	s_warp.inputs.reference_image = path.abspath(path.expanduser(template))
@@ -260,6 +271,7 @@ def functional_registration(template,
 	num_threads=4,
 	phase_dictionary=GENERIC_PHASES,
 	f_phases=["f_only_translation",'similarity',"affine","syn"],
+	f_warp_method='ants',
 	):
 
 	template = path.abspath(path.expanduser(template))
@@ -295,14 +307,18 @@ def functional_registration(template,
 		f_registration.inputs.fixed_image_masks = [path.abspath(path.expanduser(mask))]
 	f_registration.inputs.num_threads = num_threads
 
-	warp = pe.Node(ants.ApplyTransforms(), name="f_warp")
+	if f_warp_method == 'native':
+		warp = pe.Node(ChunkedApplyTransforms(), name="f_warp", mem_gb=1)
+		warp.inputs.num_threads = num_threads
+		warp.inputs.max_memory_gb = warp.mem_gb
+	else:
+		warp = pe.Node(ants.ApplyTransforms(), name="f_warp", mem_gb=16)
+		warp.inputs.input_image_type = 3
 	warp.inputs.reference_image = template
-	warp.inputs.input_image_type = 3
 	warp.inputs.interpolation = 'NearestNeighbor'
 	warp.inputs.invert_transform_flags = [False]
 	#warp.inputs.terminal_output = 'file'
 	warp.num_threads = num_threads
-	warp.interface.mem_gb = 16
 
 	return f_registration, warp
 
@@ -17,11 +17,11 @@ from nipype.interfaces import ants, afni, bru2nii, fsl, nipy, spm
 
 from samri.fetch.templates import fetch_rat_waxholm
 from samri.pipelines.extra_functions import corresponding_physiofile, get_bids_scan, write_bids_events_file, \
-    force_dummy_scans, BIDS_METADATA_EXTRACTION_DICTS
-from samri.pipelines.extra_interfaces import VoxelResize, FSLOrient
+    compress_nifti, force_dummy_scans, BIDS_METADATA_EXTRACTION_DICTS
+from samri.pipelines.extra_interfaces import VoxelResize, FSLOrient, TemporalMean, DeliveryDataSink
 from samri.pipelines.nodes import *
 from samri.pipelines.utils import bids_data_selection, copy_bids_files, fslmaths_invert_values, ss_to_path, \
-    GENERIC_PHASES
+    nifti_extension, set_nifti_output_type, GENERIC_PHASES
 
 DUMMY_SCANS = 10
 
@@ -39,7 +39,10 @@ def divideby_10(x):
 @argh.arg('-s', '--structural-match', type=json.loads)
 @argh.arg('-m', '--registration-mask')
 def legacy(bids_base, template,
+           compress_intermediates=True,
+           compresslevel=6,
            debug=False,
+           delivery=None,
            functional_blur_xy=False,
            functional_match={},
            keep_work=False,
@@ -65,9 +68,19 @@ def legacy(bids_base, template,
 		Path to the BIDS data set root.
 	template : str
 		Path to the template to register the data to.
+	compress_intermediates : bool, optional
+		Whether to write gzip-compressed intermediate files in the work directory.
+		Uncompressed intermediates take up more disk space but save the (de)compression time at every processing step; final outputs are written compressed either way.
+	compresslevel : int, optional
+		Gzip compression level, from 1 (fastest) to 9 (smallest), at which the final outputs are compressed if `compress_intermediates` is `False`.
 	debug : bool, optional
 		Whether to enable nipype debug mode.
 		This increases logging.
+	delivery : {'hardlink', 'reflink', 'copy'}, optional
+		How to deliver the results from the work directory to the output directory.
+		'hardlink' and 'reflink' avoid duplicating the data on disk and fall back to copying if the work and output directories are on different file systems.
+		Hardlinked outputs share their data with the work directory files, so that modifying either modifies both.
+		If unspecified, results are hardlinked if the work directory is removed (i.e. if `keep_work` is `False`), and copied otherwise.
 	exclude : dict
 		A dictionary with any combination of "sessions", "subjects", "tasks" as keys and corresponding identifiers as values.
 		If this is specified matching entries will be excluded in the analysis.
@@ -129,6 +142,8 @@ def legacy(bids_base, template,
     if not n_jobs:
         n_jobs = max(int(round(mp.cpu_count() * n_jobs_percentage)), 2)
 
+    nii_extension = nifti_extension(compress_intermediates)
+
     get_f_scan = pe.Node(name='get_f_scan', interface=util.Function(function=get_bids_scan,
                                                                     input_names=inspect.getargspec(get_bids_scan)[0],
                                                                     output_names=['scan_path', 'scan_type', 'task',
@@ -146,11 +161,13 @@ def legacy(bids_base, template,
                                                                           0],
                                                                       output_names=['out_file', 'deleted_scans']))
     dummy_scans.inputs.desired_dummy_scans = enforce_dummy_scans
+    dummy_scans.inputs.out_file = 'forced_dummy_scans_file' + nii_extension
 
     events_file = pe.Node(name='events_file', interface=util.Function(function=write_bids_events_file, input_names=
     inspect.getargspec(write_bids_events_file)[0], output_names=['out_file']))
 
-    temporal_mean = pe.Node(interface=fsl.MeanImage(), name="temporal_mean")
+    temporal_mean = pe.Node(interface=TemporalMean(), name="temporal_mean")
+    temporal_mean.inputs.out_file = 'mean' + nii_extension
 
     f_resize = pe.Node(interface=VoxelResize(), name="f_resize")
     f_resize.inputs.resize_factors = [10, 10, 10]
@@ -172,7 +189,10 @@ def legacy(bids_base, template,
     f_deleteorient = pe.Node(interface=FSLOrient(), name="f_deleteorient")
     f_deleteorient.inputs.main_option = 'deleteorient'
 
-    datasink = pe.Node(nio.DataSink(), name='datasink')
+    if delivery is None:
+        delivery = 'copy' if keep_work else 'hardlink'
+    datasink = pe.Node(DeliveryDataSink(), name='datasink')
+    datasink.inputs.delivery = delivery
     datasink.inputs.base_directory = out_dir
     datasink.inputs.parameterization = False
 
@@ -276,10 +296,21 @@ def legacy(bids_base, template,
         ])
     else:
 
-        f_rename = pe.Node(util.Rename(), name='f_rename')
+        if compress_intermediates:
+            f_rename = pe.Node(util.Rename(), name='f_rename')
+            workflow_connections.extend([
+                (get_f_scan, f_rename, [('nii_name', 'format_string')]),
+            ])
+        else:
+            f_rename = pe.Node(name='f_rename', interface=util.Function(function=compress_nifti,
+                                                                          input_names=inspect.getargspec(compress_nifti)[0],
+                                                                          output_names=['out_file']))
+            f_rename.inputs.compresslevel = compresslevel
+            workflow_connections.extend([
+                (get_f_scan, f_rename, [('nii_name', 'out_file')]),
+            ])
 
         workflow_connections.extend([
-            (get_f_scan, f_rename, [('nii_name', 'format_string')]),
             (f_copysform2qform, f_rename, [('out_file', 'in_file')]),
             (f_rename, datasink, [('out_file', 'func')]),
         ])
@@ -300,6 +331,7 @@ def legacy(bids_base, template,
     workflow.connect(workflow_connections)
     workflow.base_dir = out_base
     workflow.config = workflow_config
+    set_nifti_output_type(workflow, compress_intermediates)
     try:
         workflow.write_graph(dotfilename=path.join(workflow.base_dir, workdir_name, "graph.dot"),
                              graph2use="hierarchical", format="png")
@@ -333,16 +365,20 @@ def legacy(bids_base, template,
 @argh.arg('-m', '--registration-mask')
 def generic(bids_base, template,
             autorotate=False,
+            compress_intermediates=True,
             debug=False,
+            delivery=None,
             functional_blur_xy=False,
             functional_match={},
             functional_registration_method="composite",
+            functional_warp_method="ants",
             keep_work=False,
             n_jobs=False,
             n_jobs_percentage=0.8,
             out_base=None,
             realign="time",
             registration_mask="",
+            registration_crop=False,
             sessions=[],
             structural_match={},
             subjects=[],
@@ -365,9 +401,17 @@ def generic(bids_base, template,
 	autorotate : bool, optional
 		Whether to use a multi-rotation-state transformation start.
 		This allows the registration to commence with the best rotational fit, and may help if the orientation of the data is malformed with respect to the header.
+	compress_intermediates : bool, optional
+		Whether to write gzip-compressed intermediate files in the work directory.
+		Uncompressed intermediates take up more disk space but save the (de)compression time at every processing step; final outputs are written compressed either way.
 	debug : bool, optional
 		Whether to enable nipype debug mode.
 		This increases logging.
+	delivery : {'hardlink', 'reflink', 'copy'}, optional
+		How to deliver the results from the work directory to the output directory.
+		'hardlink' and 'reflink' avoid duplicating the data on disk and fall back to copying if the work and output directories are on different file systems.
+		Hardlinked outputs share their data with the work directory files, so that modifying either modifies both.
+		If unspecified, results are hardlinked if the work directory is removed (i.e. if `keep_work` is `False`), and copied otherwise.
 	exclude : dict
 		A dictionary with any combination of "sessions", "subjects", "tasks" as keys and corresponding identifiers as values.
 		If this is specified matching entries will be excluded in the analysis.
@@ -380,6 +424,9 @@ def generic(bids_base, template,
 	functional_registration_method : {'composite','functional','structural'}, optional
 		How to register the functional scan to the template.
 		Values mean the following: 'composite' that it will be registered to the structural scan which will in turn be registered to the template, 'functional' that it will be registered directly, 'structural' that it will be registered exactly as the structural scan.
+	functional_warp_method : {'ants','native'}, optional
+		How to apply the registration transforms to the functional time series.
+		'ants' uses `antsApplyTransforms` on the whole 4D image, 'native' composes the transforms into a single displacement field and resamples the series in-process, in chunks of volumes (see `samri.pipelines.extra_interfaces.ChunkedApplyTransforms`), which bounds memory usage and avoids writing the full series through ANTs.
 	keep_work : bool, str
 		Whether to keep the work directory after workflow conclusion (this directory contains all the intermediary processing commands, inputs, and outputs --- it is invaluable for debugging but many times larger in size than the actual output).
 	n_jobs : int, optional
@@ -393,6 +440,9 @@ def generic(bids_base, template,
 	registration_mask : str, optional
 		Mask to use for the registration process.
 		This mask will constrain the area for similarity metric evaluation, but the data will not be cropped.
+	registration_crop : bool, optional
+		Whether to crop the template to the (dilated) extent of `registration_mask`, and the structural scan to the extent of its foreground, before structural registration.
+		This reduces the number of voxels processed at every registration stage, the resulting transforms apply unchanged to the uncropped data.
 	sessions : list, optional
 		A whitelist of sessions to include in the workflow, if the list is empty there is no whitelist and all sessions will be considered.
 	structural_match : dict, optional
@@ -423,6 +473,8 @@ def generic(bids_base, template,
     if not n_jobs:
         n_jobs = max(int(round(mp.cpu_count() * n_jobs_percentage)), 2)
 
+    nii_extension = nifti_extension(compress_intermediates)
+
     find_physio = pe.Node(name='find_physio', interface=util.Function(function=corresponding_physiofile, input_names=
     inspect.getargspec(corresponding_physiofile)[0], output_names=['physiofile', 'meta_physiofile']))
 
@@ -443,11 +495,15 @@ def generic(bids_base, template,
                                                                           0],
                                                                       output_names=['out_file', 'deleted_scans']))
     dummy_scans.inputs.desired_dummy_scans = enforce_dummy_scans
+    dummy_scans.inputs.out_file = 'forced_dummy_scans_file' + nii_extension
 
     events_file = pe.Node(name='events_file', interface=util.Function(function=write_bids_events_file, input_names=
     inspect.getargspec(write_bids_events_file)[0], output_names=['out_file']))
 
-    datasink = pe.Node(nio.DataSink(), name='datasink')
+    if delivery is None:
+        delivery = 'copy' if keep_work else 'hardlink'
+    datasink = pe.Node(DeliveryDataSink(), name='datasink')
+    datasink.inputs.delivery = delivery
     datasink.inputs.base_directory = out_dir
     datasink.inputs.parameterization = False
 
@@ -513,6 +569,8 @@ def generic(bids_base, template,
         s_register, s_warp, f_register, f_warp = generic_registration(template,
                                                                       structural_mask=registration_mask,
                                                                       phase_dictionary=phase_dictionary,
+                                                                      f_warp_method=functional_warp_method,
+                                                                      crop_to_mask=registration_crop,
                                                                       )
         # TODO: incl. in func registration
         if autorotate:
@@ -560,7 +618,8 @@ def generic(bids_base, template,
     elif functional_registration_method == "composite":
         if not structural_scan_types.any():
             raise ValueError('The option `registration="composite"` requires there to be a structural scan type.')
-        temporal_mean = pe.Node(interface=fsl.MeanImage(), name="temporal_mean")
+        temporal_mean = pe.Node(interface=TemporalMean(), name="temporal_mean")
+        temporal_mean.inputs.out_file = 'mean' + nii_extension
 
         merge = pe.Node(util.Merge(2), name='merge')
 
@@ -593,9 +652,10 @@ def generic(bids_base, template,
                 (dummy_scans, f_warp, [('out_file', 'input_image')]),
             ])
     elif functional_registration_method == "functional":
-        f_register, f_warp = functional_registration(template)
+        f_register, f_warp = functional_registration(template, f_warp_method=functional_warp_method)
 
-        temporal_mean = pe.Node(interface=fsl.MeanImage(), name="temporal_mean")
+        temporal_mean = pe.Node(interface=TemporalMean(), name="temporal_mean")
+        temporal_mean.inputs.out_file = 'mean' + nii_extension
 
         # f_cutoff = pe.Node(interface=fsl.ImageMaths(), name="f_cutoff")
         # f_cutoff.inputs.op_string = "-thrP 30"
@@ -663,6 +723,7 @@ def generic(bids_base, template,
     workflow.connect(workflow_connections)
     workflow.base_dir = out_base
     workflow.config = workflow_config
+    set_nifti_output_type(workflow, compress_intermediates)
     try:
         workflow.write_graph(dotfilename=path.join(workflow.base_dir, workdir_name, "graph.dot"),
                              graph2use="hierarchical", format="png")
@@ -1106,7 +1167,7 @@ def structural(bids_base, template,
     elif functional_registration_method == "functional":
         f_register, f_warp = functional_registration(template)
 
-        temporal_mean = pe.Node(interface=fsl.MeanImage(), name="temporal_mean")
+        temporal_mean = pe.Node(interface=TemporalMean(), name="temporal_mean")
 
         # f_cutoff = pe.Node(interface=fsl.ImageMaths(), name="f_cutoff")
         # f_cutoff.inputs.op_string = "-thrP 30"
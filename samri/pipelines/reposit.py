@@ -1,5 +1,5 @@
 from os import path, remove
-from samri.pipelines.extra_functions import flip_if_needed, get_data_selection, get_bids_scan, write_bids_metadata_file, write_bids_events_file, write_bids_physio_file, BIDS_METADATA_EXTRACTION_DICTS
+from samri.pipelines.extra_functions import _bruker_scan_signature, compress_nifti, flip_if_needed, get_data_selection, get_bids_scan, write_bids_metadata_file, write_bids_events_file, write_bids_physio_file, BIDS_METADATA_EXTRACTION_DICTS
 import os
 
 import argh
@@ -16,8 +16,8 @@ import nipype.pipeline.engine as pe
 import pandas as pd
 #from nipype.interfaces.bru2nii import Bru2
 
-from samri.pipelines.utils import sessions_file, ss_to_path
-from samri.pipelines.extra_interfaces import Bru2
+from samri.pipelines.utils import is_not_prone, is_prone, sessions_file, ss_to_path
+from samri.pipelines.extra_interfaces import Bru2, DeliveryDataSink, NativeBru2
 from samri.utilities import N_PROCS
 
 try:
@@ -27,6 +27,87 @@ except NameError:
 
 N_PROCS=max(N_PROCS-4, 2)
 
+def _samri_version():
+	"""Installed SAMRI version, or None if it cannot be determined."""
+	try:
+		from importlib.metadata import version, PackageNotFoundError
+	except ImportError:
+		return None
+	try:
+		return version('samri')
+	except PackageNotFoundError:
+		return None
+
+def _conversion_outputs(data_selection, ind, measurements_base, out_dir, datatype, extra):
+	"""Source scan directory and potential BIDS output paths of a `bru2bids` scan conversion."""
+	scan_path, _, _, _, nii_name, eventfile_name, subject_session, metadata_filename, _, _ = get_bids_scan(data_selection,
+		bids_base=measurements_base,
+		ind_type=ind,
+		extra=extra,
+		)
+	outputs = [nii_name+'.nii.gz', metadata_filename]
+	if datatype == 'func':
+		physio_name = '_'.join([i for i in nii_name.split('_') if '-' in i])
+		outputs.extend([eventfile_name, physio_name+'_physio.tsv.gz', physio_name+'_physio.json'])
+	outputs = [path.join(out_dir, ss_to_path(subject_session), datatype, i) for i in outputs]
+	return scan_path, outputs
+
+def _pending_conversions(data_selection, inds, conversions, measurements_base, out_dir, datatype, extra, samri_version):
+	"""Select the scans which were not yet converted, or whose source or SAMRI version changed since conversion.
+
+	Returns
+	-------
+
+	pending : list
+		Indices of `data_selection` entries to be converted.
+	records : dict
+		Manifest records for the pending scans, keyed by index, which are to be completed with the outputs once converted.
+	"""
+	pending = []
+	records = {}
+	for ind in inds:
+		scan_path, outputs = _conversion_outputs(data_selection, ind, measurements_base, out_dir, datatype, extra)
+		signature = _bruker_scan_signature(scan_path)
+		key = '{}:{}'.format(datatype, scan_path)
+		record = conversions.get(key)
+		if record \
+				and record['signature'] == signature \
+				and record['samri_version'] == samri_version \
+				and record['outputs'] \
+				and all(path.exists(i) for i in record['outputs']):
+			continue
+		pending.append(ind)
+		records[ind] = {
+			'key':key,
+			'source':scan_path,
+			'signature':signature,
+			'samri_version':samri_version,
+			'outputs':outputs,
+			}
+	return pending, records
+
+def _record_conversions(records, conversions, run_start):
+	"""Add the manifest records of the scans which were converted in the current run to `conversions`.
+
+	A scan only counts as converted if its NIfTI file (the first output) was written after `run_start`, as the outputs of a previous conversion remain in place if the reconversion of a modified scan fails.
+	"""
+	for datatype_records in records.values():
+		for record in datatype_records.values():
+			if not path.exists(record['outputs'][0]) or path.getmtime(record['outputs'][0]) < run_start:
+				continue
+			key = record.pop('key')
+			record['outputs'] = [i for i in record['outputs'] if path.exists(i)]
+			conversions[key] = record
+	return conversions
+
+def _bids_datasink(out_dir, delivery, name):
+	"""Create a per-modality datasink, since a single node can only receive one `container` connection."""
+	datasink = pe.Node(DeliveryDataSink(), name=name)
+	datasink.inputs.delivery = delivery
+	datasink.inputs.base_directory = out_dir
+	datasink.inputs.parameterization = False
+	return datasink
+
 @argh.arg('-e','--exclude', type=json.loads)
 @argh.arg('-d','--diffusion-match', type=json.loads)
 @argh.arg('-f','--functional-match', type=json.loads)
@@ -34,19 +115,24 @@ N_PROCS=max(N_PROCS-4, 2)
 @argh.arg('-m','--measurements', nargs='*', type=str)
 def bru2bids(measurements_base,
 	bids_extra=['acq','run'],
+	compress_intermediates=True,
+	compresslevel=6,
 	dataset_authors=[],
 	dataset_funding=[],
 	dataset_license='',
 	dataset_name=False,
 	debug=False,
+	delivery=None,
 	diffusion_match={},
 	exclude={},
 	functional_match={},
+	incremental=False,
 	inflated_size=False,
 	keep_crashdump=False,
 	keep_work=False,
 	measurements=[],
 	n_procs=N_PROCS,
+	native_conversion=False,
 	out_base=None,
 	structural_match={},
 	workflow_name='bids',
@@ -63,6 +149,13 @@ def bru2bids(measurements_base,
 	bids_extra : list, optional
 		List of strings denoting optional BIDS fields to include in the resulting file names.
 		Accepted items are 'acq' and 'run'.
+	compress_intermediates : bool, optional
+		Whether the scans should be converted to gzip-compressed NIfTI files in the work directory.
+		If `False`, scans are converted uncompressed, and compressed only once, when they are delivered to the output directory (after potential flipping).
+		Functional and structural scans which need to be flipped are always converted uncompressed, and compressed only when flipped.
+	compresslevel : int, optional
+		Gzip compression level, from 1 (fastest) to 9 (smallest), at which the delivered scans are compressed.
+		Files compressed by the `Bru2` executable (i.e. if `compress_intermediates` is `True` and `native_conversion` is `False`) are only recompressed at this level if they need to be flipped.
 	dataset_authors : list of string, optional
 		A list of dataset author names, which will be written into the BIDS metadata file.
 		Generally not needed, unless this is important for you.
@@ -77,6 +170,11 @@ def bru2bids(measurements_base,
 	debug : bool, optional
 		Whether to enable debug support.
 		This prints the data selection before passing it to the nipype workflow management system, and turns on debug support in nipype (leading to more verbose logging).
+	delivery : {'hardlink', 'reflink', 'copy'}, optional
+		How to deliver the results from the work directory to the output directory.
+		'hardlink' and 'reflink' avoid duplicating the data on disk and fall back to copying if the work and output directories are on different file systems.
+		Hardlinked outputs share their data with the work directory files, so that modifying either modifies both.
+		If unspecified, results are hardlinked if the work directory is removed (i.e. if `keep_work` is `False`), and copied otherwise.
 	diffusion_match : dict, optional
 		A dictionary with any combination of "session", "subject", "task", and "acquisition" as keys and corresponding lists of identifiers as values.
 		Only diffusion scans matching all identifiers will be included - i.e. this is a whitelist.
@@ -86,6 +184,10 @@ def bru2bids(measurements_base,
 	functional_match : dict, optional
 		A dictionary with any combination of "session", "subject", "task", and "acquisition" as keys and corresponding lists of identifiers as values.
 		Only Functional scans matching all identifiers will be included - i.e. this is a whitelist.
+	incremental : bool, optional
+		Whether to only convert scans which are new, or have changed since they were last converted.
+		Each conversion is recorded (with the source scan directory, the sizes and modification times of its files, the SAMRI version, and the output paths) in a manifest file under `out_base`.
+		Scans whose record is unchanged and whose outputs are still present are skipped.
 	inflated_size : bool, optional
 		Whether to inflate the voxel size reported by the scanner when converting the data to NIfTI.
 		Setting this to `True` multiplies the voxel edge lengths by 10 (i.e. the volume by 1000); this is occasionally done in some small animal pipelines, which use routines designed exclusively for human data.
@@ -101,6 +203,10 @@ def bru2bids(measurements_base,
 	n_procs : int, optional
 		Maximum number of processes which to simultaneously spawn for the workflow.
 		If not explicitly defined, this is automatically calculated from the number of available cores and under the assumption that the workflow will be the main process running for the duration that it is running.
+	native_conversion : bool, optional
+		Whether to convert the scans in-process, via `samri.pipelines.extra_interfaces.NativeBru2`, rather than via the `Bru2` executable.
+		The native converter writes each output file in a single pass, applying the flip of "Prone" scans while writing, so that no file needs to be read and rewritten just to be flipped.
+		In this case `compress_intermediates` has no effect, as the converted files are directly the final (compressed) outputs.
 	out_base : str, optional
 		Base directory in which to place the BIDS reposited data.
 		If not present the BIDS records will be created in the `measurements_base` directory.
@@ -119,6 +225,8 @@ def bru2bids(measurements_base,
 	out_dir = path.join(out_base,workflow_name)
 	workdir_name = workflow_name+'_work'
 	workdir = path.join(out_base,workdir_name)
+	if delivery is None:
+		delivery = 'copy' if keep_work else 'hardlink'
 
 	if not os.path.exists(out_dir):
 		os.makedirs(out_dir)
@@ -141,6 +249,8 @@ def bru2bids(measurements_base,
 		f.write("\n")
 
 	# define measurement directories to be processed, and populate the list either with the given include_measurements, or with an intelligent selection
+	# the scans found in each measurement directory are recorded, so that unchanged directories need not be parsed again on subsequent runs
+	manifest_file = path.join(out_base,'.{}_manifest'.format(workflow_name),'scans.json')
 	functional_scan_types = diffusion_scan_types = structural_scan_types = []
 	data_selection = pd.DataFrame([])
 	if structural_match:
@@ -148,6 +258,8 @@ def bru2bids(measurements_base,
 			match=structural_match,
 			exclude=exclude,
 			measurements=measurements,
+			manifest_file=manifest_file,
+			n_jobs=n_procs,
 			)
 		print(s_data_selection.columns)
 		structural_scan_types = list(s_data_selection['scan_type'].unique())
@@ -158,6 +270,8 @@ def bru2bids(measurements_base,
 			match=functional_match,
 			exclude=exclude,
 			measurements=measurements,
+			manifest_file=manifest_file,
+			n_jobs=n_procs,
 			)
 		print(f_data_selection)
 		functional_scan_types = list(f_data_selection['scan_type'].unique())
@@ -168,6 +282,8 @@ def bru2bids(measurements_base,
 			match=diffusion_match,
 			exclude=exclude,
 			measurements=measurements,
+			manifest_file=manifest_file,
+			n_jobs=n_procs,
 			)
 		diffusion_scan_types = list(d_data_selection['scan_type'].unique())
 		dwi_ind = d_data_selection.index.tolist()
@@ -180,18 +296,29 @@ def bru2bids(measurements_base,
 		print(data_selection)
 		print('Iterating over:')
 		print(subjects_sessions)
-	infosource = pe.Node(interface=util.IdentityInterface(fields=['subject_session'], mandatory_inputs=False), name="infosource")
-	infosource.iterables = [('subject_session', subjects_sessions)]
-
-	datasink = pe.Node(nio.DataSink(), name='datasink')
-	datasink.inputs.base_directory = out_dir
-	datasink.inputs.parameterization = False
+	# conversions are recorded, so that incremental runs can skip scans which are already up to date
+	conversions_file = path.join(out_base,'.{}_manifest'.format(workflow_name),'conversions.json')
+	conversions = {}
+	try:
+		with open(conversions_file) as f:
+			conversions = json.load(f)
+	except (IOError, ValueError):
+		pass
+	samri_version = _samri_version()
+	records = {}
+	if functional_scan_types:
+		func_ind, records['func'] = _pending_conversions(f_data_selection, func_ind, conversions if incremental else {}, measurements_base, out_dir, 'func', ['acq','run'], samri_version)
+	if diffusion_scan_types:
+		dwi_ind, records['dwi'] = _pending_conversions(d_data_selection, dwi_ind, conversions if incremental else {}, measurements_base, out_dir, 'dwi', ['acq'], samri_version)
+	if structural_scan_types:
+		struct_ind, records['anat'] = _pending_conversions(s_data_selection, struct_ind, conversions if incremental else {}, measurements_base, out_dir, 'anat', ['acq'], samri_version)
+	if incremental:
+		print('Converting {} new or modified scans.'.format(sum(len(i) for i in records.values())))
 
-	workflow_connections = [
-		(infosource, datasink, [(('subject_session',ss_to_path), 'container')]),
-		]
+	# all modalities are scheduled in one graph, so that slow conversions of one modality do not leave cores idle while waiting to start the next
+	workflow_connections = []
 
-	if functional_scan_types:
+	if functional_scan_types and func_ind:
 		if not os.path.exists(workdir):
 			os.makedirs(workdir)
 		f_data_selection.to_csv(path.join(workdir,'f_data_selection.csv'))
@@ -203,29 +330,33 @@ def bru2bids(measurements_base,
 		get_f_scan.inputs.bids_base = measurements_base
 		get_f_scan.iterables = ("ind_type", func_ind)
 
-		f_bru2nii = pe.Node(interface=Bru2(), name="f_bru2nii")
+		if native_conversion:
+			# The native converter writes the final (compressed and, if needed, flipped) file in a single pass.
+			f_bru2nii = pe.Node(interface=NativeBru2(), name="f_bru2nii")
+			f_bru2nii.inputs.compress = True
+			f_bru2nii.inputs.compresslevel = compresslevel
+		else:
+			f_bru2nii = pe.Node(interface=Bru2(), name="f_bru2nii")
 		f_bru2nii.inputs.actual_size = not inflated_size
-		f_bru2nii.inputs.compress = True
 
-		f_metadata_file = pe.Node(name='metadata_file', interface=util.Function(function=write_bids_metadata_file,input_names=inspect.getargspec(write_bids_metadata_file)[0], output_names=['out_file']))
+		f_metadata_file = pe.Node(name='f_metadata_file', interface=util.Function(function=write_bids_metadata_file,input_names=inspect.getargspec(write_bids_metadata_file)[0], output_names=['out_file']))
 		f_metadata_file.inputs.extraction_dicts = BIDS_METADATA_EXTRACTION_DICTS
 
 		f_flip = pe.Node(name='f_flip', interface=util.Function(function=flip_if_needed,input_names=inspect.getargspec(flip_if_needed)[0], output_names=['out_file']))
 		f_flip.inputs.data_selection = f_data_selection
+		f_flip.inputs.compresslevel = compresslevel
 
 		events_file = pe.Node(name='events_file', interface=util.Function(function=write_bids_events_file,input_names=inspect.getargspec(write_bids_events_file)[0], output_names=['out_file']))
 		events_file.ignore_exception = True
 
 		physio_file = pe.Node(name='physio_file', interface=util.Function(function=write_bids_physio_file,input_names=inspect.getargspec(write_bids_physio_file)[0], output_names=['out_file','out_metadata_file']))
 
-		workflow_connections = [
-			(get_f_scan, datasink, [(('subject_session',ss_to_path), 'container')]),
+		f_datasink = _bids_datasink(out_dir, delivery, 'f_datasink')
+
+		workflow_connections.extend([
+			(get_f_scan, f_datasink, [(('subject_session',ss_to_path), 'container')]),
 			(get_f_scan, f_bru2nii, [('scan_path', 'input_dir')]),
 			(get_f_scan, f_bru2nii, [('nii_name', 'output_filename')]),
-			(get_f_scan, f_flip, [('ind_type', 'ind')]),
-			(get_f_scan, f_flip, [('nii_name', 'output_filename')]),
-			(f_bru2nii, f_flip, [('nii_file', 'nii_path')]),
-			(f_flip, datasink, [('out_file', 'func')]),
 			(f_metadata_file, events_file, [('out_file', 'metadata_file')]),
 			(f_bru2nii, events_file, [('nii_file', 'timecourse_file')]),
 			(get_f_scan, f_metadata_file, [
@@ -242,49 +373,32 @@ def bru2bids(measurements_base,
 				('nii_name', 'nii_name'),
 				('scan_path', 'scan_dir')
 				]),
-			(events_file, datasink, [('out_file', 'func.@events')]),
-			(physio_file, datasink, [('out_file', 'func.@physio')]),
-			(physio_file, datasink, [('out_metadata_file', 'func.@meta_physio')]),
-			(f_metadata_file, datasink, [('out_file', 'func.@metadata')]),
-			]
-		crashdump_dir = path.join(out_base,workflow_name+'_crashdump')
-		workflow_config = {'execution': {'crashdump_dir': crashdump_dir}}
-		if debug:
-			workflow_config['logging'] = {
-				'workflow_level':'DEBUG',
-				'utils_level':'DEBUG',
-				'interface_level':'DEBUG',
-				'filemanip_level':'DEBUG',
-				'log_to_file':'true',
-				}
-
-		workflow = pe.Workflow(name=workdir_name)
-		workflow.connect(workflow_connections)
-		workflow.base_dir = path.join(out_base)
-		workflow.config = workflow_config
-		try:
-			workflow.write_graph(dotfilename=path.join(workflow.base_dir,workdir_name,"graph_functional.dot"), graph2use="hierarchical", format="png")
-		except OSError:
-			print('We could not write the DOT file for visualization (`dot` function from the graphviz package). This is non-critical to the processing, but you should get this fixed.')
-
-		#Execute the workflow
-		if not keep_work or not keep_crashdump:
-			try:
-				workflow.run(plugin="MultiProc", plugin_args={'n_procs' : n_procs})
-			except RuntimeError:
-				pass
+			(events_file, f_datasink, [('out_file', 'func.@events')]),
+			(physio_file, f_datasink, [('out_file', 'func.@physio')]),
+			(physio_file, f_datasink, [('out_metadata_file', 'func.@meta_physio')]),
+			(f_metadata_file, f_datasink, [('out_file', 'func.@metadata')]),
+			])
+		if native_conversion:
+			workflow_connections.extend([
+				(get_f_scan, f_bru2nii, [(('dict_slice',is_prone), 'flip')]),
+				(f_bru2nii, f_datasink, [('nii_file', 'func')]),
+				])
 		else:
-			workflow.run(plugin="MultiProc", plugin_args={'n_procs' : n_procs})
-		if not keep_work:
-			shutil.rmtree(path.join(workflow.base_dir,workdir_name))
-		if not keep_crashdump:
-			try:
-				shutil.rmtree(crashdump_dir)
-			except (FileNotFoundError, OSError):
-				pass
-
-	if diffusion_scan_types:
-		# We check for the directory, since it gets deleted after a successful execution.
+			if compress_intermediates:
+				# Scans which need to be flipped are rewritten anyway, and are thus only compressed when flipped.
+				workflow_connections.extend([
+					(get_f_scan, f_bru2nii, [(('dict_slice',is_not_prone), 'compress')]),
+					])
+			else:
+				f_bru2nii.inputs.compress = False
+			workflow_connections.extend([
+				(get_f_scan, f_flip, [('ind_type', 'ind')]),
+				(get_f_scan, f_flip, [('nii_name', 'output_filename')]),
+				(f_bru2nii, f_flip, [('nii_file', 'nii_path')]),
+				(f_flip, f_datasink, [('out_file', 'func')]),
+				])
+
+	if diffusion_scan_types and dwi_ind:
 		if not os.path.exists(workdir):
 			os.makedirs(workdir)
 		d_data_selection.to_csv(path.join(workdir,'d_data_selection.csv'))
@@ -297,65 +411,46 @@ def bru2bids(measurements_base,
 		get_d_scan.inputs.bids_base = measurements_base
 		get_d_scan.iterables = ("ind_type", dwi_ind)
 
-		d_bru2nii = pe.Node(interface=Bru2(), name="d_bru2nii")
+		if native_conversion:
+			d_bru2nii = pe.Node(interface=NativeBru2(), name="d_bru2nii")
+			d_bru2nii.inputs.compress = True
+			d_bru2nii.inputs.compresslevel = compresslevel
+		else:
+			d_bru2nii = pe.Node(interface=Bru2(), name="d_bru2nii")
+			d_bru2nii.inputs.compress = compress_intermediates
 		d_bru2nii.inputs.force_conversion=True
 		d_bru2nii.inputs.actual_size = not inflated_size
-		d_bru2nii.inputs.compress = True
 
-		d_metadata_file = pe.Node(name='metadata_file', interface=util.Function(function=write_bids_metadata_file,input_names=inspect.getargspec(write_bids_metadata_file)[0], output_names=['out_file']))
+		d_metadata_file = pe.Node(name='d_metadata_file', interface=util.Function(function=write_bids_metadata_file,input_names=inspect.getargspec(write_bids_metadata_file)[0], output_names=['out_file']))
 		d_metadata_file.inputs.extraction_dicts = BIDS_METADATA_EXTRACTION_DICTS
 
-		workflow_connections = [
-			(get_d_scan, datasink, [(('subject_session',ss_to_path), 'container')]),
+		d_datasink = _bids_datasink(out_dir, delivery, 'd_datasink')
+
+		workflow_connections.extend([
+			(get_d_scan, d_datasink, [(('subject_session',ss_to_path), 'container')]),
 			(get_d_scan, d_bru2nii, [('scan_path', 'input_dir')]),
 			(get_d_scan, d_bru2nii, [('nii_name', 'output_filename')]),
-			(d_bru2nii, datasink, [('nii_file', 'dwi')]),
 			(get_d_scan, d_metadata_file, [
 				('metadata_filename', 'out_file'),
 				('task', 'task'),
 				('scan_path', 'scan_dir')
 				]),
-			(d_metadata_file, datasink, [('out_file', 'dwi.@metadata')]),
-			]
-
-		crashdump_dir = path.join(out_base,workflow_name+'_crashdump')
-		workflow_config = {'execution': {'crashdump_dir': crashdump_dir}}
-		if debug:
-			workflow_config['logging'] = {
-				'workflow_level':'DEBUG',
-				'utils_level':'DEBUG',
-				'interface_level':'DEBUG',
-				'filemanip_level':'DEBUG',
-				'log_to_file':'true',
-				}
-
-		workflow = pe.Workflow(name=workdir_name)
-		workflow.connect(workflow_connections)
-		workflow.base_dir = path.join(out_base)
-		workflow.config = workflow_config
-		try:
-			workflow.write_graph(dotfilename=path.join(workflow.base_dir,workdir_name,"graph_diffusion.dot"), graph2use="hierarchical", format="png")
-		except OSError:
-			print('We could not write the DOT file for visualization (`dot` function from the graphviz package). This is non-critical to the processing, but you should get this fixed.')
-
-		#Execute the workflow
-		if not keep_work or not keep_crashdump:
-			try:
-				workflow.run(plugin="MultiProc", plugin_args={'n_procs' : n_procs})
-			except RuntimeError:
-				pass
+			(d_metadata_file, d_datasink, [('out_file', 'dwi.@metadata')]),
+			])
+		if native_conversion or compress_intermediates:
+			workflow_connections.extend([
+				(d_bru2nii, d_datasink, [('nii_file', 'dwi')]),
+				])
 		else:
-			workflow.run(plugin="MultiProc", plugin_args={'n_procs' : n_procs})
-		if not keep_work:
-			shutil.rmtree(path.join(workflow.base_dir,workdir_name))
-		if not keep_crashdump:
-			try:
-				shutil.rmtree(crashdump_dir)
-			except (FileNotFoundError, OSError):
-				pass
-
-	if structural_scan_types:
-		# We check for the directory, since it gets deleted after a successful execution.
+			d_compress = pe.Node(name='d_compress', interface=util.Function(function=compress_nifti,input_names=inspect.getargspec(compress_nifti)[0], output_names=['out_file']))
+			d_compress.inputs.compresslevel = compresslevel
+			workflow_connections.extend([
+				(get_d_scan, d_compress, [('nii_name', 'out_file')]),
+				(d_bru2nii, d_compress, [('nii_file', 'in_file')]),
+				(d_compress, d_datasink, [('out_file', 'dwi')]),
+				])
+
+	if structural_scan_types and struct_ind:
 		if not os.path.exists(workdir):
 			os.makedirs(workdir)
 		s_data_selection.to_csv(path.join(workdir,'s_data_selection.csv'))
@@ -368,32 +463,58 @@ def bru2bids(measurements_base,
 		get_s_scan.inputs.bids_base = measurements_base
 		get_s_scan.iterables = ("ind_type", struct_ind)
 
-		s_bru2nii = pe.Node(interface=Bru2(), name="s_bru2nii")
+		if native_conversion:
+			s_bru2nii = pe.Node(interface=NativeBru2(), name="s_bru2nii")
+			s_bru2nii.inputs.compress = True
+			s_bru2nii.inputs.compresslevel = compresslevel
+		else:
+			s_bru2nii = pe.Node(interface=Bru2(), name="s_bru2nii")
 		s_bru2nii.inputs.force_conversion=True
 		s_bru2nii.inputs.actual_size = not inflated_size
-		s_bru2nii.inputs.compress = True
 
-		s_metadata_file = pe.Node(name='metadata_file', interface=util.Function(function=write_bids_metadata_file,input_names=inspect.getargspec(write_bids_metadata_file)[0], output_names=['out_file']))
+		s_metadata_file = pe.Node(name='s_metadata_file', interface=util.Function(function=write_bids_metadata_file,input_names=inspect.getargspec(write_bids_metadata_file)[0], output_names=['out_file']))
 		s_metadata_file.inputs.extraction_dicts = BIDS_METADATA_EXTRACTION_DICTS
 
 		s_flip = pe.Node(name='s_flip', interface=util.Function(function=flip_if_needed,input_names=inspect.getargspec(flip_if_needed)[0], output_names=['out_file']))
 		s_flip.inputs.data_selection = s_data_selection
+		s_flip.inputs.compresslevel = compresslevel
+
+		s_datasink = _bids_datasink(out_dir, delivery, 's_datasink')
 
-		workflow_connections = [
-			(get_s_scan, datasink, [(('subject_session',ss_to_path), 'container')]),
+		workflow_connections.extend([
+			(get_s_scan, s_datasink, [(('subject_session',ss_to_path), 'container')]),
 			(get_s_scan, s_bru2nii, [('scan_path', 'input_dir')]),
 			(get_s_scan, s_bru2nii, [('nii_name', 'output_filename')]),
-			(get_s_scan, s_flip, [('ind_type', 'ind')]),
-			(get_s_scan, s_flip, [('nii_name', 'output_filename')]),
-			(s_bru2nii, s_flip, [('nii_file', 'nii_path')]),
-			(s_flip, datasink, [('out_file', 'anat')]),
 			(get_s_scan, s_metadata_file, [
 				('metadata_filename', 'out_file'),
 				('task', 'task'),
 				('scan_path', 'scan_dir')
 				]),
-			(s_metadata_file, datasink, [('out_file', 'anat.@metadata')]),
-			]
+			(s_metadata_file, s_datasink, [('out_file', 'anat.@metadata')]),
+			])
+		if native_conversion:
+			workflow_connections.extend([
+				(get_s_scan, s_bru2nii, [(('dict_slice',is_prone), 'flip')]),
+				(s_bru2nii, s_datasink, [('nii_file', 'anat')]),
+				])
+		else:
+			if compress_intermediates:
+				# Scans which need to be flipped are rewritten anyway, and are thus only compressed when flipped.
+				workflow_connections.extend([
+					(get_s_scan, s_bru2nii, [(('dict_slice',is_not_prone), 'compress')]),
+					])
+			else:
+				s_bru2nii.inputs.compress = False
+			workflow_connections.extend([
+				(get_s_scan, s_flip, [('ind_type', 'ind')]),
+				(get_s_scan, s_flip, [('nii_name', 'output_filename')]),
+				(s_bru2nii, s_flip, [('nii_file', 'nii_path')]),
+				(s_flip, s_datasink, [('out_file', 'anat')]),
+				])
+
+	# outputs written from here on belong to this run, older ones may be left over from failed reconversions
+	run_start = time.time()
+	if workflow_connections:
 		crashdump_dir = path.join(out_base,workflow_name+'_crashdump')
 		workflow_config = {'execution': {'crashdump_dir': crashdump_dir}}
 		if debug:
@@ -410,7 +531,7 @@ def bru2bids(measurements_base,
 		workflow.base_dir = path.join(out_base)
 		workflow.config = workflow_config
 		try:
-			workflow.write_graph(dotfilename=path.join(workflow.base_dir,workdir_name,"graph_structural.dot"), graph2use="hierarchical", format="png")
+			workflow.write_graph(dotfilename=path.join(workflow.base_dir,workdir_name,"graph.dot"), graph2use="hierarchical", format="png")
 		except OSError:
 			print('We could not write the DOT file for visualization (`dot` function from the graphviz package). This is non-critical to the processing, but you should get this fixed.')
 
@@ -430,6 +551,15 @@ def bru2bids(measurements_base,
 			except (FileNotFoundError, OSError):
 				pass
 
+	_record_conversions(records, conversions, run_start)
+	if records:
+		conversions_dir = path.dirname(conversions_file)
+		if not os.path.exists(conversions_dir):
+			os.makedirs(conversions_dir)
+		with open(conversions_file+'.tmp', 'w') as f:
+			json.dump(conversions, f, indent=1)
+		os.replace(conversions_file+'.tmp', conversions_file)
+
 	# Copy participants/subjects file
 	for ext in ['.tsv','.json']:
 		participants_file = path.join(measurements_base,'participants')+ext
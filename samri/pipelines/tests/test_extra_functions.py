@@ -64,3 +64,216 @@ def test_reset_background(tmp_path):
 	data = img.get_data()
 	bg_by_coordinates = data[0,0,0,0]
 	assert bg_by_coordinates == 1000
+
+def test_compress_nifti(tmp_path):
+	import os
+	import numpy as np
+	import nibabel as nib
+	from samri.pipelines.extra_functions import compress_nifti
+
+	data = np.random.RandomState(0).rand(5,4,3,2).astype(np.float32)
+	in_file = f'{tmp_path}/intermediate.nii'
+	nib.save(nib.Nifti1Image(data, np.eye(4)), in_file)
+
+	out_file = compress_nifti(in_file, f'{tmp_path}/final.nii.gz')
+	with open(out_file, 'rb') as f:
+		assert f.read(2) == b'\x1f\x8b'
+	assert np.array_equal(nib.load(out_file).get_fdata(), data)
+
+	# Names without an extension, as generated for Bruker scans, are delivered compressed, at the requested level.
+	fast_file = compress_nifti(in_file, f'{tmp_path}/fast', compresslevel=1)
+	assert fast_file == f'{tmp_path}/fast.nii.gz'
+	small_file = compress_nifti(in_file, f'{tmp_path}/small.nii.gz', compresslevel=9)
+	assert os.path.getsize(small_file) <= os.path.getsize(fast_file)
+	assert np.array_equal(nib.load(fast_file).get_fdata(), data)
+
+def test_physio_roundtrip(tmp_path):
+	from samri.pipelines.extra_functions import physiofile_ts, write_bids_physio_file
+	import gzip
+	import json
+	import nibabel as nib
+	import numpy as np
+
+	scan_dir = tmp_path / 'scan'
+	scan_dir.mkdir()
+	neurons = np.arange(8) * 0.5
+	astrocytes = np.arange(6) * 0.25
+	(scan_dir / 'physio_neurons.1D').write_text(' '.join('1*{}'.format(i) for i in neurons) + ' ')
+	(scan_dir / 'physio_astrocytes.1D').write_text(' '.join('1*{}'.format(i) for i in astrocytes) + ' ')
+
+	func_dir = tmp_path / 'func'
+	func_dir.mkdir()
+	out_file, out_metadata_file = write_bids_physio_file(str(scan_dir),
+		nii_name=str(func_dir / 'sub-1_ses-1_task-a_bold_ind0'),
+		)
+	assert out_file == str(func_dir / 'sub-1_ses-1_task-a_physio.tsv.gz')
+	assert out_metadata_file == str(func_dir / 'sub-1_ses-1_task-a_physio.json')
+	with gzip.open(out_file, 'rt') as f:
+		rows = f.read().splitlines()
+	assert len(rows) == 8
+	metadata = json.load(open(out_metadata_file))
+	astrocytes_column = metadata['Columns'].index('astrocytes')
+	assert rows[-1].split('\t')[astrocytes_column] == 'n/a'
+
+	# The timecourse is longer than the shortest recording, and is truncated without copying the data.
+	data = np.random.RandomState(0).rand(3,3,2,7).astype(np.float32)
+	nii_file = str(func_dir / 'sub-1_ses-1_task-a_bold.nii')
+	nib.save(nib.Nifti1Image(data, np.eye(4)), nii_file)
+	truncated, ts = physiofile_ts(nii_file, 'astrocytes', save=str(tmp_path / 'truncated'))
+	assert np.allclose(ts, astrocytes)
+	assert truncated.endswith('.hdr')
+	assert np.array_equal(nib.load(truncated).get_fdata(), data[..., :6])
+	untruncated, ts = physiofile_ts(nii_file, 'neurons')
+	assert untruncated == nii_file
+	assert np.allclose(ts, neurons[:7])
+
+def test_force_dummy_scans(tmp_path):
+	from samri.pipelines.extra_functions import force_dummy_scans
+	import json
+	import nibabel as nib
+	import numpy as np
+	import os
+
+	data = np.random.RandomState(0).randint(0, 1000, size=(4,3,2,12)).astype(np.int16)
+	for extension in ['.nii', '.nii.gz']:
+		in_file = str(tmp_path / ('sub-1_ses-1_task-a_bold' + extension))
+		nib.save(nib.Nifti1Image(data, np.eye(4)), in_file)
+		json.dump({'NumberOfVolumesDiscardedByScanner':4}, open(str(tmp_path / 'sub-1_ses-1_task-a_bold.json'), 'w'))
+
+		out_file, deleted_scans = force_dummy_scans(in_file,
+			desired_dummy_scans=7,
+			out_file=str(tmp_path / ('forced' + extension)),
+			)
+		assert deleted_scans == 3
+		assert np.array_equal(nib.load(out_file).get_fdata(), data[..., 3:])
+		if extension == '.nii':
+			# Uncompressed data is not copied, but referenced by a header with an offset.
+			assert out_file.endswith('.hdr')
+			assert os.path.samefile(out_file[:-4] + '.img', in_file)
+		else:
+			assert out_file.endswith('.nii.gz')
+
+		out_file, deleted_scans = force_dummy_scans(in_file, desired_dummy_scans=2)
+		assert deleted_scans == -2
+		assert out_file == in_file
+
+def test_reset_background_modes(tmp_path):
+	from samri.pipelines.extra_functions import reset_background
+	import nibabel as nib
+	import numpy as np
+
+	rs = np.random.RandomState(0)
+	data = rs.randint(0, 50, size=(12,12,8,9)).astype(np.int16)
+	data[:8,:8,:8] = rs.randint(3, 6, size=(8,8,8,9))
+	in_file = str(tmp_path / 'in.nii.gz')
+	nib.save(nib.Nifti1Image(data, np.eye(4)), in_file)
+
+	out_file = str(tmp_path / 'reset_background.nii.gz')
+	reset_background(in_file, bg_value=1000, out_file=out_file, chunk_size=4)
+	expected = data.copy()
+	for i in range(data.shape[3]):
+		values, counts = np.unique(data[:8,:8,:8,i], return_counts=True)
+		expected[...,i][data[...,i] == values[counts.argmax()]] = 1000
+	assert np.array_equal(np.asanyarray(nib.load(out_file).dataobj), expected)
+
+def test_volume_modes_wide_range(monkeypatch):
+	from samri.pipelines.extra_functions import _volume_modes
+	import numpy as np
+
+	samples = np.random.RandomState(1).randint(0, 2**18, size=(500,16)).astype(np.int32)
+	samples[:100] = 7
+	bincount = np.bincount
+	sizes = []
+	def recording_bincount(x, *args, **kwargs):
+		counts = bincount(x, *args, **kwargs)
+		sizes.append(counts.size)
+		return counts
+	monkeypatch.setattr(np, 'bincount', recording_bincount)
+
+	# The table of counts is not allocated for the full value range.
+	assert np.array_equal(_volume_modes(samples), np.full(16, 7))
+	assert all(i <= samples.size for i in sizes)
+
+	narrow = samples % 5
+	expected = [np.unique(i, return_counts=True) for i in narrow.T]
+	assert np.array_equal(_volume_modes(narrow), [values[counts.argmax()] for values, counts in expected])
+
+def test_extract_volume_batch(tmp_path, monkeypatch):
+	from samri.pipelines.extra_functions import extract_volume, extract_volumes
+	import nibabel as nib
+	import numpy as np
+
+	data = np.random.RandomState(0).rand(4,3,2,10).astype(np.float32)
+	in_file = str(tmp_path / 'in.nii.gz')
+	nib.save(nib.Nifti1Image(data, np.eye(4)), in_file)
+
+	out_file = extract_volume(in_file, 4, out_file=str(tmp_path / 'volume.nii.gz'))
+	assert np.array_equal(nib.load(out_file).get_fdata(), data[...,4])
+
+	out_files = extract_volume(in_file, [7,2,5], out_file=str(tmp_path / 'volume.nii.gz'))
+	assert out_files == [str(tmp_path / 'volume_{}.nii.gz'.format(i)) for i in [7,2,5]]
+	for i, out_file in zip([7,2,5], out_files):
+		assert np.array_equal(nib.load(out_file).get_fdata(), data[...,i])
+
+	monkeypatch.chdir(tmp_path)
+	out_files = extract_volumes([in_file, in_file], 1, out_files_base='extracted.nii.gz')
+	assert len(out_files) == 2
+	assert np.array_equal(nib.load(out_files[1]).get_fdata(), data[...,1])
+
+def test_merge_statistics(tmp_path):
+	from samri.pipelines.extra_functions import merge_statistics
+	import json
+	import nibabel as nib
+	import numpy as np
+
+	in_files = []
+	for i in range(3):
+		data = np.random.RandomState(i).rand(4,3,2,5).astype(np.float32)
+		in_file = f'{tmp_path}/sub-{i}_desc-glm_cbv.nii.gz'
+		nib.save(nib.Nifti1Image(data, np.eye(4)), in_file)
+		with open(f'{tmp_path}/sub-{i}_desc-glm_cbv.json', 'w') as f:
+			json.dump({'Statistics':{'betas':[0,1], 'cope':[2,3], 'varcb':[4]}}, f)
+		in_files.append(in_file)
+
+	merged = merge_statistics(in_files, f'{tmp_path}/cope.nii.gz', statistic='cope', volume=1)
+	merged = nib.load(merged).get_fdata()
+	assert merged.shape == (4,3,2,3)
+	for i, in_file in enumerate(in_files):
+		assert np.allclose(merged[...,i], nib.load(in_file).get_fdata()[...,3])
+	merged = nib.load(merge_statistics(in_files, f'{tmp_path}/varcb.nii.gz', statistic='varcb')).get_fdata()
+	assert np.allclose(merged[...,2], nib.load(in_files[2]).get_fdata()[...,4])
+
+def test_write_bids_metadata_file(tmp_path):
+	import json
+	from samri.pipelines.extra_functions import write_bids_metadata_file, BIDS_METADATA_EXTRACTION_DICTS
+
+	method = [
+		'##TITLE=Parameter List',
+		'##$Method=<Bruker:EPI>',
+		'##$EchoTime=15',
+		'##$PVM_RepetitionTime=1000',
+		'##$PVM_DummyScans=4',
+		'##END=',
+		]
+	(tmp_path / 'method').write_text('\n'.join(method) + '\n')
+	configscan = [
+		'##TITLE=Parameter List',
+		'##ORIGIN=Bruker BioSpin MRI GmbH',
+		'##$Bis=( 65 )',
+		'<$Bis,1,20140409,2048,COILTABLE,1#$Name,1H-SUC T/R#$Id,1.0,>',
+		'##END=',
+		]
+	(tmp_path / 'configscan').write_text('\n'.join(configscan) + '\n')
+
+	out_file = write_bids_metadata_file(str(tmp_path), BIDS_METADATA_EXTRACTION_DICTS, out_file=f'{tmp_path}/metadata.json', task='JogB')
+	with open(out_file) as f:
+		metadata = json.load(f)
+	assert metadata == {
+		'EchoTime': 0.015,
+		'Manufacturer': 'Bruker BioSpin MRI GmbH',
+		'NumberOfVolumesDiscardedByScanner': 4,
+		'ReceiveCoilName': '1H-SUC T/R',
+		'RepetitionTime': 1.0,
+		'PulseSequenceType': 'EPI',
+		'TaskName': 'JogB',
+		}
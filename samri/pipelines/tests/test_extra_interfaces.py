@@ -0,0 +1,873 @@
+import numpy as np
+import pytest
+import shutil
+
+def _count_opens(monkeypatch, file_path):
+	"""Record every time nibabel opens `file_path`, each of which restarts decompression for compressed files."""
+	from nibabel import openers
+
+	opens = []
+	init = openers.ImageOpener.__init__
+	def counting_init(self, fileish, *args, **kwargs):
+		if str(fileish) == str(file_path):
+			opens.append(fileish)
+		init(self, fileish, *args, **kwargs)
+	monkeypatch.setattr(openers.ImageOpener, '__init__', counting_init)
+	return opens
+
+def test_temporal_mean(tmp_path):
+	from samri.pipelines.extra_interfaces import TemporalMean
+	import nibabel as nib
+
+	data = np.random.RandomState(0).rand(6,5,4,23).astype(np.float32) * 100
+	in_file = f'{tmp_path}/ts.nii.gz'
+	nib.save(nib.Nifti1Image(data, np.eye(4)), in_file)
+
+	temporal_mean = TemporalMean()
+	temporal_mean.inputs.in_file = in_file
+	temporal_mean.inputs.out_file = f'{tmp_path}/mean.nii.gz'
+	temporal_mean.inputs.tsnr_file = f'{tmp_path}/tsnr.nii.gz'
+	temporal_mean.inputs.chunk_size = 5
+	result = temporal_mean.run()
+
+	mean = nib.load(result.outputs.out_file).get_fdata()
+	assert mean.shape == (6,5,4)
+	assert np.allclose(mean, data.mean(axis=3), atol=1e-4)
+	tsnr = nib.load(result.outputs.tsnr_file).get_fdata()
+	assert np.allclose(tsnr, data.mean(axis=3)/data.std(axis=3), rtol=1e-3)
+
+def test_temporal_mean_compressed_chunks(tmp_path, monkeypatch):
+	from samri.pipelines.extra_interfaces import TemporalMean
+	import nibabel as nib
+
+	data = np.random.RandomState(1).rand(8,7,6,40).astype(np.float32)
+	in_file = f'{tmp_path}/ts.nii.gz'
+	nib.save(nib.Nifti1Image(data, np.eye(4)), in_file)
+	opens = _count_opens(monkeypatch, in_file)
+
+	temporal_mean = TemporalMean()
+	temporal_mean.inputs.in_file = in_file
+	temporal_mean.inputs.out_file = f'{tmp_path}/mean.nii.gz'
+	temporal_mean.inputs.chunk_size = 40
+	temporal_mean.run()
+	single_chunk_opens = len(opens)
+
+	temporal_mean.inputs.chunk_size = 4
+	result = temporal_mean.run()
+	assert np.allclose(nib.load(result.outputs.out_file).get_fdata(), data.mean(axis=3), atol=1e-5)
+	# The compressed file is decompressed once, rather than once per chunk.
+	assert len(opens) == 2 * single_chunk_opens
+
+def test_nifti_volume_range_compressed_chunks(tmp_path, monkeypatch):
+	from samri.pipelines.utils import nifti_volume_range
+	import nibabel as nib
+
+	data = np.random.RandomState(2).rand(6,5,4,30).astype(np.float32)
+	in_file = f'{tmp_path}/ts.nii.gz'
+	nib.save(nib.Nifti1Image(data, np.eye(4)), in_file)
+	opens = _count_opens(monkeypatch, in_file)
+
+	nifti_volume_range(in_file, f'{tmp_path}/single', start=5, chunk_size=30)
+	single_chunk_opens = len(opens)
+	out_file = nifti_volume_range(in_file, f'{tmp_path}/chunked', start=5, chunk_size=3)
+	assert np.array_equal(nib.load(out_file).get_fdata(), data[...,5:])
+	# The compressed file is decompressed once, rather than once per chunk.
+	assert len(opens) == 2 * single_chunk_opens
+
+def test_chunked_apply_transforms(tmp_path):
+	from samri.pipelines.extra_interfaces import ChunkedApplyTransforms
+	import nibabel as nib
+
+	affine = np.diag([0.2,0.2,0.5,1])
+	data = np.random.RandomState(0).rand(10,9,8,7).astype(np.float32)
+	in_file = f'{tmp_path}/ts.nii.gz'
+	nib.save(nib.Nifti1Image(data, affine), in_file)
+	reference = f'{tmp_path}/reference.nii.gz'
+	nib.save(nib.Nifti1Image(data[...,0], affine), reference)
+
+	# Constant displacement of one voxel along each axis, in ITK (LPS) convention.
+	field = np.zeros((10,9,8,1,3), dtype=np.float32)
+	field[...,0] = -0.2
+	field[...,1] = -0.2
+	field[...,2] = 0.5
+	field_img = nib.Nifti1Image(field, affine)
+	field_img.header.set_intent('vector')
+	field_file = f'{tmp_path}/field.nii.gz'
+	nib.save(field_img, field_file)
+
+	warp = ChunkedApplyTransforms()
+	warp.inputs.input_image = in_file
+	warp.inputs.reference_image = reference
+	warp.inputs.displacement_field = field_file
+	warp.inputs.interpolation = 'Linear'
+	warp.inputs.output_image = f'{tmp_path}/warped.nii.gz'
+	warp.inputs.chunk_size = 3
+	warp.inputs.num_threads = 2
+	result = warp.run()
+
+	warped = nib.load(result.outputs.output_image).get_fdata()
+	assert warped.shape == data.shape
+	assert np.allclose(warped[:-1,:-1,:-1], data[1:,1:,1:], atol=1e-6)
+	assert np.all(warped[-1] == 0)
+
+def test_chunked_apply_transforms_memory(tmp_path, monkeypatch):
+	from samri.pipelines.extra_interfaces import ChunkedApplyTransforms
+	import nibabel as nib
+
+	data = np.random.RandomState(1).rand(10,9,8,12).astype(np.float32)
+	in_file = f'{tmp_path}/ts.nii.gz'
+	nib.save(nib.Nifti1Image(data, np.eye(4)), in_file)
+	field = nib.Nifti1Image(np.zeros((10,9,8,1,3), dtype=np.float32), np.eye(4))
+	field.header.set_intent('vector')
+	nib.save(field, f'{tmp_path}/field.nii.gz')
+	nib.save(nib.Nifti1Image(data[...,0], np.eye(4)), f'{tmp_path}/reference.nii.gz')
+	opens = _count_opens(monkeypatch, in_file)
+
+	warp = ChunkedApplyTransforms()
+	warp.inputs.input_image = in_file
+	warp.inputs.reference_image = f'{tmp_path}/reference.nii.gz'
+	warp.inputs.displacement_field = f'{tmp_path}/field.nii.gz'
+	warp.inputs.output_image = f'{tmp_path}/warped.nii.gz'
+	warp.inputs.chunk_size = 12
+	warp.run()
+	single_chunk_opens = len(opens)
+
+	# A budget leaving room for only a few volumes beyond the resampling coordinates.
+	warp.inputs.max_memory_gb = (720 * 24 + 3 * 720 * 24) / 2**30
+	result = warp.run()
+	assert np.allclose(nib.load(result.outputs.output_image).get_fdata(), data, atol=1e-6)
+	# The compressed file is decompressed once, rather than once per chunk.
+	assert len(opens) == 2 * single_chunk_opens
+
+def test_cropped_registration_crop(tmp_path, monkeypatch):
+	from samri.pipelines.extra_interfaces import CroppedRegistration
+	from samri.pipelines.utils import bounding_box
+	import nibabel as nib
+
+	affine = np.array([[0.2,0,0,-3],[0,0.2,0,2],[0,0,0.5,1],[0,0,0,1]])
+	data = np.zeros((20,18,16), dtype=np.float32)
+	data[5:12,6:10,4:9] = 1
+	in_file = f'{tmp_path}/image.nii.gz'
+	nib.save(nib.Nifti1Image(data, affine), in_file)
+
+	extent = bounding_box(data, 2)
+	assert extent == (slice(3,14), slice(4,12), slice(2,11))
+
+	monkeypatch.chdir(tmp_path)
+	cropped = nib.load(CroppedRegistration()._crop(in_file, extent, 'crop_'))
+	assert cropped.shape == (11,8,9)
+	# Cropping must not alter the physical position of the remaining voxels.
+	assert np.allclose(cropped.affine.dot([0,0,0,1]), affine.dot([3,4,2,1]))
+	assert np.array_equal(cropped.get_fdata(), data[extent])
+
+	registration = CroppedRegistration()
+	registration.inputs.fixed_image = in_file
+	registration.inputs.moving_image = in_file
+	registration.inputs.crop_mask = in_file
+	registration.inputs.crop_margin = 2
+	registration.inputs.transforms = ['Rigid']
+	registration.inputs.transform_parameters = [(0.1,)]
+	registration.inputs.number_of_iterations = [[10]]
+	registration.inputs.metric = ['MI']
+	registration.inputs.metric_weight = [1]
+	registration.inputs.radius_or_number_of_bins = [32]
+	registration.inputs.shrink_factors = [[1]]
+	registration.inputs.smoothing_sigmas = [[0]]
+	cropped_registration = registration._cropped_registration()
+	# The cropped images are passed to a separate interface, the inputs of this one are left unchanged.
+	assert registration.inputs.fixed_image == [in_file]
+	assert registration.inputs.moving_image == [in_file]
+	assert cropped_registration.inputs.fixed_image == [f'{tmp_path}/crop_fixed_image.nii.gz']
+	assert cropped_registration.inputs.moving_image == [f'{tmp_path}/crop_moving_image.nii.gz']
+	assert cropped_registration.inputs.transforms == ['Rigid']
+	assert 'crop_fixed_image.nii.gz' in cropped_registration.cmdline
+
+def test_delivery_data_sink(tmp_path):
+	from samri.pipelines.extra_interfaces import DeliveryDataSink
+	import os
+
+	work_dir = tmp_path / 'work'
+	work_dir.mkdir()
+	in_file = work_dir / 'sub-1_ses-1_task-a_bold.nii.gz'
+	in_file.write_bytes(b'data')
+	events_file = work_dir / 'sub-1_ses-1_task-a_events.tsv'
+	events_file.write_bytes(b'events')
+
+	datasink = DeliveryDataSink()
+	datasink.inputs.base_directory = str(tmp_path / 'out')
+	datasink.inputs.parameterization = False
+	datasink.inputs.container = 'sub-1/ses-1'
+	datasink.inputs.delivery = 'hardlink'
+	setattr(datasink.inputs, 'func', str(in_file))
+	setattr(datasink.inputs, 'func.@events', str(events_file))
+	result = datasink.run()
+
+	delivered = tmp_path / 'out' / 'sub-1' / 'ses-1' / 'func' / in_file.name
+	assert str(delivered) in result.outputs.out_file
+	assert os.path.samefile(delivered, in_file)
+	assert (delivered.parent / events_file.name).read_bytes() == b'events'
+
+def test_delivery_data_sink_s3(tmp_path, monkeypatch):
+	from nipype.interfaces.io import DataSink
+	from samri.pipelines.extra_interfaces import DeliveryDataSink
+
+	in_file = tmp_path / 'sub-1_ses-1_task-a_bold.nii.gz'
+	in_file.write_bytes(b'data')
+	calls = []
+	monkeypatch.setattr(DataSink, '_list_outputs', lambda self: calls.append(self.inputs.base_directory) or {'out_file': []})
+
+	datasink = DeliveryDataSink()
+	datasink.inputs.parameterization = False
+	setattr(datasink.inputs, 'func', str(in_file))
+	datasink.inputs.base_directory = str(tmp_path / 'out')
+	datasink._list_outputs()
+	assert calls == []
+
+	# Remote targets are delivered by the nipype DataSink.
+	datasink.inputs.base_directory = 's3://bucket/out'
+	datasink._list_outputs()
+	assert calls == ['s3://bucket/out']
+
+def _write_bruker_scan(scan_dir, raw, slopes, orientation, positions, extent, repetition_time=1000.):
+	"""Write a synthetic 2D multi-slice ParaVision scan, with `raw` shaped (x, y, slice, cycle)."""
+	import os
+
+	size_x, size_y, slices, cycles = raw.shape
+	frame_count = slices * cycles
+	reco_dir = os.path.join(scan_dir, 'pdata', '1')
+	os.makedirs(reco_dir)
+	with open(os.path.join(reco_dir, '2dseq'), 'wb') as f:
+		f.write(raw.astype('<i2').tobytes(order='F'))
+
+	def array(values):
+		return ' '.join('{:.15g}'.format(i) for i in np.ravel(values))
+	visu_pars = [
+		'##TITLE=Parameter List',
+		'##$VisuCoreFrameCount={}'.format(frame_count),
+		'##$VisuCoreDim=2',
+		'##$VisuCoreSize=( 2 )', '{} {}'.format(size_x, size_y),
+		'##$VisuCoreExtent=( 2 )', array(extent),
+		'##$VisuCoreFrameThickness=( 1 )', '0.5',
+		'##$VisuCoreOrientation=( {}, 9 )'.format(slices), array(np.tile(orientation, (slices, 1))),
+		'##$VisuCorePosition=( {}, 3 )'.format(slices), array(positions),
+		'##$VisuCoreDataOffs=( {} )'.format(frame_count), array(np.zeros(frame_count)),
+		'##$VisuCoreDataSlope=( {} )'.format(frame_count), array(slopes),
+		'##$VisuCoreWordType=_16BIT_SGN_INT',
+		'##$VisuCoreByteOrder=littleEndian',
+		'##$VisuFGOrderDescDim=2',
+		'##$VisuFGOrderDesc=( 2 )', '({}, <FG_SLICE>, <>, 0, 2) ({}, <FG_CYCLE>, <>, 2, 0)'.format(slices, cycles),
+		'##$VisuGroupDepVals=( 2 )', '(<VisuCoreOrientation>, 0) (<VisuCorePosition>, 0)',
+		'##$VisuAcqRepetitionTime=( 1 )', '{:g}'.format(repetition_time),
+		'##END=',
+		]
+	with open(os.path.join(reco_dir, 'visu_pars'), 'w') as f:
+		f.write('\n'.join(visu_pars) + '\n')
+	reco = [
+		'##TITLE=Parameter List',
+		'##$RECO_size=( 2 )', '{} {}'.format(size_x, size_y),
+		'##$RECO_fov=( 2 )', array(np.asarray(extent) / 10.),
+		'##$RECO_wordtype=_16BIT_SGN_INT',
+		'##$RECO_byte_order=littleEndian',
+		'##$RECO_map_slope=( {} )'.format(frame_count), array(1. / np.asarray(slopes)),
+		'##$RECO_transposition=( {} )'.format(slices), array(np.zeros(slices, dtype=int)),
+		'##END=',
+		]
+	with open(os.path.join(reco_dir, 'reco'), 'w') as f:
+		f.write('\n'.join(reco) + '\n')
+	slice_distance = np.linalg.norm(np.asarray(positions[1]) - positions[0]) if slices > 1 else 0.5
+	acqp = [
+		'##TITLE=Parameter List',
+		'##$ACQ_protocol_name=( 64 )', '<synthetic>',
+		'##$NI={}'.format(slices),
+		'##$NR={}'.format(cycles),
+		'##$ACQ_slice_thick=0.5',
+		'##$ACQ_slice_sepn=( 1 )', '{:g}'.format(slice_distance),
+		'##$ACQ_repetition_time=( 1 )', '{:g}'.format(repetition_time),
+		'##END=',
+		]
+	with open(os.path.join(scan_dir, 'acqp'), 'w') as f:
+		f.write('\n'.join(acqp) + '\n')
+	method = [
+		'##TITLE=Parameter List',
+		'##$PVM_SPackArrSliceDistance=( 1 )', '{:g}'.format(slice_distance),
+		'##$PVM_NRepetitions={}'.format(cycles),
+		'##END=',
+		]
+	with open(os.path.join(scan_dir, 'method'), 'w') as f:
+		f.write('\n'.join(method) + '\n')
+
+def test_set_nifti_output_type():
+	import nipype.pipeline.engine as pe
+	from nipype.interfaces import fsl
+	from samri.pipelines.utils import set_nifti_output_type
+
+	default_output_type = fsl.MeanImage().inputs.output_type
+	output_type = 'NIFTI' if default_output_type == 'NIFTI_GZ' else 'NIFTI_GZ'
+	workflow = pe.Workflow(name='output_type')
+	mean = pe.Node(fsl.MeanImage(), name='mean')
+	maths = pe.MapNode(fsl.ImageMaths(), iterfield=['in_file'], name='maths')
+	workflow.connect([(mean, maths, [('out_file', 'in_file')])])
+	set_nifti_output_type(workflow, compress=output_type == 'NIFTI_GZ')
+
+	assert mean.inputs.output_type == output_type
+	assert mean.interface.inputs.environ['FSLOUTPUTTYPE'] == output_type
+	assert maths.interface.inputs.output_type == output_type
+	# Interfaces created outside of the workflow are unaffected.
+	assert fsl.MeanImage().inputs.output_type == default_output_type
+
+def test_native_bru2(tmp_path):
+	from samri.pipelines.extra_interfaces import NativeBru2
+	import nibabel as nib
+
+	raw = np.random.RandomState(0).randint(-300, 3000, size=(6,5,3,4)).astype(np.int16)
+	positions = [[-1.,-2.,-0.5], [-1.,-2.,0.25], [-1.,-2.,1.]]
+	scan_dir = str(tmp_path / 'raw' / '5')
+	_write_bruker_scan(scan_dir, raw, np.full(12, 0.25), np.eye(3).ravel(), positions, [3., 2.5])
+
+	converter = NativeBru2()
+	converter.inputs.input_dir = scan_dir
+	converter.inputs.actual_size = True
+	converter.inputs.compress = True
+	converter.inputs.output_filename = str(tmp_path / 'converted')
+	converter.inputs.chunk_size = 3
+	result = converter.run()
+
+	img = nib.load(result.outputs.nii_file)
+	assert result.outputs.nii_file.endswith('converted.nii.gz')
+	assert img.shape == (6,5,3,4)
+	assert img.get_data_dtype() == np.int16
+	assert np.allclose(img.get_fdata(), raw * 0.25)
+	expected_affine = np.array([
+		[-0.5,0,0,1],
+		[0,-0.5,0,2],
+		[0,0,0.75,-0.5],
+		[0,0,0,1],
+		])
+	assert np.allclose(img.affine, expected_affine)
+	assert np.isclose(img.header.get_zooms()[3], 1.)
+
+	# Flipping is applied while writing, at an unchanged affine, and the unscaled voxel size is inflated tenfold.
+	converter.inputs.flip = True
+	converter.inputs.actual_size = False
+	converter.inputs.output_filename = str(tmp_path / 'flipped')
+	flipped = nib.load(converter.run().outputs.nii_file)
+	assert np.allclose(flipped.get_fdata(), raw[::-1,::-1] * 0.25)
+	assert np.allclose(flipped.affine[:3], expected_affine[:3] * 10)
+
+def test_native_bru2_frame_scaling(tmp_path):
+	from samri.pipelines.extra_interfaces import NativeBru2
+	import nibabel as nib
+
+	raw = np.random.RandomState(1).randint(0, 1000, size=(4,4,2,3)).astype(np.int16)
+	slopes = np.linspace(0.1, 1.2, 6)
+	scan_dir = str(tmp_path / 'raw' / '7')
+	_write_bruker_scan(scan_dir, raw, slopes, np.eye(3).ravel(), [[0,0,0], [0,0,1]], [2., 2.])
+
+	converter = NativeBru2()
+	converter.inputs.input_dir = scan_dir
+	converter.inputs.actual_size = True
+	converter.inputs.output_filename = str(tmp_path / 'converted')
+	img = nib.load(converter.run().outputs.nii_file)
+	# Frames are ordered with the slice varying fastest.
+	expected = raw * slopes.reshape((2,3), order='F')
+	assert img.get_data_dtype() == np.float32
+	assert np.allclose(img.get_fdata(), expected, rtol=1e-6)
+
+@pytest.mark.skipif(shutil.which('Bru2') is None, reason='The `Bru2` converter is not installed.')
+def test_native_bru2_parity(tmp_path):
+	from samri.pipelines.extra_interfaces import Bru2, NativeBru2
+	import nibabel as nib
+
+	raw = np.random.RandomState(2).randint(0, 3000, size=(8,6,4,5)).astype(np.int16)
+	orientation = [0.9993, 0.0372, -0.0029, -0.0373, 0.9943, -0.1000, -0.0008, 0.1000, 0.9950]
+	positions = [[-4.9, -2.3, -1.5 + 0.65 * i] for i in range(4)]
+	scan_dir = str(tmp_path / 'raw' / '9')
+	_write_bruker_scan(scan_dir, raw, np.full(20, 0.0535), orientation, positions, [10., 4.5])
+
+	images = []
+	for interface in [Bru2, NativeBru2]:
+		converter = interface()
+		converter.inputs.input_dir = scan_dir
+		converter.inputs.actual_size = True
+		converter.inputs.compress = True
+		converter.inputs.output_filename = str(tmp_path / interface.__name__)
+		images.append(nib.load(converter.run().outputs.nii_file))
+	reference, native = images
+	assert reference.shape == native.shape
+	assert np.allclose(reference.get_fdata(), native.get_fdata(), rtol=1e-5)
+	assert np.allclose(reference.affine, native.affine, atol=1e-3)
+
+def _write_vest(file_path, matrix, names=[]):
+	with open(file_path, 'w') as f:
+		for ix, name in enumerate(names):
+			f.write(f'/ContrastName{ix+1}\t{name}\n')
+		f.write(f'/NumWaves\t{matrix.shape[1]}\n/NumPoints\t{matrix.shape[0]}\n/Matrix\n')
+		for row in matrix:
+			f.write(' '.join(str(i) for i in row) + '\n')
+
+def test_native_glm(tmp_path):
+	from samri.pipelines.extra_interfaces import NativeGLM
+	import nibabel as nib
+
+	rng = np.random.RandomState(0)
+	volumes = 80
+	design = np.column_stack([np.sin(np.arange(volumes)/4.), (np.arange(volumes)%16 < 8).astype(float)])
+	contrasts = np.array([[1.,0.],[1.,-1.]])
+	betas = rng.normal(size=(2,5,4,3))
+	# Serially correlated (AR(1)) noise, for the prewhitened fit to correct.
+	noise = rng.normal(size=(5,4,3,volumes))
+	for t in range(1, volumes):
+		noise[...,t] += 0.5 * noise[...,t-1]
+	data = np.einsum('tp,pxyz->xyzt', design, betas) + noise
+	in_file = f'{tmp_path}/ts.nii.gz'
+	nib.save(nib.Nifti1Image(data.astype(np.float32), np.eye(4)), in_file)
+	mask = np.zeros((5,4,3), dtype=np.uint8)
+	mask[1:4,1:3] = 1
+	nib.save(nib.Nifti1Image(mask, np.eye(4)), f'{tmp_path}/mask.nii.gz')
+	_write_vest(f'{tmp_path}/design.mat', design)
+	_write_vest(f'{tmp_path}/design.con', contrasts, names=['a','a-b'])
+
+	glm = NativeGLM()
+	glm.inputs.in_file = in_file
+	glm.inputs.design = f'{tmp_path}/design.mat'
+	glm.inputs.contrasts = f'{tmp_path}/design.con'
+	glm.inputs.mask = f'{tmp_path}/mask.nii.gz'
+	glm.inputs.out_file = f'{tmp_path}/betas.nii.gz'
+	glm.inputs.out_cope = f'{tmp_path}/cope.nii.gz'
+	glm.inputs.out_varcb_name = f'{tmp_path}/varcb.nii.gz'
+	glm.inputs.out_t_name = f'{tmp_path}/tstat.nii.gz'
+	glm.inputs.out_z_name = f'{tmp_path}/zstat.nii.gz'
+	glm.inputs.chunk_size = 7
+	glm.inputs.block_size = 5
+	result = glm.run()
+
+	y = np.asarray(nib.load(in_file).dataobj, dtype=np.float64)[2,1,1]
+	expected_betas = np.linalg.lstsq(design, y, rcond=None)[0]
+	residuals = y - design.dot(expected_betas)
+	expected_varcb = np.diag(contrasts.dot(np.linalg.inv(design.T.dot(design))).dot(contrasts.T)) * residuals.dot(residuals) / (volumes - 2)
+	expected_t = contrasts.dot(expected_betas) / np.sqrt(expected_varcb)
+
+	betas_img = nib.load(result.outputs.out_file).get_fdata()
+	assert betas_img.shape == (5,4,3,2)
+	assert np.allclose(betas_img[2,1,1], expected_betas, rtol=1e-4)
+	assert np.all(betas_img[0] == 0)
+	assert np.allclose(nib.load(result.outputs.out_cope).get_fdata()[2,1,1], contrasts.dot(expected_betas), rtol=1e-4)
+	assert np.allclose(nib.load(result.outputs.out_varcb).get_fdata()[2,1,1], expected_varcb, rtol=1e-3)
+	tstat = nib.load(result.outputs.out_t).get_fdata()[2,1,1]
+	assert np.allclose(tstat, expected_t, rtol=1e-3)
+	zstat = nib.load(result.outputs.out_z).get_fdata()[2,1,1]
+	assert np.all(np.sign(zstat) == np.sign(tstat))
+	assert np.all(np.abs(zstat) <= np.abs(tstat))
+
+	glm.inputs.prewhiten = True
+	whitened = glm.run()
+	assert np.all(np.isfinite(nib.load(whitened.outputs.out_t).get_fdata()))
+
+	# Prais-Winsten refit, with the AR(1) coefficient estimated from the ordinary least squares residuals.
+	rho = np.clip(residuals[1:].dot(residuals[:-1]) / residuals.dot(residuals), -0.99, 0.99)
+	whitening = np.eye(volumes) - rho * np.eye(volumes, k=-1)
+	whitening[0,0] = np.sqrt(1 - rho**2)
+	whitened_design = whitening.dot(design)
+	whitened_y = whitening.dot(y)
+	expected_betas = np.linalg.lstsq(whitened_design, whitened_y, rcond=None)[0]
+	residuals = whitened_y - whitened_design.dot(expected_betas)
+	expected_varcb = np.diag(contrasts.dot(np.linalg.inv(whitened_design.T.dot(whitened_design))).dot(contrasts.T)) * residuals.dot(residuals) / (volumes - 2)
+	whitened_betas = nib.load(whitened.outputs.out_file).get_fdata()[2,1,1]
+	assert rho > 0.2
+	assert not np.allclose(whitened_betas, betas_img[2,1,1], rtol=1e-3)
+	assert np.allclose(whitened_betas, expected_betas, rtol=1e-4)
+	assert np.allclose(nib.load(whitened.outputs.out_varcb).get_fdata()[2,1,1], expected_varcb, rtol=1e-3)
+
+def test_cached_feat_model(tmp_path):
+	from samri.pipelines.extra_interfaces import CachedFEATModel
+	from samri.pipelines.utils import design_cache_key
+	import nibabel as nib
+
+	for scan in ['a','b']:
+		nib.save(nib.Nifti1Image(np.zeros((2,2,2,30), dtype=np.float32), np.eye(4)), f'{tmp_path}/{scan}.nii.gz')
+	session_info = [{'cond':[{'name':'ev0','onset':[10.,2.],'duration':[5.,1.],'amplitudes':[1,1]}], 'hpf':225., 'regress':[], 'scans':f'{tmp_path}/a.nii.gz'}]
+	equivalent = [{'cond':[{'name':'ev0','onset':[2.,10.0000001],'duration':[1.,5.],'amplitudes':[1,1]}], 'hpf':225., 'regress':[], 'scans':f'{tmp_path}/b.nii.gz'}]
+	bases = {'gamma': {'derivs':True, 'gammasigma':30, 'gammadelay':10}}
+	contrasts = [('allStim','T', ['ev0','ev1'],[1,1])]
+	key = design_cache_key(session_info, interscan_interval=1., bases=bases, contrasts=contrasts)
+	assert key == design_cache_key(equivalent, interscan_interval=1., bases=bases, contrasts=contrasts)
+	assert key != design_cache_key(equivalent, interscan_interval=2., bases=bases, contrasts=contrasts)
+	assert key != design_cache_key(session_info, interscan_interval=1., bases=bases, contrasts=contrasts[:0])
+
+	# A previously generated design is reused without running `feat_model`.
+	design_dir = tmp_path / 'cache' / design_cache_key(session_info, interscan_interval=1., bases=bases, model_serial_correlations=True, contrasts=contrasts)
+	design_dir.mkdir(parents=True)
+	for name in ['run0.mat', 'run0.con', 'run0.png', 'run0_cov.png']:
+		(design_dir / name).write_text('')
+	modelgen = CachedFEATModel()
+	modelgen.inputs.cache_dir = str(tmp_path / 'cache')
+	modelgen.inputs.session_info = equivalent
+	modelgen.inputs.interscan_interval = 1.
+	modelgen.inputs.bases = bases
+	modelgen.inputs.model_serial_correlations = True
+	modelgen.inputs.contrasts = contrasts
+	result = modelgen.run()
+	assert result.outputs.design_file == str(design_dir / 'run0.mat')
+	assert result.outputs.design_image == str(design_dir / 'run0.png')
+	assert result.outputs.design_cov == str(design_dir / 'run0_cov.png')
+	assert result.outputs.con_file == str(design_dir / 'run0.con')
+
+def _fsl_bptf(series, highpass_sigma, lowpass_sigma):
+	# Direct transcription of the `fslmaths -bptf` loops, for a single voxel.
+	series = np.array(series, dtype=np.float64)
+	size = len(series)
+	if highpass_sigma > 0:
+		width = int(highpass_sigma * 3)
+		done = np.empty(size)
+		for t in range(size):
+			a = b = c = d = n = 0.
+			for tt in range(max(t - width, 0), min(t + width, size - 1) + 1):
+				dt = tt - t
+				w = np.exp(-0.5 * dt * dt / highpass_sigma**2)
+				a += w * dt
+				b += w * series[tt]
+				c += w * dt * dt
+				d += w * dt * series[tt]
+				n += w
+			denominator = c * n - a * a
+			done[t] = series[t] - (b * c - a * d) / denominator if denominator != 0 else series[t]
+		series = done
+	if lowpass_sigma > 0:
+		width = int(lowpass_sigma * 20) + 2
+		kernel = np.exp(-0.5 * np.arange(-width, width + 1)**2 / lowpass_sigma**2)
+		kernel /= kernel.sum()
+		done = np.empty(size)
+		for t in range(size):
+			total = norm = 0.
+			for tt in range(max(t - width, 0), min(t + width, size - 1) + 1):
+				total += series[tt] * kernel[tt - t + width]
+				norm += kernel[tt - t + width]
+			done[t] = total / norm if norm > 0 else series[t]
+		series = done
+	return series
+
+def test_temporal_bandpass(tmp_path):
+	from samri.pipelines.extra_interfaces import TemporalBandpass
+	import nibabel as nib
+
+	data = np.random.RandomState(0).rand(4,3,5,60).astype(np.float32) * 100 + np.linspace(0, 50, 60)
+	in_file = f'{tmp_path}/ts.nii.gz'
+	nib.save(nib.Nifti1Image(data, np.eye(4)), in_file)
+
+	bandpass = TemporalBandpass()
+	bandpass.inputs.in_file = in_file
+	bandpass.inputs.out_file = f'{tmp_path}/bandpassed.nii.gz'
+	bandpass.inputs.highpass_sigma = 8
+	bandpass.inputs.lowpass_sigma = 1.5
+	# Small enough to force one slice per slab.
+	bandpass.inputs.max_memory_gb = 1e-5
+	result = bandpass.run()
+
+	filtered = nib.load(result.outputs.out_file).get_fdata()
+	assert filtered.shape == data.shape
+	for voxel in [(0,0,0), (3,2,4), (1,2,3)]:
+		assert np.allclose(filtered[voxel], _fsl_bptf(data[voxel], 8, 1.5), atol=1e-3)
+	assert list(tmp_path.glob('*.nii')) == []
+
+def test_native_glm_consolidated(tmp_path):
+	from samri.pipelines.extra_interfaces import NativeGLM
+	from samri.utilities import statistic_image
+	import json
+	import nibabel as nib
+
+	rng = np.random.RandomState(1)
+	volumes = 40
+	design = np.column_stack([np.sin(np.arange(volumes)/3.), np.ones(volumes)])
+	data = np.einsum('tp,pxyz->xyzt', design, rng.normal(size=(2,3,3,2))) + rng.normal(size=(3,3,2,volumes))
+	nib.save(nib.Nifti1Image(data.astype(np.float32), np.eye(4)), f'{tmp_path}/ts.nii.gz')
+	_write_vest(f'{tmp_path}/design.mat', design)
+	_write_vest(f'{tmp_path}/design.con', np.array([[1.,0.]]), names=['stim'])
+
+	glm = NativeGLM()
+	glm.inputs.in_file = f'{tmp_path}/ts.nii.gz'
+	glm.inputs.design = f'{tmp_path}/design.mat'
+	glm.inputs.contrasts = f'{tmp_path}/design.con'
+	glm.inputs.out_t_name = f'{tmp_path}/sub-1_ses-1_task-a_desc-tstat_cbv.nii.gz'
+	glm.inputs.out_glm_name = f'{tmp_path}/sub-1_ses-1_task-a_desc-glm_cbv.nii.gz'
+	result = glm.run()
+
+	assert result.outputs.out_glm_sidecar == f'{tmp_path}/sub-1_ses-1_task-a_desc-glm_cbv.json'
+	with open(result.outputs.out_glm_sidecar) as f:
+		sidecar = json.load(f)
+	assert sidecar['Contrasts'] == ['stim']
+	assert sidecar['Statistics']['betas'] == [0,1]
+	consolidated = nib.load(result.outputs.out_glm)
+	assert consolidated.get_data_dtype() == np.float32
+	assert consolidated.shape == (3,3,2,sum(len(i) for i in sidecar['Statistics'].values()))
+
+	tstat = nib.load(result.outputs.out_t).get_fdata()
+	assert np.allclose(statistic_image(result.outputs.out_glm, 'tstat').get_fdata(), tstat)
+	# Dedicated statistic file names resolve to the consolidated file if they do not exist.
+	assert statistic_image(f'{tmp_path}/sub-1_ses-1_task-a_desc-tstat_cbv.nii.gz').shape == (3,3,2)
+	assert statistic_image(f'{tmp_path}/sub-1_ses-1_task-a_desc-betas_cbv.nii.gz').shape == (3,3,2,2)
+	with pytest.raises(ValueError):
+		statistic_image(result.outputs.out_glm)
+
+def test_native_flameo(tmp_path, monkeypatch):
+	from samri.pipelines.extra_interfaces import NativeFLAMEO
+	from scipy.optimize import minimize_scalar
+	import nibabel as nib
+	import os
+
+	rng = np.random.RandomState(2)
+	maps = 10
+	design = np.column_stack([np.ones(maps), rng.normal(size=maps)])
+	variances = rng.uniform(0.2, 1., size=(maps,4,3,2)).astype(np.float32)
+	copes = (np.einsum('np,pxyz->nxyz', design, rng.normal(size=(2,4,3,2))) + rng.normal(size=(maps,4,3,2)) * np.sqrt(variances + 0.5)).astype(np.float32)
+	cope_files, var_cope_files = [], []
+	for i in range(maps):
+		cope_files.append(f'{tmp_path}/sub-{i}_cope.nii.gz')
+		var_cope_files.append(f'{tmp_path}/sub-{i}_varcb.nii.gz')
+		nib.save(nib.Nifti1Image(copes[i], np.eye(4)), cope_files[-1])
+		nib.save(nib.Nifti1Image(variances[i], np.eye(4)), var_cope_files[-1])
+	mask = np.ones((4,3,2), dtype=np.uint8)
+	mask[0] = 0
+	nib.save(nib.Nifti1Image(mask, np.eye(4)), f'{tmp_path}/mask.nii.gz')
+	_write_vest(f'{tmp_path}/design.mat', design)
+	_write_vest(f'{tmp_path}/design.con', np.eye(2))
+	_write_vest(f'{tmp_path}/design.fts', np.array([[1.,1.]]))
+	_write_vest(f'{tmp_path}/design.grp', np.ones((maps,1)))
+
+	y = copes[:,2,1,1].astype(np.float64)
+	v = variances[:,2,1,1].astype(np.float64)
+	def neg_log_likelihood(random_variance):
+		w = 1 / (v + random_variance)
+		gram = design.T.dot(w[:,None] * design)
+		residuals = y - design.dot(np.linalg.solve(gram, design.T.dot(w * y)))
+		return np.log(v + random_variance).sum() + np.linalg.slogdet(gram)[1] + (w * residuals**2).sum()
+	expected_variances = {
+		'ols': None,
+		'fe': 0,
+		'flame1': minimize_scalar(neg_log_likelihood, bounds=(0, 20), method='bounded').x,
+		}
+
+	monkeypatch.chdir(tmp_path)
+	for run_mode, random_variance in expected_variances.items():
+		if random_variance is None:
+			betas = np.linalg.lstsq(design, y, rcond=None)[0]
+			residuals = y - design.dot(betas)
+			covariance = np.linalg.inv(design.T.dot(design)) * residuals.dot(residuals) / (maps - 2)
+		else:
+			w = 1 / (v + random_variance)
+			covariance = np.linalg.inv(design.T.dot(w[:,None] * design))
+			betas = covariance.dot(design.T.dot(w * y))
+		flameo = NativeFLAMEO()
+		flameo.inputs.cope_files = cope_files
+		flameo.inputs.var_cope_files = var_cope_files
+		flameo.inputs.mask_file = f'{tmp_path}/mask.nii.gz'
+		flameo.inputs.design_file = f'{tmp_path}/design.mat'
+		flameo.inputs.t_con_file = f'{tmp_path}/design.con'
+		flameo.inputs.f_con_file = f'{tmp_path}/design.fts'
+		flameo.inputs.cov_split_file = f'{tmp_path}/design.grp'
+		flameo.inputs.run_mode = run_mode
+		flameo.inputs.block_size = 4
+		result = flameo.run()
+
+		assert [os.path.basename(i) for i in result.outputs.copes] == ['cope1.nii.gz', 'cope2.nii.gz']
+		assert np.allclose([nib.load(i).get_fdata()[2,1,1] for i in result.outputs.copes], betas, rtol=1e-3)
+		assert np.allclose([nib.load(i).get_fdata()[2,1,1] for i in result.outputs.tstats], betas / np.sqrt(np.diag(covariance)), rtol=1e-3)
+		fstat = betas.dot(np.linalg.inv(covariance)).dot(betas) / 2
+		assert np.allclose(nib.load(result.outputs.fstats).get_fdata()[2,1,1], fstat, rtol=1e-3)
+		assert np.all(nib.load(result.outputs.copes[0]).get_fdata()[0] == 0)
+		if run_mode == 'flame1':
+			assert np.allclose(nib.load(result.outputs.mrefvars).get_fdata()[2,1,1], random_variance, rtol=1e-3, atol=1e-5)
+		# The temporary stacks are removed.
+		assert not [i for i in os.listdir(tmp_path) if i.startswith('l2_stack_')]
+
+def test_permutation_test(tmp_path, monkeypatch):
+	from samri.pipelines.extra_interfaces import PermutationTest
+	import itertools
+	import nibabel as nib
+	import os
+
+	rng = np.random.RandomState(3)
+	maps = 7
+	data = rng.normal(size=(maps,5,4,3)).astype(np.float32)
+	data[:,1:3,1:3,1:] += 4
+	cope_files = []
+	for i in range(maps):
+		cope_files.append(f'{tmp_path}/sub-{i}_cope.nii.gz')
+		nib.save(nib.Nifti1Image(data[i], np.eye(4)), cope_files[-1])
+	mask = np.ones((5,4,3), dtype=np.uint8)
+	mask[4] = 0
+	nib.save(nib.Nifti1Image(mask, np.eye(4)), f'{tmp_path}/mask.nii.gz')
+	_write_vest(f'{tmp_path}/design.mat', np.ones((maps,1)))
+	_write_vest(f'{tmp_path}/design.con', np.array([[1.],[-1.]]))
+
+	monkeypatch.chdir(tmp_path)
+	randomise = PermutationTest()
+	randomise.inputs.cope_files = cope_files
+	randomise.inputs.mask = f'{tmp_path}/mask.nii.gz'
+	randomise.inputs.design_mat = f'{tmp_path}/design.mat'
+	randomise.inputs.tcon = f'{tmp_path}/design.con'
+	randomise.inputs.batch_size = 10
+	randomise.inputs.block_size = 7
+	randomise.inputs.num_threads = 2
+	result = randomise.run()
+
+	# With 7 maps, all 128 sign-flips are enumerated.
+	y = data.reshape(maps, -1)[:, mask.reshape(-1) > 0].astype(np.float64)
+	tstats = []
+	for signs in itertools.product([1., -1.], repeat=maps):
+		flipped = y * np.array(signs)[:, None]
+		tstats.append(flipped.mean(axis=0) / flipped.std(axis=0, ddof=1) * np.sqrt(maps))
+	tstats = np.array(tstats)
+	observed = tstats[0]
+	expected_p = (tstats >= observed - 1e-6).mean(axis=0)
+	expected_corrp = (tstats.max(axis=1)[:, None] >= observed - 1e-6).mean(axis=0)
+
+	assert [i.split('/')[-1] for i in result.outputs.tstat_files] == ['randomise_tstat1.nii.gz', 'randomise_tstat2.nii.gz']
+	tstat = nib.load(result.outputs.tstat_files[0]).get_fdata()[mask > 0]
+	assert np.allclose(tstat, observed, rtol=1e-4)
+	assert np.allclose(nib.load(result.outputs.tstat_files[1]).get_fdata()[mask > 0], -observed, rtol=1e-4)
+	assert np.allclose(nib.load(result.outputs.vox_p_files[0]).get_fdata()[mask > 0], 1 - expected_p)
+	assert np.allclose(nib.load(result.outputs.vox_corrected_p_files[0]).get_fdata()[mask > 0], 1 - expected_corrp)
+	tfce_corrp = nib.load(result.outputs.t_corrected_p_files[0]).get_fdata()
+	assert result.outputs.t_corrected_p_files[0].endswith('randomise_tfce_corrp_tstat1.nii.gz')
+	assert tfce_corrp[1:3,1:3,1:].min() > 0.95
+	assert not [i for i in os.listdir(tmp_path) if i.startswith('permutation_stack_')]
+
+def test_bids_gen_info(tmp_path):
+	from samri.pipelines.extra_interfaces import bids_gen_info, read_bids_events
+
+	events = 'onset\tduration\ttrial_type\tintensity\n1.234\t2\tb\t0.5\n3\t1\ta\t2\n5.1\t1.5\tb\t1\n'
+	for name in ['run1', 'run2']:
+		with open(f'{tmp_path}/{name}_events.tsv', 'w') as f:
+			f.write(events)
+	event_files = [f'{tmp_path}/run1_events.tsv', f'{tmp_path}/run2_events.tsv']
+
+	info = bids_gen_info(event_files, time_repetition=0.1)
+	assert len(info) == 2
+	assert info[0].conditions == ['a', 'b']
+	assert info[0].onsets == [[3.], [1.2, 5.1]]
+	assert info[0].durations == [[1.], [2., 1.5]]
+	assert info[0].amplitudes == [[1], [1, 1]]
+	assert info[1].dictcopy() == info[0].dictcopy()
+	info = bids_gen_info(event_files[:1], condition_column='', amplitude_column='intensity')
+	assert info[0].conditions == ['ev0']
+	assert info[0].onsets == [[1.234, 3., 5.1]]
+	assert info[0].amplitudes == [[0.5, 2., 1.]]
+	# Files with identical content are parsed only once.
+	assert read_bids_events(event_files[0]) is read_bids_events(event_files[1])
+	# Rows omitting trailing optional columns are accepted, with empty values.
+	with open(f'{tmp_path}/short_events.tsv', 'w') as f:
+		f.write('onset\tduration\ttrial_type\tresponse_time\n1\t2\ta\t0.3\n3\t1\tb\n')
+	events = read_bids_events(f'{tmp_path}/short_events.tsv')
+	assert events['trial_type'].tolist() == ['a', 'b']
+	assert events['response_time'].tolist() == ['0.3', '']
+	info = bids_gen_info([f'{tmp_path}/short_events.tsv'])
+	assert info[0].onsets == [[1.], [3.]]
+
+def test_seed_glm(tmp_path, monkeypatch):
+	from samri.pipelines.extra_interfaces import SeedGLM
+	from samri.pipelines.utils import bandpass_filter, read_vest, seed_voxels
+	import nibabel as nib
+
+	monkeypatch.chdir(tmp_path)
+	rng = np.random.RandomState(3)
+	volumes = 60
+	signal = rng.normal(size=volumes)
+	data = 100 + rng.normal(size=(5,4,3,volumes))
+	data[1:3,1:3,1] += 2 * signal
+	data[4,3,2] += signal
+	nib.save(nib.Nifti1Image(data.astype(np.float32), np.eye(4)), f'{tmp_path}/ts.nii.gz')
+	seed = np.zeros((5,4,3), dtype=np.uint8)
+	seed[1:3,1:3,1] = 1
+	nib.save(nib.Nifti1Image(seed, np.eye(4)), f'{tmp_path}/seed.nii.gz')
+	mask = np.ones((5,4,3), dtype=np.uint8)
+	mask[0] = 0
+	nib.save(nib.Nifti1Image(mask, np.eye(4)), f'{tmp_path}/mask.nii.gz')
+
+	glm = SeedGLM()
+	glm.inputs.in_file = f'{tmp_path}/ts.nii.gz'
+	glm.inputs.seed_voxels = seed_voxels(f'{tmp_path}/seed.nii.gz').tolist()
+	glm.inputs.mask = f'{tmp_path}/mask.nii.gz'
+	glm.inputs.metric = 'median'
+	glm.inputs.highpass_cutoff = 30
+	glm.inputs.tr = 2
+	glm.inputs.out_file = f'{tmp_path}/betas.nii.gz'
+	glm.inputs.out_t_name = f'{tmp_path}/tstat.nii.gz'
+	glm.inputs.out_design_name = f'{tmp_path}/design.mat'
+	glm.inputs.chunk_size = 7
+	glm.inputs.block_size = 5
+	result = glm.run()
+
+	timecourse = np.median(np.asarray(nib.load(f'{tmp_path}/ts.nii.gz').dataobj, dtype=np.float64)[1:3,1:3,1].reshape(-1,volumes), axis=0)
+	regressor = bandpass_filter(timecourse - timecourse.mean(), highpass_sigma=7.5)
+	regressor -= regressor.mean()
+	design, _ = read_vest(result.outputs.out_design)
+	assert np.allclose(design[:,0], regressor, rtol=1e-5)
+
+	y = np.asarray(nib.load(f'{tmp_path}/ts.nii.gz').dataobj, dtype=np.float64)[4,3,2]
+	beta = regressor.dot(y) / regressor.dot(regressor)
+	residuals = y - beta * regressor
+	expected_t = beta / np.sqrt(residuals.dot(residuals) / (volumes - 1) / regressor.dot(regressor))
+	assert np.allclose(nib.load(result.outputs.out_file).get_fdata()[4,3,2], beta, rtol=1e-4)
+	tstat = nib.load(result.outputs.out_t).get_fdata()
+	assert np.allclose(tstat[4,3,2], expected_t, rtol=1e-3)
+	assert np.all(tstat[0] == 0)
+	assert not list(tmp_path.glob('seed_stack_*'))
+
+	masked = SeedGLM()
+	masked.inputs.in_file = f'{tmp_path}/ts.nii.gz'
+	masked.inputs.seed_mask = f'{tmp_path}/seed.nii.gz'
+	masked.inputs.mask = f'{tmp_path}/mask.nii.gz'
+	masked.inputs.metric = 'median'
+	masked.inputs.highpass_cutoff = 30
+	masked.inputs.tr = 2
+	masked.inputs.out_t_name = f'{tmp_path}/tstat_masked.nii.gz'
+	assert np.allclose(nib.load(masked.run().outputs.out_t).get_fdata(), tstat)
+
+def test_anova_design(tmp_path, monkeypatch):
+	from samri.pipelines.extra_interfaces import NativeFLAMEO
+	from samri.pipelines.utils import anova_design
+	import nibabel as nib
+	import pandas as pd
+
+	monkeypatch.chdir(tmp_path)
+	observations = pd.DataFrame({'subject': list('123412341234'), 'session': list('aaaabbbbcccc')})
+	regressors, contrasts = anova_design(observations, 'session', block='subject')
+	assert list(regressors) == ['sub-1','sub-2','sub-3','sub-4','ses-(b-a)','ses-(c-a)']
+	assert regressors['ses-(c-a)'] == [0]*8 + [1]*4
+	assert [i[0] for i in contrasts] == ['ses-(b-a)','ses-(c-a)','anova']
+	assert contrasts[2][1] == 'F' and contrasts[2][2] == contrasts[:2]
+	with pytest.raises(ValueError):
+		anova_design(observations[observations['session'] == 'a'], 'session')
+	# Levels are taken in order of appearance, the first one being the reference.
+	unsorted_regressors, unsorted_contrasts = anova_design(observations.iloc[::-1], 'session', block='subject')
+	assert list(unsorted_regressors) == ['sub-4','sub-3','sub-2','sub-1','ses-(b-c)','ses-(a-c)']
+	assert unsorted_regressors['ses-(a-c)'] == [0]*8 + [1]*4
+
+	design = np.column_stack(list(regressors.values())).astype(float)
+	rng = np.random.RandomState(4)
+	data = rng.normal(size=(len(design),3,3,2)) + 3 * design[:,5,None,None,None]
+	cope_files = []
+	for i, volume in enumerate(data):
+		cope_files.append(f'{tmp_path}/cope{i}.nii.gz')
+		nib.save(nib.Nifti1Image(volume.astype(np.float32), np.eye(4)), cope_files[-1])
+	nib.save(nib.Nifti1Image(np.ones((3,3,2), dtype=np.uint8), np.eye(4)), f'{tmp_path}/mask.nii.gz')
+	_write_vest(f'{tmp_path}/design.mat', design)
+	_write_vest(f'{tmp_path}/design.con', np.eye(6)[4:])
+	_write_vest(f'{tmp_path}/design.fts', np.ones((1,2)))
+
+	flameo = NativeFLAMEO()
+	flameo.inputs.cope_files = cope_files
+	flameo.inputs.mask_file = f'{tmp_path}/mask.nii.gz'
+	flameo.inputs.design_file = f'{tmp_path}/design.mat'
+	flameo.inputs.t_con_file = f'{tmp_path}/design.con'
+	flameo.inputs.f_con_file = f'{tmp_path}/design.fts'
+	flameo.inputs.run_mode = 'ols'
+	result = flameo.run()
+	assert len(result.outputs.tstats) == 2
+
+	# The F-test of the single fit equals the comparison with the model lacking the session regressors.
+	y = data[:,1,2,0]
+	rss_full = np.sum((y - design.dot(np.linalg.lstsq(design, y, rcond=None)[0]))**2)
+	rss_reduced = np.sum((y - design[:,:4].dot(np.linalg.lstsq(design[:,:4], y, rcond=None)[0]))**2)
+	expected_f = (rss_reduced - rss_full) / 2 / (rss_full / (len(y) - 6))
+	assert np.isclose(nib.load(result.outputs.fstats).get_fdata()[1,2,0], expected_f, rtol=1e-4)
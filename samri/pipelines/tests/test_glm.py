@@ -1,4 +1,4 @@
-from samri.pipelines.glm import l1, l1_physio, seed
+from samri.pipelines.glm import l1, l1_physio, l2_batch, seed
 
 PREPROCESS_BASE = '/usr/share/samri_bidsdata/preprocessing'
 
@@ -10,6 +10,54 @@ def test_l1(tmp_path):
 		workflow_name='l1',
 		)
 
+def test_l2_batch(tmp_path):
+	import nibabel as nib
+	import numpy as np
+	from os import path
+
+	rng = np.random.default_rng(0)
+	affine = np.eye(4)
+	mask_file = str(tmp_path / 'mask.nii.gz')
+	mask = np.zeros((4,4,3), dtype=np.uint8)
+	mask[1:3,1:3,:] = 1
+	nib.save(nib.Nifti1Image(mask, affine), mask_file)
+	copes = rng.normal(1, 1, (6,4,4,3)).astype(np.float32)
+	cope_files = []
+	var_cope_files = []
+	for ix, cope in enumerate(copes):
+		cope_files.append(str(tmp_path / 'cope_{}.nii.gz'.format(ix)))
+		var_cope_files.append(str(tmp_path / 'varcope_{}.nii.gz'.format(ix)))
+		nib.save(nib.Nifti1Image(cope, affine), cope_files[-1])
+		nib.save(nib.Nifti1Image(np.full(cope.shape, .5, dtype=np.float32), affine), var_cope_files[-1])
+	jobs = [
+		{'name': 'ols', 'cope_files': cope_files, 'run_mode': 'ols'},
+		{'name': 'missing', 'cope_files': cope_files[:-1] + [str(tmp_path / 'missing.nii.gz')], 'run_mode': 'ols'},
+		{'name': 'flame1', 'cope_files': cope_files, 'var_cope_files': var_cope_files},
+		]
+	out_dir = str(tmp_path / 'l2')
+	summary = l2_batch(jobs, out_dir,
+		mask=mask_file,
+		n_jobs_percentage=.5,
+		statistics=['cope','tstat'],
+		)
+
+	assert list(summary['name']) == ['ols', 'missing', 'flame1']
+	assert list(summary['status']) == ['completed', 'failed', 'completed']
+	assert summary['error'][1]
+	assert not path.exists(path.join(out_dir, 'missing_cope.nii.gz'))
+	for name in ['ols', 'flame1']:
+		for statistic in ['cope', 'tstat']:
+			assert path.isfile(path.join(out_dir, '{}_{}.nii.gz'.format(name, statistic)))
+	inside = mask.astype(bool)
+	cope = nib.load(path.join(out_dir, 'ols_cope.nii.gz')).get_fdata()
+	tstat = nib.load(path.join(out_dir, 'ols_tstat.nii.gz')).get_fdata()
+	mean = copes.mean(axis=0)
+	np.testing.assert_allclose(cope[inside], mean[inside], rtol=1e-4, atol=1e-5)
+	np.testing.assert_allclose(tstat[inside], (mean/(copes.std(axis=0, ddof=1)/np.sqrt(len(copes))))[inside], rtol=1e-3)
+	np.testing.assert_array_equal(cope[~inside], 0)
+	flame1_cope = nib.load(path.join(out_dir, 'flame1_cope.nii.gz')).get_fdata()
+	np.testing.assert_allclose(flame1_cope[inside], mean[inside], rtol=1e-4, atol=1e-5)
+
 # Takes too long or hangs
 #def test_physio():
 #	l1_physio(PREPROCESS_BASE, 'astrocytes',
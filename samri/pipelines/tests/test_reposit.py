@@ -13,3 +13,25 @@ def test_bru2bids(tmp_path):
 		#keep_crashdump=True,
 		keep_work=True,
 		)
+
+def test_record_conversions(tmp_path):
+	import os
+	import time
+	from samri.pipelines.reposit import _record_conversions
+
+	run_start = time.time()
+	outputs = {}
+	for scan in ['reconverted', 'failed', 'new']:
+		outputs[scan] = [f'{tmp_path}/sub-{scan}_bold.nii.gz', f'{tmp_path}/sub-{scan}_bold.json']
+	# The previous conversions of the modified scans remain in place, but only one of them is written anew in this run.
+	for scan, mtime in [('reconverted', run_start + 1), ('failed', run_start - 100)]:
+		for output in outputs[scan]:
+			open(output, 'w').close()
+			os.utime(output, (mtime, mtime))
+	conversions = {f'func:{scan}': {'source': scan, 'signature': 'old', 'samri_version': '1', 'outputs': outputs[scan]} for scan in ['reconverted', 'failed']}
+	records = {'func': {ix: {'key': f'func:{scan}', 'source': scan, 'signature': 'new', 'samri_version': '1', 'outputs': outputs[scan]} for ix, scan in enumerate(['reconverted', 'failed', 'new'])}}
+	_record_conversions(records, conversions, run_start)
+	assert conversions['func:reconverted']['signature'] == 'new'
+	# Failed reconversions keep their previous record, so that incremental runs retry them.
+	assert conversions['func:failed']['signature'] == 'old'
+	assert 'func:new' not in conversions
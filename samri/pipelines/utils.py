@@ -3,6 +3,7 @@
 from __future__ import print_function, division, unicode_literals, absolute_import
 import csv
 import os
+import re
 import pandas as pd
 # PyBIDS 0.6.5 and 0.10.2 compatibility
 try:
@@ -15,6 +16,7 @@ except ModuleNotFoundError:
 	from bids_validator import BIDSValidator
 from copy import deepcopy
 from datetime import datetime
+from functools import lru_cache
 from shutil import copyfile
 
 GENERIC_PHASES = {
@@ -129,6 +131,36 @@ GENERIC_PHASES = {
 		},
 	}
 
+# Entity patterns as defined in the PyBIDS configuration, in the same order.
+BIDS_ENTITY_PATTERNS = [
+	('subject', r'[/\\]+sub-([a-zA-Z0-9+]+)', str),
+	('session', r'[_/\\]+ses-([a-zA-Z0-9+]+)', str),
+	('sample', r'[_/\\]+sample-([a-zA-Z0-9+]+)', str),
+	('task', r'[_/\\]+task-([a-zA-Z0-9+]+)', str),
+	('tracksys', r'[_/\\]+tracksys-([a-zA-Z0-9+]+)', str),
+	('acquisition', r'[_/\\]+acq-([a-zA-Z0-9+]+)', str),
+	('nucleus', r'[_/\\]+nuc-([a-zA-Z0-9+]+)', str),
+	('volume', r'[_/\\]+voi-([a-zA-Z0-9+]+)', str),
+	('ceagent', r'[_/\\]+ce-([a-zA-Z0-9+]+)', str),
+	('staining', r'[_/\\]+stain-([a-zA-Z0-9+]+)', str),
+	('tracer', r'[_/\\]+trc-([a-zA-Z0-9+]+)', str),
+	('reconstruction', r'[_/\\]+rec-([a-zA-Z0-9+]+)', str),
+	('direction', r'[_/\\]+dir-([a-zA-Z0-9+]+)', str),
+	('run', r'[_/\\]+run-(\d+)', int),
+	('proc', r'[_/\\]+proc-([a-zA-Z0-9+]+)', str),
+	('modality', r'[_/\\]+mod-([a-zA-Z0-9+]+)', str),
+	('echo', r'[_/\\]+echo-([0-9]+)', str),
+	('flip', r'[_/\\]+flip-([0-9]+)', str),
+	('inv', r'[_/\\]+inv-([0-9]+)', str),
+	('mt', r'[_/\\]+mt-(on|off)', str),
+	('part', r'[_/\\]+part-(imag|mag|phase|real)', str),
+	('recording', r'[_/\\]+recording-([a-zA-Z0-9+]+)', str),
+	('space', r'[_/\\]+space-([a-zA-Z0-9+]+)', str),
+	('chunk', r'[_/\\]+chunk-([0-9]+)', str),
+	('suffix', r'(?:^|[_/\\])([a-zA-Z0-9+]+)\.[^/\\]+$', str),
+	('datatype', r'[/\\]+(anat|beh|dwi|eeg|fmap|func|ieeg|meg|micr|motion|mrs|nirs|perf|pet)[/\\]+', str),
+	('extension', r'[^./\\](\.[^/\\]+)$', str),
+	]
 TRANSFORM_PHASES = {
 	"rigid":{
 		"transforms":"Rigid",
@@ -361,6 +393,296 @@ def parse_paravision_date(pv_date):
 	pv_date = datetime.strptime(pv_date, "%Y-%m-%dT%H:%M:%S,%f")
 	return pv_date
 
+def _jcampdx_scalar(value):
+	value = value.strip()
+	if value.startswith('<') and value.endswith('>'):
+		return value[1:-1]
+	for value_type in (int, float):
+		try:
+			return value_type(value)
+		except ValueError:
+			pass
+	return value
+
+def _jcampdx_struct(value):
+	return tuple(_jcampdx_scalar(i) for i in re.findall(r'<[^>]*>|[^,\s][^,]*', value))
+
+def _jcampdx_value(value):
+	"""Convert the raw value of a JCAMP-DX record to a Python object."""
+	import numpy as np
+
+	array = re.match(r'^\( (?P<shape>\d+(?:, \d+)*) \)\n?(?P<data>.*)$', value, re.S)
+	if not array:
+		if value.startswith('(') and value.endswith(')'):
+			return _jcampdx_struct(value[1:-1])
+		return _jcampdx_scalar(value)
+	shape = tuple(int(i) for i in array.group('shape').split(','))
+	data = array.group('data')
+	if data.startswith('<'):
+		# Long strings are wrapped over multiple lines without additional whitespace.
+		strings = re.findall(r'<([^>]*)>', data.replace('\n', ''))
+		return strings[0] if len(strings) == 1 else strings
+	if data.startswith('('):
+		return [_jcampdx_struct(i) for i in re.findall(r'\(([^()]*)\)', data)]
+	items = []
+	for item in data.split():
+		# ParaVision run-length encodes repeated values as `@count*(value)`.
+		repeat = re.match(r'^@(?P<count>\d+)\*\((?P<value>.*)\)$', item)
+		if repeat:
+			items.extend([repeat.group('value')] * int(repeat.group('count')))
+		else:
+			items.append(item)
+	items = [_jcampdx_scalar(i) for i in items]
+	if all(isinstance(i, (int, float)) for i in items):
+		items = np.array(items)
+		if items.size == np.prod(shape):
+			items = items.reshape(shape)
+	return items
+
+def parse_jcampdx(text):
+	"""Parse the text of a JCAMP-DX parameter file, as written by Bruker ParaVision.
+
+	Parameters
+	----------
+
+	text : str
+		Content of the parameter file.
+
+	Returns
+	-------
+
+	dict : Dictionary with parameter names (without the `##` or `##$` prefix) as keys, and typed values.
+		Strings are returned without their enclosing angle brackets, numeric arrays as `numpy.ndarray` objects shaped according to the declared dimensions, and structures as tuples.
+	"""
+	parameters = {}
+	for record in re.split(r'^##', text, flags=re.M)[1:]:
+		key, _, value = record.partition('=')
+		value = '\n'.join(i for i in value.splitlines() if not i.startswith('$$')).strip()
+		parameters[key.lstrip('$')] = _jcampdx_value(value)
+	return parameters
+
+@lru_cache(maxsize=256)
+def _jcampdx_file(file_path, mtime):
+	with open(file_path, errors='replace') as f:
+		text = f.read()
+	return tuple(text.splitlines(keepends=True)), parse_jcampdx(text)
+
+def read_jcampdx(file_path,
+	lines=False,
+	):
+	"""Read a Bruker ParaVision JCAMP-DX parameter file (e.g. `acqp`, `method`, `visu_pars`, or `subject`).
+
+	Results are memoized by path and modification time, so that repeated queries of the same file only read and parse it once.
+
+	Parameters
+	----------
+
+	file_path : str
+		Path to the parameter file.
+	lines : bool, optional
+		Whether to return the raw lines of the file instead of the parsed parameters.
+
+	Returns
+	-------
+
+	dict or tuple of str : Parameter dictionary as returned by `samri.pipelines.utils.parse_jcampdx`, or the lines of the file, if `lines` is `True`.
+		The parameter dictionary is a shallow copy of the cached dictionary, values should not be modified in-place.
+	"""
+	file_path = os.path.abspath(os.path.expanduser(file_path))
+	file_lines, parameters = _jcampdx_file(file_path, os.stat(file_path).st_mtime_ns)
+	if lines:
+		return file_lines
+	return dict(parameters)
+
+BRUKER_WORD_TYPES = {
+	'_8BIT_UNSGN_INT':'u1',
+	'_16BIT_SGN_INT':'i2',
+	'_32BIT_SGN_INT':'i4',
+	'_32BIT_FLOAT':'f4',
+	}
+
+def _bruker_frame_values(values, frame_count):
+	"""Broadcast a per-frame ParaVision parameter to one entry per frame."""
+	import numpy as np
+
+	values = np.atleast_1d(np.asarray(values, dtype=np.float64))
+	if values.shape[0] == frame_count:
+		return values
+	return np.resize(values, (frame_count,) + values.shape[1:])
+
+def bruker_to_nifti(scan_dir, out_file,
+	actual_size=False,
+	chunk_size=16,
+	compresslevel=None,
+	flip=False,
+	force_conversion=False,
+	pdata=1,
+	):
+	"""Convert a Bruker ParaVision reconstruction (`2dseq` file) to NIfTI, in-process and in a single streaming pass.
+
+	The `2dseq` file is memory-mapped, and written out in chunks of volumes, so that only one chunk is resident in memory at any one time.
+	If all frames share the same slope and offset, the raw integer data is written unchanged and the scaling is recorded in the NIfTI header, otherwise the scaled data is written as 32-bit floating point.
+
+	Parameters
+	----------
+
+	scan_dir : str
+		Path to a ParaVision scan directory, containing a `pdata` subdirectory.
+	out_file : str
+		Path under which to write the NIfTI file, compression is determined from the extension (i.e. `.nii.gz` files will be gzipped).
+	actual_size : bool, optional
+		Whether to keep the actual voxel size, otherwise the voxel size (and position) is scaled by a factor of 10, as done by `Bru2` without the `-a` flag.
+		The default matches `Bru2` and `samri.pipelines.extra_interfaces.NativeBru2`.
+	chunk_size : int, optional
+		Number of volumes to hold in memory at any one time.
+	compresslevel : int, optional
+		Gzip compression level, from 1 (fastest) to 9 (smallest), used if `out_file` is compressed.
+	flip : bool, optional
+		Whether to rotate the image by 180 degrees around the slice axis (i.e. reverse the first two voxel axes, at an unchanged affine), as `samri.manipulations.flip_axis(axis=2)` does to correct for "Prone" scans.
+	force_conversion : bool, optional
+		Whether to convert scans with differently oriented slices (e.g. localizers), using the orientation of the first slice.
+	pdata : int, optional
+		Number of the reconstruction (`pdata` subdirectory) to convert.
+
+	Returns
+	-------
+
+	str : Path to which the NIfTI file was written.
+	"""
+	import nibabel as nib
+	import numpy as np
+
+	scan_dir = os.path.abspath(os.path.expanduser(scan_dir))
+	reco_dir = os.path.join(scan_dir, 'pdata', str(pdata))
+	visu_pars_file = os.path.join(reco_dir, 'visu_pars')
+	if not os.path.isfile(visu_pars_file):
+		visu_pars_file = os.path.join(scan_dir, 'visu_pars')
+	visu_pars = read_jcampdx(visu_pars_file)
+
+	core_dim = int(visu_pars['VisuCoreDim'])
+	core_size = [int(i) for i in np.atleast_1d(visu_pars['VisuCoreSize'])[:core_dim]]
+	frame_count = int(visu_pars.get('VisuCoreFrameCount', 1))
+	byte_order = '>' if visu_pars.get('VisuCoreByteOrder') == 'bigEndian' else '<'
+	in_dtype = np.dtype(byte_order + BRUKER_WORD_TYPES[visu_pars['VisuCoreWordType']])
+
+	# Frame groups are listed from the fastest to the slowest varying.
+	group_sizes = []
+	slice_group = None
+	for group in visu_pars.get('VisuFGOrderDesc', []):
+		if group[1] == 'FG_SLICE' and slice_group is None:
+			slice_group = len(group_sizes)
+		group_sizes.append(int(group[0]))
+	if not group_sizes or int(np.prod(group_sizes)) != frame_count:
+		group_sizes = [frame_count]
+		slice_group = None
+
+	data = np.memmap(os.path.join(reco_dir, '2dseq'), dtype=in_dtype, mode='r', shape=tuple(core_size) + (frame_count,), order='F')
+	frames = np.arange(frame_count).reshape(group_sizes, order='F')
+	data = data.reshape(tuple(core_size) + tuple(group_sizes), order='F')
+	# Bring the data into (x, y, z, ...) order, with all non-slice frame groups collapsed into time.
+	if core_dim == 2:
+		if slice_group is None:
+			frames = frames[np.newaxis]
+			data = data[:, :, np.newaxis]
+		else:
+			frames = np.moveaxis(frames, slice_group, 0)
+			data = np.moveaxis(data, core_dim + slice_group, 2)
+	else:
+		frames = frames[np.newaxis]
+	spatial_shape = data.shape[:3]
+	frames = frames.reshape((frames.shape[0], -1), order='F')
+	volume_count = frames.shape[1]
+
+	slopes = _bruker_frame_values(visu_pars.get('VisuCoreDataSlope', 1), frame_count)
+	offsets = _bruker_frame_values(visu_pars.get('VisuCoreDataOffs', 0), frame_count)
+	uniform_scaling = np.all(slopes == slopes[0]) and np.all(offsets == offsets[0])
+
+	orientations = _bruker_frame_values(visu_pars['VisuCoreOrientation'], frame_count).reshape((frame_count, 3, 3))
+	positions = _bruker_frame_values(visu_pars['VisuCorePosition'], frame_count).reshape((frame_count, 3))
+	slice_frames = frames[:, 0]
+	if not np.allclose(orientations[slice_frames], orientations[slice_frames[0]], atol=1e-5) and not force_conversion:
+		raise ValueError('The slices of `{}` have different orientations, set `force_conversion` to convert it nonetheless.'.format(scan_dir))
+	orientation = orientations[slice_frames[0]]
+	extent = np.atleast_1d(visu_pars['VisuCoreExtent']).astype(np.float64)[:core_dim]
+	resolution = extent / core_size
+
+	# ParaVision orientation rows and positions are given in the LPS subject coordinate system.
+	affine = np.eye(4)
+	affine[:3, 0] = orientation[0] * resolution[0]
+	affine[:3, 1] = orientation[1] * resolution[1]
+	if core_dim == 3:
+		affine[:3, 2] = orientation[2] * resolution[2]
+	elif len(slice_frames) > 1:
+		affine[:3, 2] = positions[slice_frames[1]] - positions[slice_frames[0]]
+	else:
+		affine[:3, 2] = orientation[2] * float(np.atleast_1d(visu_pars.get('VisuCoreFrameThickness', 1))[0])
+	affine[:3, 3] = positions[slice_frames[0]]
+	affine = np.diag([-1, -1, 1, 1]).dot(affine)
+	if not actual_size:
+		affine[:3] *= 10
+
+	if uniform_scaling:
+		out_dtype = in_dtype.newbyteorder('<')
+		slope_inter = (slopes[0], offsets[0])
+	else:
+		out_dtype = np.dtype('<f4')
+		slope_inter = (None, None)
+	header = nib.Nifti1Header()
+	header.set_data_dtype(out_dtype)
+	if volume_count > 1:
+		header.set_data_shape(spatial_shape + (volume_count,))
+	else:
+		header.set_data_shape(spatial_shape)
+	header.set_qform(affine, code=1)
+	header.set_sform(affine, code=1)
+	repetition_time = visu_pars.get('VisuAcqRepetitionTime')
+	if repetition_time is not None and volume_count > 1:
+		zooms = list(header.get_zooms())
+		zooms[3] = float(np.atleast_1d(repetition_time)[0]) / 1000.
+		header.set_zooms(zooms)
+	header.set_xyzt_units('mm', 'sec')
+
+	group_shape = data.shape[3:]
+	def volumes():
+		step = max(int(chunk_size), 1)
+		for start in range(0, volume_count, step):
+			stop = min(start + step, volume_count)
+			chunk = np.stack([data[(slice(None),) * 3 + np.unravel_index(i, group_shape, order='F')] for i in range(start, stop)], axis=-1)
+			if flip:
+				chunk = chunk[::-1, ::-1]
+			if not uniform_scaling:
+				chunk_frames = frames[:, start:stop]
+				chunk = chunk * slopes[chunk_frames].astype(np.float32) + offsets[chunk_frames].astype(np.float32)
+			if volume_count == 1:
+				chunk = chunk[..., 0]
+			yield chunk
+
+	return write_nifti_volumes(out_file, header, volumes(), slope_inter=slope_inter, compresslevel=compresslevel)
+
+def parse_bids_entities(name):
+	"""Parse BIDS entities from a file or scan name, without the overhead of creating a PyBIDS layout.
+
+	This gives the same results as `bids.layout.BIDSLayout.parse_file_entities` for a file with the given name placed in the layout root.
+
+	Parameters
+	----------
+
+	name : str
+		File or scan name, e.g. "task-JogB_acq-EPI_run-1_bold".
+
+	Returns
+	-------
+
+	dict : Dictionary with BIDS entity names (e.g. "task", "acquisition") as keys.
+	"""
+	name = '/' + name
+	entities = {}
+	for entity, pattern, entity_type in BIDS_ENTITY_PATTERNS:
+		m = re.search(pattern, name)
+		if m:
+			entities[entity] = entity_type(m.group(1))
+	return entities
+
 def fslmaths_invert_values(img_path):
 	"""Calculates the op_string required to make an fsl.ImageMaths() node invert an image"""
 	op_string = "-sub {0} -sub {0}".format(img_path)
@@ -438,6 +760,14 @@ def bids_dict_to_dir(bids_dictionary):
 	session = "ses-" + bids_dictionary['session']
 	return "/".join([subject,session])
 
+def is_prone(record):
+	"""Whether a data selection record (e.g. the `dict_slice` output of `samri.pipelines.extra_functions.get_bids_scan`) describes a scan acquired in "Prone" position, which needs to be flipped."""
+	return record.get('PV_position') == 'Prone'
+
+def is_not_prone(record):
+	"""Whether a data selection record describes a scan which does not need to be flipped, see `is_prone`."""
+	return record.get('PV_position') != 'Prone'
+
 def ss_to_path(subject_session):
 	"""Concatenate a (subject, session) or (subject, session, scan) tuple to a BIDS-style path"""
 	subject = "sub-" + subject_session[0]
@@ -662,3 +992,1573 @@ def copy_bids_files(bids_in, bids_out):
 		except:
 			print('Copying {} to {} failed.'.format(in_file,out_file))
 			pass
+
+def write_nifti_volumes(out_file, header, volumes,
+	slope_inter=(None, None),
+	compresslevel=None,
+	):
+	"""Write a NIfTI file from an iterable of volumes, without holding the entire data array in memory.
+
+	Parameters
+	----------
+
+	out_file : str
+		Path under which to write the NIfTI file, compression is determined from the extension (i.e. `.nii.gz` files will be gzipped).
+	header : nibabel.Nifti1Header
+		Header containing the final data shape, data type, and affine of the image.
+	volumes : iterable of numpy.ndarray
+		Successive chunks of the image along the last axis, with shapes equal to the header shape in all but the last dimension, or equal to the header shape without its last dimension (for single volumes).
+	slope_inter : tuple, optional
+		Scaling slope and intercept to record in the header.
+		The volumes are written as given, i.e. they should be unscaled if a slope and intercept are specified.
+	compresslevel : int, optional
+		Gzip compression level, from 1 (fastest) to 9 (smallest), used if `out_file` is compressed.
+		If unspecified, the nibabel default is used.
+
+	Returns
+	-------
+
+	str : Path to which the NIfTI file was written.
+	"""
+	import numpy as np
+	from nibabel.openers import Opener
+
+	out_file = os.path.abspath(os.path.expanduser(out_file))
+	header = header.copy()
+	header.set_slope_inter(*slope_inter)
+	header['vox_offset'] = 0
+	dtype = header.get_data_dtype()
+	opener_kwargs = {}
+	if compresslevel is not None and out_file.endswith('.gz'):
+		opener_kwargs['compresslevel'] = compresslevel
+	with Opener(out_file, 'wb', **opener_kwargs) as f:
+		header.write_to(f)
+		vox_offset = int(header['vox_offset'])
+		if f.tell() < vox_offset:
+			f.write(b'\x00' * (vox_offset - f.tell()))
+		for volume in volumes:
+			f.write(np.asarray(volume).astype(dtype, copy=False).tobytes(order='F'))
+	return out_file
+
+def nifti_slope_inter(img):
+	"""Scaling slope and intercept of a loaded NIfTI image, or `(None, None)` if the data is not scaled.
+
+	On loading, nibabel moves the scaling from the header to the data proxy, so it cannot be read from the header.
+	"""
+	slope = float(getattr(img.dataobj, 'slope', 1.))
+	inter = float(getattr(img.dataobj, 'inter', 0.))
+	if slope == 1. and inter == 0.:
+		return None, None
+	return slope, inter
+
+def nifti_raw_chunks(img,
+	start=0,
+	stop=None,
+	spatial_slicer=(slice(None),) * 3,
+	chunk_size=16,
+	):
+	"""Iterate over chunks of volumes of a NIfTI image, as stored on disk (i.e. unscaled, and in the original data type).
+
+	Chunks are read via the image data proxy, so that only one chunk is resident in memory at any one time.
+
+	Parameters
+	----------
+
+	img : nibabel.Nifti1Image
+		Image from which to read the volumes.
+		Compressed images should be loaded with `keep_file_open=True`, as the proxy otherwise decompresses the file from its start for every chunk.
+	start : int, optional
+		Index of the first volume to read.
+	stop : int, optional
+		Index after the last volume to read, if unspecified the volumes are read until the end of the image.
+	spatial_slicer : tuple of slice, optional
+		Slices to apply along the three spatial axes (e.g. with negative steps, to flip the image while reading).
+	chunk_size : int, optional
+		Number of volumes to hold in memory at any one time.
+	"""
+	import numpy as np
+
+	slope, inter = nifti_slope_inter(img)
+	integer_data = np.issubdtype(img.get_data_dtype(), np.integer)
+	if len(img.shape) < 4:
+		chunks = [tuple(spatial_slicer)]
+	else:
+		if stop is None:
+			stop = img.shape[3]
+		chunks = [tuple(spatial_slicer) + (slice(i, min(i + chunk_size, stop)),) for i in range(start, stop, max(chunk_size, 1))]
+	for slicer in chunks:
+		chunk = np.asanyarray(img.dataobj[slicer])
+		if slope is not None:
+			chunk = (chunk - inter) / slope
+			if integer_data:
+				chunk = np.rint(chunk)
+		yield chunk
+
+def nifti_volume_range(in_file, out_base,
+	start=0,
+	stop=None,
+	chunk_size=16,
+	compress=None,
+	):
+	"""Create a NIfTI image containing only the volumes `start:stop` of a 4D NIfTI file, without holding the entire data array in memory.
+
+	If the input is an uncompressed single-file NIfTI (and no compressed output is requested), no data is copied: a NIfTI pair is created, the header of which (`.hdr`) points at the selected volumes within the original data, linked as the image file (`.img`).
+	Otherwise the selected volumes are streamed into a new file.
+
+	Parameters
+	----------
+
+	in_file : str
+		Path to a 4D NIfTI file.
+	out_base : str
+		Path, without extension, under which to create the output.
+	start : int, optional
+		Index of the first volume to keep.
+	stop : int, optional
+		Index after the last volume to keep, if unspecified all volumes after `start` are kept.
+	chunk_size : int, optional
+		Number of volumes to hold in memory at any one time, if the data needs to be copied.
+	compress : bool, optional
+		Whether the output should be gzip-compressed, if unspecified this matches the input.
+
+	Returns
+	-------
+
+	str : Path of the output image (the `.hdr` file, in the case of a NIfTI pair).
+	"""
+	import nibabel as nib
+	import numpy as np
+	from nibabel.nifti1 import Nifti1PairHeader
+
+	in_file = os.path.abspath(os.path.expanduser(in_file))
+	out_base = os.path.abspath(os.path.expanduser(out_base))
+	# Keeping the file open lets chunks of compressed files be read sequentially, rather than decompressing from the start for each chunk.
+	img = nib.load(in_file, keep_file_open=True)
+	volumes = img.shape[3]
+	if stop is None or stop > volumes:
+		stop = volumes
+	shape = img.shape[:3] + (stop - start,) + img.shape[4:]
+	slope, inter = nifti_slope_inter(img)
+	if compress is None:
+		compress = in_file.endswith('.gz')
+
+	if in_file.endswith('.nii') and not compress:
+		header = Nifti1PairHeader.from_header(img.header)
+		header.set_data_shape(shape)
+		header.set_slope_inter(slope, inter)
+		volume_bytes = int(np.prod(img.shape[:3])) * img.get_data_dtype().itemsize
+		header.set_data_offset(img.dataobj.offset + start * volume_bytes)
+		out_file = out_base + '.hdr'
+		image_file = out_base + '.img'
+		with open(out_file, 'wb') as f:
+			header.write_to(f)
+		if os.path.lexists(image_file):
+			os.remove(image_file)
+		os.symlink(os.path.realpath(in_file), image_file)
+		return out_file
+
+	out_file = out_base + '.nii.gz' if compress else out_base + '.nii'
+	header = img.header.copy()
+	header.set_data_shape(shape)
+	return write_nifti_volumes(out_file, header, nifti_raw_chunks(img, start, stop, chunk_size=chunk_size), slope_inter=(slope, inter))
+
+def bounding_box(data, margin=0):
+	"""Determine the bounding box of the nonzero entries of an array, expanded by a margin and clipped to the array extent.
+
+	Parameters
+	----------
+
+	data : numpy.ndarray
+		Array whose nonzero entries define the extent.
+	margin : int, optional
+		Number of elements by which to expand the bounding box on each side along each axis.
+
+	Returns
+	-------
+
+	tuple of slice : Slices selecting the bounding box, or slices selecting the entire array, if `data` has no nonzero entries.
+	"""
+	import numpy as np
+
+	nonzero = np.nonzero(data)
+	if not len(nonzero[0]):
+		return tuple(slice(0, i) for i in data.shape)
+	return tuple(slice(max(int(i.min()) - margin, 0), min(int(i.max()) + margin + 1, n)) for i, n in zip(nonzero, data.shape))
+
+def nifti_extension(compress=True):
+	"""NIfTI file extension corresponding to the FSL and AFNI output type selected by `set_nifti_output_type`.
+
+	Parameters
+	----------
+
+	compress : bool, optional
+		Whether gzip-compressed NIfTI (`.nii.gz`) files, rather than uncompressed NIfTI (`.nii`) files are written.
+	"""
+	return '.nii.gz' if compress else '.nii'
+
+def set_nifti_output_type(workflow, compress=True):
+	"""Set the output type of all FSL and AFNI nodes in a workflow, which is used for all outputs not explicitly named.
+
+	The output type is set on the nodes, rather than as the default of the interface classes, so that other workflows run in the same process are unaffected.
+	This needs to be called once all nodes have been connected to the workflow.
+
+	Parameters
+	----------
+
+	workflow : nipype.pipeline.engine.Workflow
+		Workflow containing the nodes.
+	compress : bool, optional
+		Whether to write gzip-compressed NIfTI (`.nii.gz`) files, rather than uncompressed NIfTI (`.nii`) files.
+		Uncompressed files are larger, but much faster to read and write.
+	"""
+	from nipype.interfaces import afni, fsl
+
+	output_type = 'NIFTI_GZ' if compress else 'NIFTI'
+	for node in workflow._get_all_nodes():
+		if isinstance(node.interface, (fsl.FSLCommand, afni.base.AFNICommand)):
+			node.interface.inputs.output_type = output_type
+
+def deliver_file(src, dst,
+	method='hardlink',
+	):
+	"""Deliver a file to a target path, avoiding a copy of the data where the file system allows it.
+
+	Parameters
+	----------
+
+	src : str
+		Path to the file to be delivered.
+	dst : str
+		Target path, any existing file at this path will be replaced.
+	method : {'hardlink', 'reflink', 'move', 'copy'}, optional
+		How to deliver the file.
+		'hardlink' creates a new link to the same data, 'reflink' creates a copy-on-write clone (supported e.g. on Btrfs and XFS), 'move' renames the file (so it is no longer available at `src`), and 'copy' copies the data.
+		All methods other than 'copy' require `src` and `dst` to be on the same file system, and fall back to copying otherwise.
+
+	Returns
+	-------
+
+	str : The method which was actually used.
+	"""
+	import shutil
+
+	if os.path.lexists(dst):
+		if os.path.exists(dst) and os.path.samefile(src, dst):
+			return method
+		os.remove(dst)
+	if method == 'hardlink':
+		try:
+			os.link(os.path.realpath(src), dst)
+			return method
+		except OSError:
+			pass
+	elif method == 'reflink':
+		import fcntl
+		# FICLONE from linux/fs.h
+		ficlone = 0x40049409
+		try:
+			with open(src, 'rb') as f_src, open(dst, 'wb') as f_dst:
+				fcntl.ioctl(f_dst.fileno(), ficlone, f_src.fileno())
+			shutil.copystat(src, dst)
+			return method
+		except OSError:
+			if os.path.lexists(dst):
+				os.remove(dst)
+	elif method == 'move':
+		try:
+			os.rename(src, dst)
+			return method
+		except OSError:
+			shutil.move(src, dst)
+			return 'copy'
+	shutil.copy2(src, dst)
+	return 'copy'
+
+def read_vest(file_path):
+	"""Read an FSL VEST file (e.g. a `.mat` design or a `.con` contrast file, as written by `FEATModel`).
+
+	Parameters
+	----------
+
+	file_path : str
+		Path to the VEST file.
+
+	Returns
+	-------
+
+	matrix : numpy.ndarray
+		Two-dimensional array of the values following the `/Matrix` tag.
+	header : dict
+		Dictionary of the `/`-prefixed header entries (without the slash) and their values, as strings.
+	"""
+	import numpy as np
+
+	header = {}
+	rows = []
+	in_matrix = False
+	with open(file_path) as f:
+		for line in f:
+			line = line.strip()
+			if not line:
+				continue
+			if in_matrix:
+				rows.append([float(i) for i in line.split()])
+			elif line == '/Matrix':
+				in_matrix = True
+			elif line.startswith('/'):
+				entry = line[1:].split(None, 1)
+				header[entry[0]] = entry[1].strip() if len(entry) > 1 else ''
+	return np.array(rows, dtype=np.float64, ndmin=2), header
+
+def write_vest(file_path, matrix,
+	header={},
+	):
+	"""Write an FSL VEST file (e.g. a `.mat` design or a `.con` contrast file), readable via `read_vest`.
+
+	Parameters
+	----------
+
+	file_path : str
+		Path under which to save the VEST file.
+	matrix : numpy.ndarray
+		Two-dimensional array, with one row per point (or contrast) and one column per wave (or regressor).
+	header : dict, optional
+		Dictionary of additional header entries (without the leading slash) and their values.
+		The `NumWaves` and `NumPoints` entries are derived from the matrix.
+	"""
+	import numpy as np
+
+	matrix = np.array(matrix, dtype=np.float64, ndmin=2)
+	with open(file_path, 'w') as f:
+		f.write('/NumWaves\t{}\n'.format(matrix.shape[1]))
+		f.write('/NumPoints\t{}\n'.format(matrix.shape[0]))
+		for key, value in header.items():
+			f.write('/{}\t{}\n'.format(key, value))
+		f.write('\n/Matrix\n')
+		for row in matrix:
+			f.write('\t'.join('{:.6e}'.format(i) for i in row) + '\n')
+
+def _glm_block_statistics(betas, rss, xy, contrasts, contrast_variance, rank, dof):
+	"""Statistics of a GLM fit for a block of voxels, given the parameter estimates (regressors × voxels), residual sums of squares, design-data cross products (regressors × voxels), and contrast variance factors (contrasts × voxels, or contrasts × 1), as arrays with one row per voxel."""
+	import numpy as np
+	from scipy import special, stats
+
+	sigsq = np.clip(rss, 0, None) / dof
+	cope = contrasts.dot(betas)
+	varcb = contrast_variance * sigsq
+	tstat = np.zeros_like(cope)
+	np.divide(cope, np.sqrt(varcb), out=tstat, where=varcb > 0)
+	zstat = np.sign(tstat) * -special.ndtri_exp(stats.t.logsf(np.abs(tstat), dof))
+	fstat = np.zeros_like(sigsq)
+	np.divide(np.einsum('pv,pv->v', betas, xy) / rank, sigsq, out=fstat, where=sigsq > 0)
+	return {
+		'betas': betas.T,
+		'cope': cope.T,
+		'varcb': varcb.T,
+		'tstat': tstat.T,
+		'zstat': zstat.T,
+		'pstat': stats.t.sf(tstat, dof).T,
+		'sigsq': sigsq[:, None],
+		'fstat': fstat[:, None],
+		'pfstat': stats.f.sf(fstat, rank, dof)[:, None],
+		}
+
+def glm_fit(in_file, design, contrasts,
+	mask=None,
+	prewhiten=False,
+	chunk_size=16,
+	block_size=16384,
+	):
+	"""Fit a voxelwise GLM to a 4D NIfTI time series, in-process.
+
+	The time series is read once, in chunks of `chunk_size` volumes, and reduced to the per-voxel cross products with the design from which all estimates derive.
+	The estimates are then computed for blocks of `block_size` voxels at a time, so that memory usage is bounded by the chunk and block sizes rather than by the size of the data.
+	The statistics follow the conventions of FSL's `fsl_glm`: no intercept is added to the design, the degrees of freedom are the number of volumes minus the rank of the design, and p-values are one-sided.
+
+	Parameters
+	----------
+
+	in_file : str
+		Path to a 4D NIfTI file.
+	design : numpy.ndarray
+		Design matrix, with one row per volume and one column per regressor.
+	contrasts : numpy.ndarray
+		Contrast matrix, with one row per contrast and one column per regressor.
+	mask : str, optional
+		Path to a NIfTI file on the same grid as `in_file`, the nonzero voxels of which will be fitted.
+		All other voxels are set to zero in the output.
+	prewhiten : bool, optional
+		Whether to estimate a voxelwise AR(1) coefficient from the ordinary least squares residuals, and refit the model after prewhitening the data and the design with it.
+	chunk_size : int, optional
+		Number of volumes to hold in memory at any one time.
+	block_size : int, optional
+		Number of voxels for which to compute the estimates at any one time.
+
+	Returns
+	-------
+
+	dict : Dictionary of 4D arrays (with the statistics of consecutive regressors or contrasts along the last axis), under the keys 'betas', 'cope', 'varcb', 'tstat', 'zstat', 'pstat', 'sigsq', 'fstat', and 'pfstat'.
+		The last three are the residual variance and the F-test of the full model (with one volume each).
+	"""
+	import nibabel as nib
+	import numpy as np
+
+	img = nib.load(os.path.abspath(os.path.expanduser(in_file)), keep_file_open=True)
+	if len(img.shape) < 4:
+		raise ValueError('The GLM can only be fitted to 4D images, but "{}" has the shape {}.'.format(in_file, img.shape))
+	spatial_shape = img.shape[:3]
+	volumes = img.shape[3]
+	design = np.asarray(design, dtype=np.float64)
+	contrasts = np.atleast_2d(np.asarray(contrasts, dtype=np.float64))
+	if design.shape[0] != volumes:
+		raise ValueError('The design has {} rows, but "{}" has {} volumes.'.format(design.shape[0], in_file, volumes))
+	if contrasts.shape[1] != design.shape[1]:
+		raise ValueError('The contrasts have {} columns, but the design has {} regressors.'.format(contrasts.shape[1], design.shape[1]))
+
+	if mask:
+		mask_data = np.asanyarray(nib.load(os.path.abspath(os.path.expanduser(mask))).dataobj)
+		if mask_data.shape[:3] != spatial_shape:
+			raise ValueError('The mask shape {} does not match the image shape {}.'.format(mask_data.shape[:3], spatial_shape))
+		voxels = np.flatnonzero(mask_data.reshape(spatial_shape))
+	else:
+		voxels = np.arange(int(np.prod(spatial_shape)))
+	regressors = design.shape[1]
+	voxel_count = len(voxels)
+
+	# Per-voxel cross products, accumulated over chunks of volumes.
+	xy = np.zeros((regressors, voxel_count))
+	yy = np.zeros(voxel_count)
+	if prewhiten:
+		# Lagged cross products, for the AR(1) estimate and the prewhitened refit.
+		x_ylag = np.zeros((regressors, voxel_count))
+		xlag_y = np.zeros((regressors, voxel_count))
+		y_ylag = np.zeros(voxel_count)
+		previous = None
+	chunk_size = max(chunk_size, 1)
+	for start in range(0, volumes, chunk_size):
+		stop = min(start + chunk_size, volumes)
+		chunk = np.asarray(img.dataobj[..., start:stop], dtype=np.float64)
+		chunk = chunk.reshape(-1, stop - start)[voxels].T
+		xy += design[start:stop].T.dot(chunk)
+		yy += np.einsum('tv,tv->v', chunk, chunk)
+		if prewhiten:
+			if previous is None:
+				first = chunk[0].copy()
+				lagged, lagged_design = chunk, design[start:stop]
+			else:
+				lagged, lagged_design = np.vstack([previous, chunk]), design[start - 1:stop]
+			x_ylag += lagged_design[1:].T.dot(lagged[:-1])
+			xlag_y += lagged_design[:-1].T.dot(lagged[1:])
+			y_ylag += np.einsum('tv,tv->v', lagged[1:], lagged[:-1])
+			previous = chunk[-1:].copy()
+		del chunk
+	if prewhiten:
+		last = previous[0]
+
+	gram = design.T.dot(design)
+	gram_inverse = np.linalg.pinv(gram)
+	rank = np.linalg.matrix_rank(design)
+	dof = volumes - rank
+	if dof < 1:
+		raise ValueError('The design (with rank {}) leaves no degrees of freedom for {} volumes.'.format(rank, volumes))
+	if prewhiten:
+		design_lag = design[1:].T.dot(design[:-1])
+		gram_lag = design_lag + design_lag.T
+		gram_ends = np.outer(design[0], design[0]) + np.outer(design[-1], design[-1])
+
+	statistics = {
+		'betas': np.zeros((voxel_count, regressors), dtype=np.float32),
+		'cope': np.zeros((voxel_count, len(contrasts)), dtype=np.float32),
+		'varcb': np.zeros((voxel_count, len(contrasts)), dtype=np.float32),
+		'tstat': np.zeros((voxel_count, len(contrasts)), dtype=np.float32),
+		'zstat': np.zeros((voxel_count, len(contrasts)), dtype=np.float32),
+		'pstat': np.zeros((voxel_count, len(contrasts)), dtype=np.float32),
+		'sigsq': np.zeros((voxel_count, 1), dtype=np.float32),
+		'fstat': np.zeros((voxel_count, 1), dtype=np.float32),
+		'pfstat': np.zeros((voxel_count, 1), dtype=np.float32),
+		}
+	block_size = max(block_size, 1)
+	for start in range(0, voxel_count, block_size):
+		block = slice(start, min(start + block_size, voxel_count))
+		block_xy = xy[:, block]
+		betas = gram_inverse.dot(block_xy)
+		rss = yy[block] - np.einsum('pv,pv->v', betas, block_xy)
+		if prewhiten:
+			lag = y_ylag[block] - np.einsum('pv,pv->v', betas, x_ylag[:, block] + xlag_y[:, block]) + np.einsum('pv,pq,qv->v', betas, design_lag, betas)
+			rho = np.zeros_like(rss)
+			np.divide(lag, rss, out=rho, where=rss > 0)
+			rho = np.clip(rho, -0.99, 0.99)
+			rho_sq = rho**2
+			ends_xy = np.outer(design[0], first[block]) + np.outer(design[-1], last[block])
+			block_xy = (1 + rho_sq) * block_xy - rho * (x_ylag[:, block] + xlag_y[:, block]) - rho_sq * ends_xy
+			block_yy = (1 + rho_sq) * yy[block] - 2 * rho * y_ylag[block] - rho_sq * (first[block]**2 + last[block]**2)
+			whitened_gram = (1 + rho_sq)[:, None, None] * gram - rho[:, None, None] * gram_lag - rho_sq[:, None, None] * gram_ends
+			covariance = np.linalg.pinv(whitened_gram)
+			betas = np.einsum('vpq,qv->pv', covariance, block_xy)
+			rss = block_yy - np.einsum('pv,pv->v', betas, block_xy)
+			contrast_variance = np.einsum('kp,vpq,kq->kv', contrasts, covariance, contrasts)
+		else:
+			contrast_variance = np.einsum('kp,pq,kq->k', contrasts, gram_inverse, contrasts)[:, None]
+		for key, values in _glm_block_statistics(betas, rss, block_xy, contrasts, contrast_variance, rank, dof).items():
+			statistics[key][block] = values
+
+	for key, values in statistics.items():
+		volume = np.zeros((int(np.prod(spatial_shape)), values.shape[1]), dtype=np.float32)
+		volume[voxels] = values
+		statistics[key] = volume.reshape(spatial_shape + (values.shape[1],))
+	return statistics
+
+def _canonical_design_value(value):
+	import numpy as np
+
+	if isinstance(value, dict) or hasattr(value, 'dictcopy'):
+		if not isinstance(value, dict):
+			value = value.dictcopy()
+		return {str(key): _canonical_design_value(value[key]) for key in sorted(value, key=str)}
+	if isinstance(value, (list, tuple, np.ndarray)):
+		return [_canonical_design_value(i) for i in value]
+	if isinstance(value, (bool, np.bool_)) or value is None:
+		return bool(value) if value is not None else None
+	if isinstance(value, (int, float, np.number)):
+		# Rounding makes the representation robust to floating point noise from unit conversions.
+		return round(float(value), 6)
+	return str(value)
+
+def design_cache_key(session_info, **parameters):
+	"""Create a key identifying the design generated from a model specification, independently of the scan it applies to.
+
+	Within each condition, events are sorted by onset, and each scan path is replaced by the number of volumes of the scan.
+	Two model specifications with the same key produce the same design matrix, contrasts, and design images.
+
+	Parameters
+	----------
+
+	session_info : list of dict
+		Model specification, as produced by `samri.pipelines.extra_interfaces.SpecifyModel` or `samri.pipelines.extra_functions.regressor`.
+	parameters : dict
+		Any other values which determine the design (e.g. repetition time, HRF basis set, contrasts).
+
+	Returns
+	-------
+
+	str : SHA-1 hex digest of the canonical design description.
+	"""
+	import hashlib
+	import json
+	import nibabel as nib
+
+	sessions = []
+	for info in session_info:
+		info = dict(info)
+		scans = info.pop('scans', [])
+		if isinstance(scans, str):
+			scans = [scans]
+		shapes = [nib.load(i).shape for i in scans]
+		info['volumes'] = [shape[3] if len(shape) > 3 else 1 for shape in shapes]
+		conditions = []
+		for condition in info.get('cond', []):
+			condition = dict(condition)
+			onsets = list(condition.get('onset', []))
+			columns = [i for i in ['duration', 'amplitudes'] if len(list(condition.get(i, []) or [])) == len(onsets) and len(onsets) > 1]
+			if columns:
+				order = sorted(range(len(onsets)), key=lambda i: float(onsets[i]))
+				condition['onset'] = [onsets[i] for i in order]
+				for column in columns:
+					values = list(condition[column])
+					condition[column] = [values[i] for i in order]
+			else:
+				condition['onset'] = sorted(onsets, key=float)
+			conditions.append(condition)
+		info['cond'] = conditions
+		sessions.append(info)
+	# Unset and empty parameters (e.g. no orthogonalization) are equivalent.
+	parameters = {key: value for key, value in parameters.items() if value is not None and not (isinstance(value, (dict, list, tuple)) and not value)}
+	description = _canonical_design_value({'session_info': sessions, 'parameters': parameters})
+	return hashlib.sha1(json.dumps(description, sort_keys=True).encode('utf-8')).hexdigest()
+
+def _bandpass_kernels(highpass_sigma, lowpass_sigma):
+	"""Gaussian kernels (indexed by the time offset plus the kernel half-width) used by `fslmaths -bptf`."""
+	import numpy as np
+
+	kernels = {}
+	if highpass_sigma > 0:
+		width = int(highpass_sigma * 3)
+		offsets = np.arange(-width, width + 1, dtype=np.float64)
+		kernels['highpass'] = (offsets, np.exp(-0.5 * offsets**2 / highpass_sigma**2))
+	if lowpass_sigma > 0:
+		width = int(lowpass_sigma * 20) + 2
+		offsets = np.arange(-width, width + 1, dtype=np.float64)
+		weights = np.exp(-0.5 * offsets**2 / lowpass_sigma**2)
+		kernels['lowpass'] = (offsets, weights / weights.sum())
+	return kernels
+
+def _windowed_sum(data, kernel):
+	"""Sum of `kernel(dt) * data[..., t+dt]` over all offsets `dt` for which `t+dt` lies within the time series, for every `t`."""
+	from scipy import signal
+
+	width = (len(kernel) - 1) // 2
+	full = signal.fftconvolve(data, kernel[::-1].reshape((1,) * (data.ndim - 1) + (-1,)), mode='full', axes=-1)
+	return full[..., width:width + data.shape[-1]]
+
+def bandpass_filter(data, highpass_sigma=-1, lowpass_sigma=-1):
+	"""Temporally filter time series with the semantics of `fslmaths -bptf`.
+
+	The highpass filter subtracts a Gaussian-weighted running line fit (which also removes the mean), and the lowpass filter is a Gaussian smoothing, both truncated at the ends of the time series.
+
+	Parameters
+	----------
+
+	data : numpy.ndarray
+		Array with time along the last axis.
+	highpass_sigma : float, optional
+		Highpass filter sigma, in volumes, nonpositive values disable the highpass filter.
+	lowpass_sigma : float, optional
+		Lowpass filter sigma, in volumes, nonpositive values disable the lowpass filter.
+
+	Returns
+	-------
+
+	numpy.ndarray : Filtered float64 array of the same shape as `data`.
+	"""
+	import numpy as np
+
+	data = np.asarray(data, dtype=np.float64)
+	kernels = _bandpass_kernels(highpass_sigma, lowpass_sigma)
+	ones = np.ones(data.shape[-1])
+	if 'highpass' in kernels:
+		offsets, weights = kernels['highpass']
+		a = _windowed_sum(ones, weights * offsets)
+		c = _windowed_sum(ones, weights * offsets**2)
+		n = _windowed_sum(ones, weights)
+		b = _windowed_sum(data, weights)
+		d = _windowed_sum(data, weights * offsets)
+		denominator = c * n - a**2
+		intercept = np.zeros_like(data)
+		np.divide(b * c - a * d, denominator, out=intercept, where=denominator != 0)
+		data = data - intercept
+	if 'lowpass' in kernels:
+		_, weights = kernels['lowpass']
+		total = _windowed_sum(data, weights)
+		norm = _windowed_sum(ones, weights)
+		data = np.where(norm > 0, total / np.where(norm > 0, norm, 1), data)
+	return data
+
+def temporal_bandpass(in_file, out_file,
+	highpass_sigma=-1,
+	lowpass_sigma=-1,
+	max_memory_gb=1.,
+	):
+	"""Temporally filter a 4D NIfTI file with the semantics of `fslmaths -bptf`, holding only one block of voxels in memory at any one time.
+
+	The data is processed in slabs of consecutive slices, the size of which is chosen to keep the memory usage within `max_memory_gb`.
+	Compressed input is first decompressed to a temporary file, so that each slab can be read without decompressing the entire file.
+
+	Parameters
+	----------
+
+	in_file : str
+		Path to a 4D NIfTI file.
+	out_file : str
+		Path under which to write the filtered float32 image, compression is determined from the extension.
+	highpass_sigma : float, optional
+		Highpass filter sigma, in volumes, nonpositive values disable the highpass filter.
+	lowpass_sigma : float, optional
+		Lowpass filter sigma, in volumes, nonpositive values disable the lowpass filter.
+	max_memory_gb : float, optional
+		Approximate upper bound on the memory used for the filtering.
+
+	Returns
+	-------
+
+	str : Path to which the filtered image was written.
+	"""
+	import gzip
+	import shutil
+	import tempfile
+	import nibabel as nib
+	import numpy as np
+
+	in_file = os.path.abspath(os.path.expanduser(in_file))
+	out_file = os.path.abspath(os.path.expanduser(out_file))
+	out_dir = os.path.dirname(out_file)
+	temporary_files = []
+	try:
+		if in_file.endswith('.gz'):
+			handle, uncompressed = tempfile.mkstemp(suffix='.nii', dir=out_dir)
+			temporary_files.append(uncompressed)
+			with gzip.open(in_file, 'rb') as f_in, os.fdopen(handle, 'wb') as f_out:
+				shutil.copyfileobj(f_in, f_out, 2**24)
+			img = nib.load(uncompressed)
+		else:
+			img = nib.load(in_file)
+		if len(img.shape) != 4:
+			raise ValueError('Temporal filtering requires a 4D image, but "{}" has the shape {}.'.format(in_file, img.shape))
+		volumes = img.shape[3]
+
+		header = img.header.copy()
+		header.set_data_dtype(np.float32)
+		header.set_slope_inter(None, None)
+		header['vox_offset'] = 0
+		if out_file.endswith('.gz'):
+			handle, filtered = tempfile.mkstemp(suffix='.nii', dir=out_dir)
+			os.close(handle)
+			temporary_files.append(filtered)
+		else:
+			filtered = out_file
+		with open(filtered, 'wb') as f:
+			header.write_to(f)
+			offset = int(header['vox_offset'])
+			if f.tell() < offset:
+				f.write(b'\x00' * (offset - f.tell()))
+			f.truncate(offset + int(np.prod(img.shape)) * 4)
+		out_data = np.memmap(filtered, dtype=header.get_data_dtype(), mode='r+', offset=offset, shape=img.shape, order='F')
+
+		# The FFT-based windowed sums hold several copies of each padded time series in memory.
+		widths = [len(weights) for _, weights in _bandpass_kernels(highpass_sigma, lowpass_sigma).values()]
+		voxel_bytes = 16 * 8 * (volumes + max(widths + [0]))
+		slab_voxels = max(int(max_memory_gb * 2**30 / voxel_bytes), 1)
+		slices = max(slab_voxels // (img.shape[0] * img.shape[1]), 1)
+		for start in range(0, img.shape[2], slices):
+			stop = min(start + slices, img.shape[2])
+			slab = np.asarray(img.dataobj[:, :, start:stop, :], dtype=np.float64)
+			out_data[:, :, start:stop, :] = bandpass_filter(slab, highpass_sigma, lowpass_sigma)
+			del slab
+		out_data.flush()
+		del out_data
+
+		if filtered != out_file:
+			with open(filtered, 'rb') as f_in, gzip.open(out_file, 'wb', compresslevel=6) as f_out:
+				shutil.copyfileobj(f_in, f_out, 2**24)
+	finally:
+		for temporary_file in temporary_files:
+			if os.path.exists(temporary_file):
+				os.remove(temporary_file)
+	return out_file
+
+def seed_voxels(seed_mask,
+	top_voxel='',
+	):
+	"""Indices (into the C-ordered flattened 3D grid) of the voxels from which to extract a seed time course.
+
+	This computes the same selection as `samri.report.roi.ts`, but returns it in a form which can be computed once and reused for any number of scans on the same grid.
+
+	Parameters
+	----------
+
+	seed_mask : str
+		Path to a NIfTI file, the nonzero voxels of which constitute the seed.
+	top_voxel : str, optional
+		Path to a NIfTI file on the same grid as `seed_mask`, based on the within-mask top-value voxel of which to restrict the seed.
+
+	Returns
+	-------
+
+	numpy.ndarray : Sorted voxel indices.
+	"""
+	import nibabel as nib
+	import numpy as np
+
+	mask_data = np.asanyarray(nib.load(os.path.abspath(os.path.expanduser(seed_mask))).dataobj)
+	voxels = np.flatnonzero(mask_data.reshape(mask_data.shape[:3]))
+	if top_voxel:
+		top_data = np.asanyarray(nib.load(os.path.abspath(os.path.expanduser(top_voxel))).dataobj, dtype=np.float64)
+		if top_data.shape[:3] != mask_data.shape[:3]:
+			raise ValueError('The shape of "{}" ({}) does not match the shape of the seed mask ({}).'.format(top_voxel, top_data.shape[:3], mask_data.shape[:3]))
+		values = top_data.reshape(-1)[voxels]
+		voxels = voxels[values == np.nanmax(values)]
+	return voxels
+
+def seed_glm_fit(in_file, seed,
+	mask=None,
+	metric='mean',
+	highpass_cutoff=0,
+	tr=1,
+	chunk_size=16,
+	block_size=16384,
+	stack_dir=None,
+	):
+	"""Fit a seed-based functional connectivity GLM to a 4D NIfTI time series, in-process.
+
+	The time series is read once, in chunks of `chunk_size` volumes, during which both the seed time course is extracted and the in-mask data is written to a temporary memory-mapped stack.
+	The seed regressor is then processed as FEAT does for custom single-column regressors (demeaned, and highpass-filtered if `highpass_cutoff` is positive), and the model is fitted for blocks of `block_size` voxels at a time.
+	As with FSL's `fsl_glm` run on the FEAT design, no intercept is added to the design, and the data are not demeaned.
+
+	Parameters
+	----------
+
+	in_file : str
+		Path to a 4D NIfTI file.
+	seed : str or numpy.ndarray
+		Path to a NIfTI seed mask on the same grid as `in_file`, or indices of the seed voxels (as returned by `seed_voxels`).
+	mask : str or numpy.ndarray, optional
+		Path to a NIfTI file on the same grid as `in_file` (or the equivalent boolean array), the nonzero voxels of which will be fitted.
+		All other voxels are set to zero in the output.
+	metric : {'mean', 'median'}, optional
+		Whether to use the volume-wise seed mean or median as the regressor.
+	highpass_cutoff : float, optional
+		Highpass filter cutoff for the regressor, in seconds, nonpositive values disable the filter.
+	tr : float, optional
+		Repetition time, in seconds.
+	chunk_size : int, optional
+		Number of volumes to hold in memory at any one time.
+	block_size : int, optional
+		Number of voxels for which to compute the estimates at any one time.
+	stack_dir : str, optional
+		Directory in which to create the temporary stack, by default the current working directory.
+		The stack is removed once the estimates are computed.
+
+	Returns
+	-------
+
+	statistics : dict
+		Dictionary of 4D arrays, with the same keys as returned by `glm_fit`.
+	design : numpy.ndarray
+		Design matrix, with one row per volume and the seed regressor as its only column.
+	"""
+	import nibabel as nib
+	import numpy as np
+	import shutil
+	import tempfile
+
+	if metric not in ('mean', 'median'):
+		raise ValueError('Accepted values for the `metric` parameter are "mean" and "median". You specified {}'.format(metric))
+	img = nib.load(os.path.abspath(os.path.expanduser(in_file)), keep_file_open=True)
+	if len(img.shape) < 4:
+		raise ValueError('The GLM can only be fitted to 4D images, but "{}" has the shape {}.'.format(in_file, img.shape))
+	spatial_shape = img.shape[:3]
+	volumes = img.shape[3]
+	if isinstance(seed, str):
+		seed = seed_voxels(seed)
+	seed = np.asarray(seed, dtype=np.intp)
+	if len(seed) == 0:
+		raise ValueError('The seed contains no voxels.')
+	if mask is not None:
+		if isinstance(mask, str):
+			mask = np.asanyarray(nib.load(os.path.abspath(os.path.expanduser(mask))).dataobj)
+		if mask.shape[:3] != spatial_shape:
+			raise ValueError('The mask shape {} does not match the image shape {}.'.format(mask.shape[:3], spatial_shape))
+		voxels = np.flatnonzero(mask.reshape(spatial_shape))
+	else:
+		voxels = np.arange(int(np.prod(spatial_shape)))
+	voxel_count = len(voxels)
+
+	stack_dir = tempfile.mkdtemp(prefix='seed_stack_', dir=stack_dir or os.getcwd())
+	try:
+		stack = np.lib.format.open_memmap(os.path.join(stack_dir, 'data.npy'), mode='w+', dtype=np.float32, shape=(volumes, voxel_count))
+		timecourse = np.zeros(volumes)
+		chunk_size = max(chunk_size, 1)
+		for start in range(0, volumes, chunk_size):
+			stop = min(start + chunk_size, volumes)
+			chunk = np.asarray(img.dataobj[..., start:stop], dtype=np.float32).reshape(-1, stop - start)
+			seed_chunk = chunk[seed].astype(np.float64)
+			timecourse[start:stop] = seed_chunk.mean(axis=0) if metric == 'mean' else np.median(seed_chunk, axis=0)
+			stack[start:stop] = chunk[voxels].T
+			del chunk
+		stack.flush()
+
+		regressor = timecourse - timecourse.mean()
+		if highpass_cutoff and highpass_cutoff > 0:
+			regressor = bandpass_filter(regressor, highpass_sigma=highpass_cutoff / (2. * tr))
+			regressor -= regressor.mean()
+		design = regressor[:, None]
+		contrasts = np.ones((1, 1))
+		gram = regressor.dot(regressor)
+		rank = int(gram > 0)
+		dof = volumes - rank
+		if dof < 1:
+			raise ValueError('The design (with rank {}) leaves no degrees of freedom for {} volumes.'.format(rank, volumes))
+		gram_inverse = 1. / gram if rank else 0.
+		contrast_variance = np.full((1, 1), gram_inverse)
+
+		statistics = {key: np.zeros((voxel_count, 1), dtype=np.float32) for key in ['betas', 'cope', 'varcb', 'tstat', 'zstat', 'pstat', 'sigsq', 'fstat', 'pfstat']}
+		block_size = max(block_size, 1)
+		for start in range(0, voxel_count, block_size):
+			block = slice(start, min(start + block_size, voxel_count))
+			data = np.asarray(stack[:, block], dtype=np.float64)
+			xy = regressor.dot(data)[None]
+			betas = gram_inverse * xy
+			rss = np.einsum('tv,tv->v', data, data) - betas[0] * xy[0]
+			for key, values in _glm_block_statistics(betas, rss, xy, contrasts, contrast_variance, max(rank, 1), dof).items():
+				statistics[key][block] = values
+		del stack
+	finally:
+		shutil.rmtree(stack_dir, ignore_errors=True)
+
+	for key, values in statistics.items():
+		volume = np.zeros((int(np.prod(spatial_shape)), 1), dtype=np.float32)
+		volume[voxels] = values
+		statistics[key] = volume.reshape(spatial_shape + (1,))
+	return statistics, design
+
+def statistic_stack(in_files, stack_file,
+	voxels=None,
+	statistic=None,
+	volume=None,
+	):
+	"""Stack one statistic map per file into a memory-mapped 2D array, with one row per file and one column per voxel.
+
+	The maps are read one at a time (via `samri.utilities.statistic_image`, so that consolidated GLM statistics files are supported), and written to a NumPy `.npy` file on disk, so that only one map is held in memory at any one time.
+
+	Parameters
+	----------
+
+	in_files : list of str
+		Paths to NIfTI files, all on the same grid.
+	stack_file : str
+		Path under which to save the `.npy` stack.
+	voxels : numpy.ndarray, optional
+		Indices (into the C-ordered flattened 3D grid) of the voxels to stack.
+		If unspecified, all voxels are stacked.
+	statistic : str, optional
+		Name of the statistic to read from consolidated files.
+	volume : int, optional
+		Volume to select from 4D maps (e.g. one of multiple contrasts).
+		Single-volume 4D maps are read as 3D maps if this is unspecified.
+
+	Returns
+	-------
+
+	numpy.memmap : Array of shape (files, voxels), memory-mapped from `stack_file`.
+	"""
+	import numpy as np
+	from samri.utilities import statistic_image
+
+	stack = None
+	for i, in_file in enumerate(in_files):
+		img = statistic_image(in_file, statistic)
+		if len(img.shape) > 3:
+			if volume is None and img.shape[3] == 1:
+				img = img.slicer[..., 0]
+			elif isinstance(volume, int):
+				img = img.slicer[..., volume]
+			else:
+				raise ValueError('"{}" has {} volumes, please specify which to stack.'.format(in_file, img.shape[3]))
+		if stack is None:
+			spatial_shape = img.shape[:3]
+			if voxels is None:
+				voxels = np.arange(int(np.prod(spatial_shape)))
+			stack = np.lib.format.open_memmap(stack_file, mode='w+', dtype=np.float32, shape=(len(in_files), len(voxels)))
+		elif img.shape[:3] != spatial_shape:
+			raise ValueError('The shape of "{}" ({}) does not match the shape of "{}" ({}).'.format(in_file, img.shape[:3], in_files[0], spatial_shape))
+		stack[i] = np.asarray(img.dataobj, dtype=np.float32).reshape(-1)[voxels]
+	stack.flush()
+	return stack
+
+def _weighted_fit(design, data, weights):
+	"""Voxelwise weighted least squares, returning the parameter estimates (voxels × regressors) and their covariance (voxels × regressors × regressors)."""
+	import numpy as np
+
+	gram = np.einsum('np,nv,nq->vpq', design, weights, design)
+	covariance = np.linalg.pinv(gram)
+	betas = np.einsum('vpq,nq,nv->vp', covariance, design, weights * data)
+	return betas, covariance, gram
+
+def _reml_variance(design, data, variances,
+	upper,
+	iterations=32,
+	):
+	"""Voxelwise restricted maximum likelihood estimate of the between-subject variance in a mixed-effects model, via golden-section search on [0, `upper`]."""
+	import numpy as np
+
+	def neg_log_likelihood(random_variance):
+		total = variances + random_variance
+		weights = 1. / total
+		betas, _, gram = _weighted_fit(design, data, weights)
+		residuals = data - design.dot(betas.T)
+		return np.log(total).sum(axis=0) + np.linalg.slogdet(gram)[1] + (weights * residuals**2).sum(axis=0)
+
+	ratio = (np.sqrt(5) - 1) / 2
+	low = np.zeros_like(upper)
+	high = upper.copy()
+	inner_low = high - ratio * (high - low)
+	inner_high = low + ratio * (high - low)
+	value_low = neg_log_likelihood(inner_low)
+	value_high = neg_log_likelihood(inner_high)
+	for _ in range(iterations):
+		left = value_low < value_high
+		high = np.where(left, inner_high, high)
+		low = np.where(left, low, inner_low)
+		candidate = np.where(left, high - ratio * (high - low), low + ratio * (high - low))
+		value = neg_log_likelihood(candidate)
+		inner_low, inner_high = np.where(left, candidate, inner_high), np.where(left, inner_low, candidate)
+		value_low, value_high = np.where(left, value, value_high), np.where(left, value_low, value)
+	estimate = (low + high) / 2
+	# The likelihood is often maximal at the boundary, which golden-section search only approaches.
+	at_zero = neg_log_likelihood(np.zeros_like(upper)) <= neg_log_likelihood(estimate)
+	return np.where(at_zero, 0., estimate)
+
+def _factor_prefix(factor):
+	"""BIDS key of a BIDS entity name (e.g. "ses" for "session"), or the name itself for any other factor."""
+	for entity, pattern, _ in BIDS_ENTITY_PATTERNS:
+		if entity == factor:
+			m = re.search(r'([a-z]+)-\(', pattern)
+			if m:
+				return m.group(1)
+	return factor
+
+def anova_design(observations, factors,
+	block=None,
+	):
+	"""Encode the factors of a second-level ANOVA into regressors and contrasts, in the format of `nipype.interfaces.fsl.MultipleRegressDesign`.
+
+	Each factor is encoded once, by treatment coding against its first level (in order of appearance in `observations`): every other level gets one regressor, named e.g. "ses-(2-1)", together with a t-contrast of the same name.
+	An F-test over these t-contrasts is added for every factor, named "anova" if there is only one factor, and e.g. "anova-session" otherwise.
+	All requested contrasts and F-tests can thus be evaluated from a single fit of the resulting design (e.g. via `l2_fit`).
+
+	Parameters
+	----------
+
+	observations : pandas.DataFrame
+		Data frame with one row per first-level map, in the order in which the maps will be passed to the model.
+	factors : str or list of str
+		Columns of `observations` the effects of which to test.
+	block : str, optional
+		Column of `observations` to control for (e.g. "subject" for repeated measures), every level of which gets its own intercept regressor, in order of appearance.
+		If unspecified, a single intercept regressor, named "mean", is used.
+
+	Returns
+	-------
+
+	regressors : dict
+		Dictionary of regressor names and lists of values, with one value per observation.
+	contrasts : list
+		List of t-contrasts followed by F-tests, the latter referencing the former.
+	"""
+	import numpy as np
+
+	if isinstance(factors, str):
+		factors = [factors]
+	regressors = {}
+	if block:
+		codes, levels = pd.factorize(observations[block], sort=False)
+		indicators = np.eye(len(levels), dtype=int)[codes]
+		for level, column in zip(levels, indicators.T):
+			regressors['{}-{}'.format(_factor_prefix(block), level)] = column.tolist()
+	else:
+		regressors['mean'] = [1] * len(observations)
+
+	t_contrasts = []
+	f_tests = []
+	for factor in factors:
+		codes, levels = pd.factorize(observations[factor], sort=False)
+		if len(levels) < 2:
+			raise ValueError('The "{}" factor needs at least two levels, but only {} are present.'.format(factor, list(levels)))
+		indicators = np.eye(len(levels), dtype=int)[codes]
+		factor_contrasts = []
+		for level, column in zip(levels[1:], indicators[:, 1:].T):
+			name = '{}-({}-{})'.format(_factor_prefix(factor), level, levels[0])
+			regressors[name] = column.tolist()
+			factor_contrasts.append([name, 'T', [name], [1]])
+		t_contrasts.extend(factor_contrasts)
+		f_tests.append(['anova' if len(factors) == 1 else 'anova-{}'.format(factor), 'F', deepcopy(factor_contrasts)])
+	return regressors, t_contrasts + f_tests
+
+def l2_fit(cope_files, design, t_contrasts,
+	var_cope_files=None,
+	f_contrasts=None,
+	mask=None,
+	run_mode='flame1',
+	cope_statistic='cope',
+	varcope_statistic='varcb',
+	volume=None,
+	block_size=16384,
+	stack_dir=None,
+	):
+	"""Fit a voxelwise second-level (group) model to a list of first-level contrast maps, in-process.
+
+	The first-level maps are stacked into temporary memory-mapped arrays (see `statistic_stack`) rather than merged into 4D NIfTI files, and the estimates are computed for blocks of `block_size` voxels at a time, so that memory usage is bounded by the block size rather than by the size of the data.
+	The estimation models follow the run modes of FSL's `flameo`:
+
+	* 'ols' -- ordinary least squares, ignoring the first-level variances.
+	* 'fe' -- fixed effects, weighting each map by the inverse of its first-level variance.
+	* 'flame1' -- mixed effects, weighting each map by the inverse of the sum of its first-level variance and a between-subject variance, which is estimated voxelwise via restricted maximum likelihood.
+	  This corresponds to the "FLAME1" approximation, and 'flame12' is accepted as an alias (the MCMC refinement of "FLAME2" is not performed).
+
+	Parameters
+	----------
+
+	cope_files : list of str
+		Paths to the first-level contrast maps, one per row of `design`.
+	design : numpy.ndarray
+		Design matrix, with one row per map and one column per regressor.
+	t_contrasts : numpy.ndarray
+		Contrast matrix, with one row per t-contrast and one column per regressor.
+	var_cope_files : list of str, optional
+		Paths to the first-level contrast variance maps, corresponding to `cope_files`.
+		These are required for all run modes but 'ols'.
+	f_contrasts : numpy.ndarray, optional
+		F-test matrix, with one row per F-test and one column per t-contrast, the nonzero entries of which mark the t-contrasts included in the F-test.
+	mask : str or numpy.ndarray, optional
+		Path to a NIfTI file on the same grid as the maps, or an already loaded array of its data, the nonzero voxels of which will be fitted.
+		All other voxels are set to zero in the output.
+	run_mode : {'ols', 'fe', 'flame1', 'flame12'}, optional
+		Estimation model.
+	cope_statistic : str, optional
+		Name of the statistic to read from consolidated first-level statistics files listed in `cope_files`.
+	varcope_statistic : str, optional
+		Name of the statistic to read from consolidated first-level statistics files listed in `var_cope_files`.
+	volume : int, optional
+		Volume to select from 4D first-level maps (e.g. one of multiple contrasts).
+	block_size : int, optional
+		Number of voxels for which to compute the estimates at any one time.
+	stack_dir : str, optional
+		Directory in which to create the temporary stacks, by default the current working directory.
+		The stacks are removed once the estimates are computed.
+
+	Returns
+	-------
+
+	dict : Dictionary of 4D arrays (with the statistics of consecutive regressors or contrasts along the last axis), under the keys 'pe', 'cope', 'varcope', 'tstat', 'zstat', 'fstat', 'zfstat', and 'mrefvars'.
+		The last is the estimated between-subject variance (zero unless the run mode is 'flame1' or 'flame12').
+	"""
+	import nibabel as nib
+	import numpy as np
+	import shutil
+	import tempfile
+	from scipy import special, stats
+	from samri.utilities import statistic_image
+
+	if run_mode not in ['ols', 'fe', 'flame1', 'flame12']:
+		raise ValueError('The run mode "{}" is not supported, please choose one of "ols", "fe", "flame1", or "flame12".'.format(run_mode))
+	if run_mode != 'ols' and not var_cope_files:
+		raise ValueError('The "{}" run mode requires first-level variance maps.'.format(run_mode))
+	if var_cope_files and len(var_cope_files) != len(cope_files):
+		raise ValueError('{} variance maps were given for {} contrast maps.'.format(len(var_cope_files), len(cope_files)))
+	design = np.atleast_2d(np.asarray(design, dtype=np.float64))
+	t_contrasts = np.atleast_2d(np.asarray(t_contrasts, dtype=np.float64))
+	if f_contrasts is None:
+		f_contrasts = np.zeros((0, len(t_contrasts)))
+	f_contrasts = np.atleast_2d(np.asarray(f_contrasts, dtype=np.float64))
+	if design.shape[0] != len(cope_files):
+		raise ValueError('The design has {} rows, but {} contrast maps were given.'.format(design.shape[0], len(cope_files)))
+	if t_contrasts.shape[1] != design.shape[1]:
+		raise ValueError('The contrasts have {} columns, but the design has {} regressors.'.format(t_contrasts.shape[1], design.shape[1]))
+	if f_contrasts.size and f_contrasts.shape[1] != len(t_contrasts):
+		raise ValueError('The F-tests have {} columns, but there are {} t-contrasts.'.format(f_contrasts.shape[1], len(t_contrasts)))
+	rank = np.linalg.matrix_rank(design)
+	dof = len(cope_files) - rank
+	if dof < 1:
+		raise ValueError('The design (with rank {}) leaves no degrees of freedom for {} maps.'.format(rank, len(cope_files)))
+
+	spatial_shape = statistic_image(cope_files[0], cope_statistic).shape[:3]
+	if isinstance(mask, str):
+		mask = np.asanyarray(nib.load(os.path.abspath(os.path.expanduser(mask))).dataobj) if mask else None
+	if mask is not None:
+		mask_data = np.asanyarray(mask)
+		if mask_data.shape[:3] != spatial_shape:
+			raise ValueError('The mask shape {} does not match the image shape {}.'.format(mask_data.shape[:3], spatial_shape))
+		voxels = np.flatnonzero(mask_data.reshape(spatial_shape))
+	else:
+		voxels = np.arange(int(np.prod(spatial_shape)))
+	voxel_count = len(voxels)
+
+	regressors = design.shape[1]
+	contrast_count = len(t_contrasts)
+	f_tests = [np.flatnonzero(i) for i in f_contrasts]
+	statistics = {
+		'pe': np.zeros((voxel_count, regressors), dtype=np.float32),
+		'cope': np.zeros((voxel_count, contrast_count), dtype=np.float32),
+		'varcope': np.zeros((voxel_count, contrast_count), dtype=np.float32),
+		'tstat': np.zeros((voxel_count, contrast_count), dtype=np.float32),
+		'zstat': np.zeros((voxel_count, contrast_count), dtype=np.float32),
+		'fstat': np.zeros((voxel_count, len(f_tests)), dtype=np.float32),
+		'zfstat': np.zeros((voxel_count, len(f_tests)), dtype=np.float32),
+		'mrefvars': np.zeros((voxel_count, 1), dtype=np.float32),
+		}
+
+	stack_dir = tempfile.mkdtemp(prefix='l2_stack_', dir=stack_dir or os.getcwd())
+	try:
+		copes = statistic_stack(cope_files, os.path.join(stack_dir, 'cope.npy'),
+			voxels=voxels,
+			statistic=cope_statistic,
+			volume=volume,
+			)
+		if run_mode != 'ols':
+			varcopes = statistic_stack(var_cope_files, os.path.join(stack_dir, 'varcope.npy'),
+				voxels=voxels,
+				statistic=varcope_statistic,
+				volume=volume,
+				)
+		pseudoinverse = np.linalg.pinv(design)
+		gram_inverse = np.linalg.pinv(design.T.dot(design))
+		block_size = max(block_size, 1)
+		for start in range(0, voxel_count, block_size):
+			block = slice(start, min(start + block_size, voxel_count))
+			data = np.asarray(copes[:, block], dtype=np.float64)
+			betas = pseudoinverse.dot(data).T
+			residuals = data - design.dot(betas.T)
+			sigsq = (residuals**2).sum(axis=0) / dof
+			if run_mode == 'ols':
+				covariance = gram_inverse[None] * sigsq[:, None, None]
+				valid = sigsq > 0
+			else:
+				variances = np.asarray(varcopes[:, block], dtype=np.float64)
+				valid = (variances > 0).all(axis=0)
+				variances = np.where(valid, variances, 1.)
+				if run_mode == 'fe':
+					random_variance = np.zeros(variances.shape[1])
+				else:
+					random_variance = _reml_variance(design, data, variances, upper=4 * np.maximum(sigsq, np.finfo(np.float32).tiny))
+				betas, covariance, _ = _weighted_fit(design, data, 1. / (variances + random_variance))
+				statistics['mrefvars'][block, 0] = np.where(valid, random_variance, 0)
+
+			cope = betas.dot(t_contrasts.T)
+			varcope = np.einsum('kp,vpq,kq->vk', t_contrasts, covariance, t_contrasts)
+			tstat = np.zeros_like(cope)
+			np.divide(cope, np.sqrt(varcope), out=tstat, where=varcope > 0)
+			zstat = np.sign(tstat) * -special.ndtri_exp(stats.t.logsf(np.abs(tstat), dof))
+			valid = valid[:, None]
+			statistics['pe'][block] = np.where(valid, betas, 0)
+			statistics['cope'][block] = np.where(valid, cope, 0)
+			statistics['varcope'][block] = np.where(valid, varcope, 0)
+			statistics['tstat'][block] = np.where(valid, tstat, 0)
+			statistics['zstat'][block] = np.where(valid, zstat, 0)
+			for i, f_test in enumerate(f_tests):
+				contrasts = t_contrasts[f_test]
+				effect = betas.dot(contrasts.T)
+				effect_covariance = np.linalg.pinv(np.einsum('kp,vpq,lq->vkl', contrasts, covariance, contrasts))
+				fstat = np.einsum('vk,vkl,vl->v', effect, effect_covariance, effect) / len(f_test)
+				zfstat = -special.ndtri_exp(stats.f.logsf(fstat, len(f_test), dof))
+				statistics['fstat'][block, i] = np.where(valid[:, 0], fstat, 0)
+				statistics['zfstat'][block, i] = np.where(valid[:, 0], zfstat, 0)
+		del copes
+		if run_mode != 'ols':
+			del varcopes
+	finally:
+		shutil.rmtree(stack_dir, ignore_errors=True)
+
+	for key, values in statistics.items():
+		maps = np.zeros((int(np.prod(spatial_shape)), values.shape[1]), dtype=np.float32)
+		maps[voxels] = values
+		statistics[key] = maps.reshape(spatial_shape + (values.shape[1],))
+	return statistics
+
+@lru_cache(maxsize=16)
+def _l2_batch_mask(mask_path):
+	"""Load a mask once per worker process, for all `samri.pipelines.glm.l2_batch` jobs which use it."""
+	import nibabel as nib
+	import numpy as np
+
+	mask_img = nib.load(mask_path)
+	return mask_img, np.asanyarray(mask_img.dataobj)
+
+def _l2_batch_job(position, job, out_dir, mask, run_mode, statistics, block_size):
+	"""Estimate and save one job of `samri.pipelines.glm.l2_batch`, returning its position and its summary record."""
+	import time
+	import nibabel as nib
+	import numpy as np
+
+	start = time.time()
+	record = {'name': job['name'], 'status': 'completed', 'error': ''}
+	try:
+		mask_img, mask_data = _l2_batch_mask(os.path.abspath(os.path.expanduser(job.get('mask', mask))))
+		cope_files = job['cope_files']
+		design = job.get('design', np.ones((len(cope_files), 1)))
+		contrasts = job.get('contrasts', np.ones((1, np.shape(design)[1])))
+		estimates = l2_fit(cope_files, design, contrasts,
+			var_cope_files=job.get('var_cope_files'),
+			mask=mask_data,
+			run_mode=job.get('run_mode', run_mode),
+			volume=job.get('volume'),
+			block_size=block_size,
+			stack_dir=out_dir,
+			)
+		header = mask_img.header.copy()
+		header.set_data_dtype(np.float32)
+		for statistic in statistics:
+			data = estimates[statistic]
+			if data.shape[3] == 1:
+				data = data[..., 0]
+			record[statistic] = os.path.join(out_dir, '{}_{}.nii.gz'.format(job['name'], statistic))
+			nib.save(nib.Nifti1Image(data, mask_img.affine, header), record[statistic])
+	except Exception as e:
+		record['status'] = 'failed'
+		record['error'] = '{}: {}'.format(type(e).__name__, e)
+	record['seconds'] = time.time() - start
+	return position, record
+
+def tfce(data,
+	extent=0.5,
+	height=2.,
+	steps=100,
+	):
+	"""Threshold-free cluster enhancement of the positive values of a 3D statistic map, as computed by FSL's `randomise`.
+
+	Parameters
+	----------
+
+	data : numpy.ndarray
+		3D statistic map.
+	extent : float, optional
+		Exponent of the cluster extent.
+	height : float, optional
+		Exponent of the threshold height.
+	steps : int, optional
+		Number of thresholds, evenly spaced up to the maximum of `data`.
+
+	Returns
+	-------
+
+	numpy.ndarray : Enhanced map, with the same shape as `data`.
+	"""
+	import numpy as np
+	from scipy import ndimage
+
+	enhanced = np.zeros(data.shape)
+	top = data.max()
+	if not top > 0:
+		return enhanced
+	step = top / steps
+	# FSL uses 26-connectivity for 3D clusters.
+	structure = ndimage.generate_binary_structure(3, 3)
+	# Spacing the thresholds via `linspace` ensures that the last one is exactly the maximum.
+	for threshold in np.linspace(step, top, steps):
+		labels, count = ndimage.label(data >= threshold, structure)
+		if not count:
+			break
+		sizes = np.bincount(labels.ravel()).astype(np.float64)
+		sizes[0] = 0
+		enhanced += (sizes**extent * threshold**height * step)[labels]
+	return enhanced
+
+def _permuted_tstat(data, operators, residual_forming, effect_row, basis, scale, dof):
+	"""Freedman-Lane t-statistics (permutations × voxels) of a block of data (maps × voxels), for a stack of permutation and sign-flipping matrices (permutations × maps × maps)."""
+	import numpy as np
+
+	residuals = residual_forming.dot(data)
+	effect = effect_row.dot(operators).dot(residuals)
+	projections = np.einsum('nr,bnm->brm', basis, operators).reshape(-1, len(data))
+	explained = (projections.dot(residuals).reshape(len(operators), basis.shape[1], -1)**2).sum(axis=1)
+	rss = np.clip((residuals**2).sum(axis=0) - explained, 0, None)
+	tstat = np.zeros_like(effect)
+	np.divide(effect, np.sqrt(rss / dof * scale), out=tstat, where=rss > 0)
+	return tstat
+
+def _permutation_chunk(stack_file, orders, signs, observed, model,
+	observed_tfce=None,
+	voxels=None,
+	spatial_shape=None,
+	batch_size=64,
+	block_size=16384,
+	tfce_parameters={},
+	):
+	"""Maximum statistics and voxelwise exceedance counts for a chunk of permutations (see `permutation_test`)."""
+	import numpy as np
+
+	stack = np.load(stack_file, mmap_mode='r')
+	voxel_count = stack.shape[1]
+	maxima = []
+	tfce_maxima = []
+	exceedances = np.zeros(voxel_count, dtype=np.int64)
+	tfce_exceedances = np.zeros(voxel_count, dtype=np.int64)
+	for batch_start in range(0, len(orders), batch_size):
+		batch = slice(batch_start, batch_start + batch_size)
+		batch_count = len(orders[batch])
+		operators = np.zeros((batch_count,) + orders.shape[1:] * 2)
+		operators[np.arange(batch_count)[:, None], np.arange(orders.shape[1]), orders[batch]] = signs[batch]
+		batch_maxima = np.full(batch_count, -np.inf)
+		if observed_tfce is not None:
+			maps = np.zeros((batch_count, int(np.prod(spatial_shape))))
+		for start in range(0, voxel_count, block_size):
+			block = slice(start, min(start + block_size, voxel_count))
+			tstat = _permuted_tstat(np.asarray(stack[:, block], dtype=np.float64), operators, **model)
+			batch_maxima = np.maximum(batch_maxima, tstat.max(axis=1))
+			exceedances[block] += (tstat >= observed[block]).sum(axis=0)
+			if observed_tfce is not None:
+				maps[:, voxels[block]] = tstat
+		maxima.append(batch_maxima)
+		if observed_tfce is not None:
+			for tstat in maps:
+				enhanced = tfce(tstat.reshape(spatial_shape), **tfce_parameters).reshape(-1)[voxels]
+				tfce_maxima.append(enhanced.max())
+				tfce_exceedances += enhanced >= observed_tfce
+	return np.concatenate(maxima), np.array(tfce_maxima), exceedances, tfce_exceedances
+
+def permutation_test(cope_files, design, contrasts,
+	mask=None,
+	permutations=5000,
+	method='flip',
+	tfce_enhancement=True,
+	tfce_parameters={},
+	cope_statistic='cope',
+	volume=None,
+	batch_size=64,
+	block_size=16384,
+	n_jobs=1,
+	seed=None,
+	stack_dir=None,
+	):
+	"""Non-parametric inference for the t-contrasts of a second-level (group) model, via sign-flipping or permutation of the first-level contrast maps.
+
+	Nuisance regressors are handled as by FSL's `randomise`: for each contrast the design is partitioned into the effect of interest and nuisance, and the residuals of the nuisance-only model are sign-flipped or permuted (Freedman-Lane).
+	The first-level maps are stacked into a temporary memory-mapped array (see `statistic_stack`), and the statistics for `batch_size` permutations at a time are computed as batched matrix products over blocks of `block_size` voxels.
+	Chunks of permutations are distributed across `n_jobs` processes, which share the stack via the memory map.
+	If the number of all possible sign-flips or permutations does not exceed `permutations`, they are enumerated exhaustively.
+
+	Parameters
+	----------
+
+	cope_files : list of str
+		Paths to the first-level contrast maps, one per row of `design`.
+	design : numpy.ndarray
+		Design matrix, with one row per map and one column per regressor.
+	contrasts : numpy.ndarray
+		Contrast matrix, with one row per t-contrast and one column per regressor.
+	mask : str, optional
+		Path to a NIfTI file on the same grid as the maps, the nonzero voxels of which will be tested.
+	permutations : int, optional
+		Number of sign-flips or permutations, including the unpermuted data.
+	method : {'flip', 'permute'}, optional
+		Whether to sign-flip the residuals (assuming symmetric errors, e.g. for one-sample and paired designs), or to permute them (assuming exchangeable errors).
+	tfce_enhancement : bool, optional
+		Whether to additionally compute threshold-free cluster enhanced statistics and their p-values.
+		This requires the whole statistic map of `batch_size` permutations to be held in memory at any one time.
+	tfce_parameters : dict, optional
+		Keyword arguments for `tfce`.
+	cope_statistic : str, optional
+		Name of the statistic to read from consolidated first-level statistics files.
+	volume : int, optional
+		Volume to select from 4D first-level maps (e.g. one of multiple contrasts).
+	batch_size : int, optional
+		Number of permutations for which to compute the statistics at any one time in each process.
+	block_size : int, optional
+		Number of voxels for which to compute the statistics at any one time.
+	n_jobs : int, optional
+		Number of processes across which to distribute the permutations.
+	seed : int, optional
+		Seed for the random generation of sign-flips or permutations.
+	stack_dir : str, optional
+		Directory in which to create the temporary stack, by default the current working directory.
+
+	Returns
+	-------
+
+	dict : Dictionary of 4D arrays (with consecutive contrasts along the last axis), under the keys 'tstat', 'vox_p', and 'vox_corrp' (the uncorrected and the family-wise error corrected p-values, the latter via the maximum statistic), as well as 'tfce', 'tfce_p', and 'tfce_corrp' if `tfce_enhancement` is true.
+		Following FSL's `randomise`, p-value maps are given as 1-p.
+	"""
+	import itertools
+	import math
+	import nibabel as nib
+	import numpy as np
+	import shutil
+	import tempfile
+	from joblib import Parallel, delayed
+	from scipy import linalg
+	from samri.utilities import statistic_image
+
+	if method not in ['flip', 'permute']:
+		raise ValueError('The method "{}" is not supported, please choose either "flip" or "permute".'.format(method))
+	design = np.atleast_2d(np.asarray(design, dtype=np.float64))
+	contrasts = np.atleast_2d(np.asarray(contrasts, dtype=np.float64))
+	n = len(cope_files)
+	if design.shape[0] != n:
+		raise ValueError('The design has {} rows, but {} contrast maps were given.'.format(design.shape[0], n))
+	if contrasts.shape[1] != design.shape[1]:
+		raise ValueError('The contrasts have {} columns, but the design has {} regressors.'.format(contrasts.shape[1], design.shape[1]))
+
+	spatial_shape = statistic_image(cope_files[0], cope_statistic).shape[:3]
+	if mask:
+		mask_data = np.asanyarray(nib.load(os.path.abspath(os.path.expanduser(mask))).dataobj)
+		if mask_data.shape[:3] != spatial_shape:
+			raise ValueError('The mask shape {} does not match the image shape {}.'.format(mask_data.shape[:3], spatial_shape))
+		voxels = np.flatnonzero(mask_data.reshape(spatial_shape))
+	else:
+		voxels = np.arange(int(np.prod(spatial_shape)))
+
+	# The first row is always the unpermuted data.
+	rng = np.random.default_rng(seed)
+	if method == 'flip':
+		if 2**n <= permutations:
+			signs = np.array(list(itertools.product([1., -1.], repeat=n)))
+		else:
+			signs = np.vstack([np.ones(n), rng.choice([1., -1.], size=(permutations - 1, n))])
+		orders = np.tile(np.arange(n), (len(signs), 1))
+	else:
+		if math.factorial(n) <= permutations:
+			orders = np.array(list(itertools.permutations(range(n))))
+		else:
+			orders = np.vstack([np.arange(n)] + [rng.permutation(n) for _ in range(permutations - 1)])
+		signs = np.ones(orders.shape)
+	count = len(orders)
+	chunks = np.array_split(np.arange(count), max(min(n_jobs, count), 1))
+
+	keys = ['tstat', 'vox_p', 'vox_corrp']
+	if tfce_enhancement:
+		keys += ['tfce', 'tfce_p', 'tfce_corrp']
+	statistics = {key: np.zeros((len(voxels), len(contrasts)), dtype=np.float32) for key in keys}
+	gram_inverse = np.linalg.pinv(design.T.dot(design))
+	stack_dir = tempfile.mkdtemp(prefix='permutation_stack_', dir=stack_dir or os.getcwd())
+	try:
+		stack_file = os.path.join(stack_dir, 'cope.npy')
+		stack = statistic_stack(cope_files, stack_file,
+			voxels=voxels,
+			statistic=cope_statistic,
+			volume=volume,
+			)
+		for i, contrast in enumerate(contrasts):
+			# Partition the design into the effect of interest and the nuisance (Smith et al. 2007).
+			contrast_variance = contrast.dot(gram_inverse).dot(contrast)
+			interest = design.dot(gram_inverse).dot(contrast) / contrast_variance
+			null = linalg.null_space(contrast[None])
+			null = null - np.outer(contrast, contrast.dot(gram_inverse).dot(null)) / contrast_variance
+			nuisance = design.dot(gram_inverse).dot(null).dot(np.linalg.pinv(null.T.dot(gram_inverse).dot(null)))
+			if np.linalg.matrix_rank(nuisance) > 0:
+				nuisance = linalg.orth(nuisance)
+				residual_forming = np.eye(n) - nuisance.dot(nuisance.T)
+			else:
+				nuisance = np.zeros((n, 0))
+				residual_forming = np.eye(n)
+			partitioned = np.column_stack([interest, nuisance])
+			basis = linalg.orth(partitioned)
+			dof = n - basis.shape[1]
+			if dof < 1:
+				raise ValueError('The design (with rank {}) leaves no degrees of freedom for {} maps.'.format(basis.shape[1], n))
+			model = dict(
+				residual_forming=residual_forming,
+				effect_row=np.linalg.pinv(partitioned)[0],
+				basis=basis,
+				scale=np.linalg.pinv(partitioned.T.dot(partitioned))[0, 0],
+				dof=dof,
+				)
+
+			identity = np.eye(n)[None]
+			observed = np.concatenate([_permuted_tstat(np.asarray(stack[:, start:start + block_size], dtype=np.float64), identity, **model)[0] for start in range(0, len(voxels), block_size)])
+			# Tolerance for the comparison of permuted statistics to the observed ones, which are numerically identical for the identity.
+			tolerance = 1e-6 * max(np.abs(observed).max(), 1)
+			observed_tfce = None
+			if tfce_enhancement:
+				volume_data = np.zeros(int(np.prod(spatial_shape)))
+				volume_data[voxels] = observed
+				observed_tfce = tfce(volume_data.reshape(spatial_shape), **tfce_parameters).reshape(-1)[voxels]
+				tfce_tolerance = 1e-6 * max(observed_tfce.max(), 1)
+			results = Parallel(n_jobs=n_jobs, verbose=0)(map(delayed(_permutation_chunk),
+				[stack_file] * len(chunks),
+				[orders[chunk] for chunk in chunks],
+				[signs[chunk] for chunk in chunks],
+				[observed - tolerance] * len(chunks),
+				[model] * len(chunks),
+				[None if observed_tfce is None else observed_tfce - tfce_tolerance] * len(chunks),
+				[voxels] * len(chunks),
+				[spatial_shape] * len(chunks),
+				[batch_size] * len(chunks),
+				[block_size] * len(chunks),
+				[tfce_parameters] * len(chunks),
+				))
+			maxima = np.sort(np.concatenate([result[0] for result in results]))
+			statistics['tstat'][:, i] = observed
+			statistics['vox_p'][:, i] = 1 - sum(result[2] for result in results) / count
+			statistics['vox_corrp'][:, i] = np.searchsorted(maxima, observed - tolerance) / count
+			if tfce_enhancement:
+				tfce_maxima = np.sort(np.concatenate([result[1] for result in results]))
+				statistics['tfce'][:, i] = observed_tfce
+				statistics['tfce_p'][:, i] = 1 - sum(result[3] for result in results) / count
+				statistics['tfce_corrp'][:, i] = np.searchsorted(tfce_maxima, observed_tfce - tfce_tolerance) / count
+		del stack
+	finally:
+		shutil.rmtree(stack_dir, ignore_errors=True)
+
+	for key, values in statistics.items():
+		maps = np.zeros((int(np.prod(spatial_shape)), values.shape[1]), dtype=np.float32)
+		maps[voxels] = values
+		statistics[key] = maps.reshape(spatial_shape + (values.shape[1],))
+	return statistics
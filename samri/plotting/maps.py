@@ -23,7 +23,7 @@ from mpl_toolkits.axes_grid1.inset_locator import inset_axes
 
 from samri.fetch.local import roi_from_atlaslabel
 from samri.plotting.utilities import QUALITATIVE_COLORSET
-from samri.utilities import collapse
+from samri.utilities import collapse, statistic_image
 from samri.report.roi import from_img_threshold
 
 COLORS_PLUS = plt.cm.autumn(np.linspace(0., 1, 128))
@@ -109,8 +109,7 @@ def _draw_colorbar(stat_map_img, axes,
 	if bypass_cmap:
 		bypass_cmap = cmap
 	if isinstance(stat_map_img, str):
-		stat_map_img = path.abspath(path.expanduser(stat_map_img))
-		stat_map_img = nib.load(stat_map_img)
+		stat_map_img = statistic_image(stat_map_img)
 		stat_map_img_dat = _safe_get_data(stat_map_img, ensure_finite=True)
 	else:
 		stat_map_img_dat = stat_map_img
@@ -200,7 +199,10 @@ def make_pos(stat_map):
 	Creates a Nifti1Image from given stat_map that contains only
 	positive values for plotting positive values only.
 	"""
-	img = nib.load(stat_map)
+	if isinstance(stat_map, str):
+		img = statistic_image(stat_map)
+	else:
+		img = stat_map
 	img_data = img.get_fdata()
 	img_data[img_data < 0] = 0
 	img_pos=nib.Nifti1Image(img_data,img.affine)
@@ -211,7 +213,10 @@ def make_neg(stat_map):
 	Creates a Nifti1Image from given stat_map that contains only
 	negative values for plotting negative values only.
 	"""
-	img = nib.load(stat_map)
+	if isinstance(stat_map, str):
+		img = statistic_image(stat_map)
+	else:
+		img = stat_map
 	img_data = img.get_fdata()
 	img_data[img_data > 0] = 0
 	img_neg=nib.Nifti1Image(img_data,img.affine)
@@ -249,6 +254,7 @@ def scaled_plot(template,
 
 	stat_map : string or array_like
 		A path to a NIfTI file, or a nibabel object (e.g. Nifti1Image), giving the statistic image to plot.
+		Paths to statistics within consolidated GLM statistics files are resolved via `samri.utilities.statistic_image`.
 	template : string or array_like
 		A path to a NIfTI file, or a nibabel object (e.g. Nifti1Image), to use as a backdrop when plotting the statistic image.
 	fig : matplotlib figure object
@@ -265,10 +271,9 @@ def scaled_plot(template,
 	except AttributeError:
 		pass
 
-	try:
-		stat_map = path.abspath(path.expanduser(stat_map))
-	except (AttributeError, TypeError):
-		pass
+	# Paths are resolved to images, so that maps in consolidated GLM statistics files can be plotted.
+	if isinstance(stat_map, str):
+		stat_map = statistic_image(stat_map)
 
 	#if stat_cmap:
 	#	cmap=stat_cmap
@@ -5,7 +5,8 @@ import pandas as pd
 from os import path
 from joblib import Parallel, delayed
 
-from nipype.interfaces import ants, fsl
+from nipype.interfaces import ants
+from samri.pipelines.extra_interfaces import TemporalMean
 
 def measure_sim(image_path, reference,
 	substitutions=False,
@@ -53,7 +54,7 @@ def measure_sim(image_path, reference,
 		merged_image_name = "merged_"+image_name
 		merged_image_path = path.join("/tmp",merged_image_name)
 		if not path.isfile(merged_image_path):
-			temporal_mean = fsl.MeanImage()
+			temporal_mean = TemporalMean()
 			temporal_mean.inputs.in_file = image_path
 			temporal_mean.inputs.out_file = merged_image_path
 			temporal_mean_res = temporal_mean.run()
@@ -80,3 +80,41 @@ def test_bids_naming():
 #		structural_match={'acquisition':['TurboRARE', 'TurboRARElowcov']},
 #		functional_registration_method="composite")
 
+
+def test_read_jcampdx():
+	from samri.pipelines.utils import read_jcampdx
+
+	scan_dir = path.join(DATA_DIR,'bruker','20151110_170605_4011_1_1')
+	subject = read_jcampdx(path.join(scan_dir,'subject'))
+	assert subject['SUBJECT_id'] == '4011'
+	assert subject['SUBJECT_study_name'] == 'ofMaF'
+	assert subject['SUBJECT_instance_creation_date'] == (1447171505, 763, 60)
+
+	visu_pars = read_jcampdx(path.join(scan_dir,'3','visu_pars'))
+	assert visu_pars['VisuCoreOrientation'].shape == (1,9)
+	assert list(visu_pars['VisuCoreSize']) == [64,64,64]
+
+	# Repeated reads are served from the cache.
+	assert read_jcampdx(path.join(scan_dir,'3','acqp'), lines=True) is read_jcampdx(path.join(scan_dir,'3','acqp'), lines=True)
+
+def test_data_selection_manifest(tmp_path):
+	from samri.pipelines.extra_functions import get_data_selection
+	import json
+
+	bruker_data_dir = path.join(DATA_DIR,'bruker')
+	manifest_file = path.join(str(tmp_path),'manifest.json')
+	match = {'task':['JogB','CogB','CogB2m']}
+	data_selection = get_data_selection(bruker_data_dir, match=match)
+	manifest_selection = get_data_selection(bruker_data_dir, match=match, manifest_file=manifest_file)
+	assert data_selection.equals(manifest_selection)
+
+	with open(manifest_file) as f:
+		manifest = json.load(f)
+	assert len(manifest) == 3
+	# Unchanged measurements are read from the manifest.
+	for measurement in manifest.values():
+		measurement['measurement']['session'] = 'fromManifest'
+	with open(manifest_file, 'w') as f:
+		json.dump(manifest, f)
+	manifest_selection = get_data_selection(bruker_data_dir, match=match, manifest_file=manifest_file)
+	assert list(manifest_selection['session'].unique()) == ['fromManifest']
@@ -3,3 +3,20 @@ from samri.manipulations import flip_axis
 def test_flip_axis():
 	nii_path = '/usr/share/samri_bidsdata/bids_collapsed/sub-4007/ses-ofM/func/sub-4007_ses-ofM_task-JogB_acq-EPIlowcov_run-0_bold.nii.gz'
 	flip_axis(nii_path)
+
+def test_flip_axis_chunked(tmp_path):
+	import nibabel as nib
+	import numpy as np
+
+	data = np.random.RandomState(0).randint(0, 1000, size=(5,4,3,7)).astype(np.int16)
+	img = nib.Nifti1Image(data, np.diag([0.2,0.3,0.5,1]))
+	img.header.set_slope_inter(0.5, 2)
+	in_file = str(tmp_path / 'in.nii.gz')
+	nib.save(img, in_file)
+
+	out_file = flip_axis(in_file, out_path=str(tmp_path / 'flipped.nii.gz'), chunk_size=3)
+	img = nib.load(in_file)
+	flipped = nib.load(out_file)
+	assert flipped.get_data_dtype() == np.int16
+	assert np.allclose(flipped.affine, img.affine)
+	assert np.array_equal(flipped.get_fdata(), img.get_fdata()[::-1,::-1])
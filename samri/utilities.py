@@ -350,3 +350,64 @@ def ordered_structures(
 		structure_names.append(structure_name)
 
 	return structure_names
+
+GLM_STATISTICS_DESC = 'glm'
+
+def statistics_sidecar(file_path):
+	"""Return the path of the JSON sidecar of a NIfTI file (i.e. the path with the `.nii` or `.nii.gz` extension replaced by `.json`)."""
+	for extension in ['.nii.gz', '.nii']:
+		if file_path.endswith(extension):
+			return file_path[:-len(extension)] + '.json'
+	return path.splitext(file_path)[0] + '.json'
+
+def statistic_image(stat_map,
+	statistic=None,
+	):
+	"""Load a statistic map, transparently supporting consolidated GLM statistics files.
+
+	Consolidated files (as written by `samri.pipelines.extra_interfaces.NativeGLM`) contain all statistics of a GLM fit as consecutive volumes of a single 4D NIfTI file, with a `desc-glm` BIDS field.
+	Their JSON sidecar maps each statistic name (e.g. 'cope', 'tstat') to its volume indices under the "Statistics" key.
+	If `stat_map` does not exist, but a consolidated file does at the same path with the `desc-<statistic>` field replaced by `desc-glm`, the statistic is read from there.
+
+	Parameters
+	----------
+
+	stat_map : str
+		Path to a NIfTI file, either containing the statistic map, or a consolidated GLM statistics file.
+	statistic : str, optional
+		Name of the statistic to read from a consolidated file.
+		If unspecified, this is determined from the `desc-` field of `stat_map`.
+
+	Returns
+	-------
+
+	nibabel.Nifti1Image : Image of the statistic map, 3D if it consists of a single volume.
+	"""
+	import json
+	import re
+
+	stat_map = path.abspath(path.expanduser(stat_map))
+	desc = re.search(r'(?<=[_/])desc-([a-zA-Z0-9]+)(?=_)', stat_map)
+	if not path.exists(stat_map) and desc and desc.group(1) != GLM_STATISTICS_DESC:
+		statistic = statistic or desc.group(1)
+		stat_map = stat_map[:desc.start(1)] + GLM_STATISTICS_DESC + stat_map[desc.end(1):]
+	img = nib.load(stat_map)
+	sidecar = statistics_sidecar(stat_map)
+	if not path.isfile(sidecar):
+		return img
+	with open(sidecar) as f:
+		statistics = json.load(f).get('Statistics')
+	if not statistics:
+		return img
+	if statistic is None:
+		if desc and desc.group(1) in statistics:
+			statistic = desc.group(1)
+		else:
+			raise ValueError('"{}" is a consolidated statistics file, please specify which of the following statistics to read: {}.'.format(stat_map, ', '.join(statistics)))
+	try:
+		volumes = statistics[statistic]
+	except KeyError:
+		raise ValueError('The statistic "{}" is not recorded in "{}", available statistics are: {}.'.format(statistic, stat_map, ', '.join(statistics)))
+	if len(volumes) == 1:
+		return img.slicer[..., volumes[0]]
+	return img.slicer[..., volumes[0]:volumes[-1] + 1]